@@ -0,0 +1,52 @@
+# このファイルは backend/http_session_helper.py と google-adk/firestore_test_connect/http_session_helper.py に同じ内容で置いています
+# （デプロイ単位が別のため）。変更する場合は両方を同じ内容に更新してください。
+import random
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 接続先ホストごとのプール数と、ホストごとに保持する接続数
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 10
+# Cloud Runが混雑時に返す429/503は、リクエストが処理されていないため再試行します（Retry-Afterヘッダーがあれば従います）
+HTTP_RETRY_STATUS_CODES = (429, 503)
+HTTP_RETRY_TOTAL = 3
+# 再試行の待ち時間: 0.5秒, 1秒, 2秒 ... に、同時に失敗した呼び出しの再試行が重ならないようランダムな揺らぎを加えます
+HTTP_RETRY_BACKOFF_FACTOR = 0.5
+HTTP_RETRY_JITTER_SEC = 0.5
+
+
+class JitteredRetry(Retry):
+    """指数バックオフの待ち時間にランダムな揺らぎを加えるRetry"""
+
+    def get_backoff_time(self) -> float:
+        return super().get_backoff_time() + random.uniform(0, HTTP_RETRY_JITTER_SEC)
+
+
+def create_http_session() -> requests.Session:
+    """接続プール（keep-alive）と再試行を設定したHTTPセッションを作成します。
+
+    モジュールレベルで1つ作成して使い回すことで、呼び出しごとのDNS解決・TCP/TLSハンドシェイクを省きます。
+
+    Returns:
+        requests.Session: HTTPセッション
+    """
+    retry = JitteredRetry(
+        total=HTTP_RETRY_TOTAL,
+        connect=HTTP_RETRY_TOTAL,
+        # 送信済みのリクエストが処理されている可能性があるため、読み取りエラーでは再試行しません
+        read=0,
+        status=HTTP_RETRY_TOTAL,
+        status_forcelist=HTTP_RETRY_STATUS_CODES,
+        # POSTも再試行します（429/503と接続エラーのみ）
+        allowed_methods=None,
+        backoff_factor=HTTP_RETRY_BACKOFF_FACTOR,
+        # 再試行しきった場合は最後のレスポンスをそのまま返します
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
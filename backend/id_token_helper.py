@@ -0,0 +1,116 @@
+# このファイルは backend/id_token_helper.py と google-adk/firestore_test_connect/id_token_helper.py に同じ内容で置いています
+# （デプロイ単位が別のため）。変更する場合は両方を同じ内容に更新してください。
+import logging
+import threading
+import time
+
+import google.auth
+from google.auth import jwt
+from google.auth.transport.requests import Request
+from google.oauth2 import id_token
+
+logger = logging.getLogger(__name__)
+
+# 有効期限までの残り時間がこれを下回ったら、キャッシュ済みのIDトークンを返しつつバックグラウンドで更新します
+ID_TOKEN_REFRESH_MARGIN_SEC = 300
+# 有効期限までの残り時間がこれを下回ったIDトークンは使わず、呼び出し元で取得し直します
+ID_TOKEN_MIN_VALID_SEC = 60
+
+
+class IdTokenProvider:
+    def __init__(self):
+        """Cloud Run呼び出し用のIDトークンをaudience(呼び出し先URL)ごとにキャッシュするクラスの初期化
+
+        インスタンス内の呼び出し間で共有し、複数スレッドから同時に呼び出しても、同じaudienceのIDトークン取得は1回だけ行います。
+        """
+        # audience -> (IDトークン, 有効期限のUNIX時刻)
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self._refreshing = set()
+        self._default_credentials = None
+        self._credentials_lock = threading.Lock()
+
+    def get_token(self, audience: str) -> str:
+        """audienceのIDトークンを返します。
+
+        有効期限まで十分に残っているキャッシュはそのまま返し、期限が近い場合はバックグラウンドで更新します。
+        キャッシュが無い、または期限切れ間近の場合のみ、その場で取得します。
+
+        Args:
+            audience (str): 呼び出し先のCloud RunのURL
+
+        Returns:
+            str: IDトークン
+        """
+        with self._lock:
+            cached = self._tokens.get(audience)
+
+        if cached is not None:
+            token, expires_at = cached
+            remaining = expires_at - time.time()
+            if remaining > ID_TOKEN_MIN_VALID_SEC:
+                if remaining < ID_TOKEN_REFRESH_MARGIN_SEC:
+                    self._refresh_in_background(audience)
+                return token
+
+        return self._fetch(audience, ID_TOKEN_MIN_VALID_SEC)
+
+    def get_access_token(self, credentials=None) -> str:
+        """認証情報のアクセストークンを返します（期限切れの場合のみ更新します）
+
+        Args:
+            credentials: google.auth の認証情報（省略時はデフォルト認証情報を初回のみ取得して使い回します）
+
+        Returns:
+            str: アクセストークン
+        """
+        with self._credentials_lock:
+            if credentials is None:
+                if self._default_credentials is None:
+                    self._default_credentials, _ = google.auth.default()
+                credentials = self._default_credentials
+            if not credentials.valid:
+                credentials.refresh(Request())
+            return credentials.token
+
+    def _fetch(self, audience: str, min_valid_sec: float) -> str:
+        """IDトークンを取得してキャッシュします（同じaudienceの取得は1スレッドずつ行います）"""
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(audience, threading.Lock())
+
+        with fetch_lock:
+            # 待っている間に他のスレッドが取得済みであれば、それを使います
+            with self._lock:
+                cached = self._tokens.get(audience)
+            if cached is not None and cached[1] - time.time() > min_valid_sec:
+                return cached[0]
+
+            token = id_token.fetch_id_token(Request(), audience)
+            # 署名の検証は呼び出し先で行われるため、ここでは有効期限の読み取りのみ行います
+            expires_at = jwt.decode(token, verify=False)["exp"]
+
+            with self._lock:
+                self._tokens[audience] = (token, expires_at)
+
+            logger.info(f"🔐 IDトークンを取得しました for URL: {audience} (有効期限まで{int(expires_at - time.time())}秒)")
+            return token
+
+    def _refresh_in_background(self, audience: str):
+        """IDトークンの更新をバックグラウンドのスレッドで開始します（更新中の場合は何もしません）"""
+        with self._lock:
+            if audience in self._refreshing:
+                return
+            self._refreshing.add(audience)
+
+        def refresh():
+            try:
+                self._fetch(audience, ID_TOKEN_REFRESH_MARGIN_SEC)
+            except Exception as e:
+                # 失敗してもキャッシュ済みのIDトークンは期限まで使えるため、次回の呼び出しで再試行します
+                logger.warning(f"⚠️ IDトークンのバックグラウンド更新に失敗しました for URL: {audience}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(audience)
+
+        threading.Thread(target=refresh, name="id-token-refresh", daemon=True).start()
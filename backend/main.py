@@ -1,48 +1,190 @@
-from firebase_functions import firestore_fn
+from firebase_functions import firestore_fn, scheduler_fn
 from firebase_functions.firestore_fn import Event, DocumentSnapshot
-import requests
+import contextvars
 import logging
+import os
+import random
 import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-import google.auth
-from google.auth.transport.requests import Request
 import json
+from http_session_helper import create_http_session
+from id_token_helper import IdTokenProvider
 
 # Cloud Logging用の設定
+# LOG_LEVEL 以上のログは常に出力し、それ未満（DEBUG）の詳細ログは LOG_SAMPLE_RATE の割合の関数呼び出しでのみ出力する
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# 不明なレベル名が指定された場合は INFO として扱う（getLevelName は不明な名前に "Level XXX" という文字列を返す）
+LOG_LEVEL_NO = logging.getLevelName(LOG_LEVEL) if isinstance(logging.getLevelName(LOG_LEVEL), int) else logging.INFO
+# サンプリングした関数呼び出しで DEBUG を出力するアプリケーションのロガー（それ以外のライブラリのロガーは LOG_LEVEL 未満を出力しない）
+APP_LOGGER_NAMES = (__name__, "id_token_helper")
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.05"))
+# 1件のログに出力するメッセージ・値の最大文字数（超えた分は切り詰める）
+LOG_MAX_MESSAGE_CHARS = 2000
+LOG_MAX_FIELD_CHARS = 500
+
+# 実行中の関数呼び出しのログの文脈（InvocationLog）
+_current_invocation = contextvars.ContextVar("current_invocation", default=None)
+
+def truncate_for_log(value, limit: int = LOG_MAX_FIELD_CHARS) -> str:
+    """ログに出力する値を文字列にし、limit文字を超える分を切り詰める"""
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(truncated {len(text) - limit} chars)"
+
+class JsonLogFormatter(logging.Formatter):
+    """Cloud Loggingが構造化ログ（jsonPayload）として取り込めるよう、ログを1行のJSONで出力"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": truncate_for_log(record.getMessage(), LOG_MAX_MESSAGE_CHARS),
+            "logger": record.name,
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+        }
+        invocation = _current_invocation.get()
+        if invocation is not None:
+            entry["invocation"] = {
+                "function": invocation.function_name,
+                "request_id": invocation.request_id,
+                "sampled": invocation.sampled,
+            }
+        # logger.info(..., extra={"fields": {...}}) で渡された構造化データ
+        if getattr(record, "fields", None):
+            entry.update(record.fields)
+        if record.exc_info:
+            entry["exception"] = truncate_for_log(self.formatException(record.exc_info), LOG_MAX_MESSAGE_CHARS)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class InvocationSamplingFilter(logging.Filter):
+    """LOG_LEVEL未満のアプリケーションのログを、サンプリング対象の関数呼び出しでのみ通す"""
+
+    def __init__(self, app_logger_names: set):
+        super().__init__()
+        self.app_logger_names = app_logger_names
+        self.min_level = LOG_LEVEL_NO
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.min_level:
+            return True
+        invocation = _current_invocation.get()
+        return record.name in self.app_logger_names and invocation is not None and invocation.sampled
+
 def setup_logging():
     """Cloud Logging用のロガーを設定"""
-    # ルートロガーの設定
+    # ルートロガーは LOG_LEVEL とし、アプリケーションのロガーのみ DEBUG まで通す（出力するかどうかはハンドラーのフィルターで判定）
     root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
+    root_logger.setLevel(LOG_LEVEL_NO)
+    for logger_name in APP_LOGGER_NAMES:
+        logging.getLogger(logger_name).setLevel(logging.DEBUG)
     
     # 既存のハンドラーをクリア
     root_logger.handlers.clear()
     
     # StreamHandlerを追加（Cloud Functionsでは標準出力がCloud Loggingに転送される）
     handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.INFO)
+    handler.addFilter(InvocationSamplingFilter(set(APP_LOGGER_NAMES)))
     
-    # フォーマッターを設定
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    handler.setFormatter(formatter)
+    # フォーマッターを設定（1行のJSON）
+    handler.setFormatter(JsonLogFormatter())
     
     root_logger.addHandler(handler)
     
-    return root_logger
+    app_logger = logging.getLogger(__name__)
+    if logging.getLevelName(LOG_LEVEL) != LOG_LEVEL_NO:
+        app_logger.warning(f"Unknown LOG_LEVEL: {LOG_LEVEL} (using INFO)")
+    return app_logger
+
+class InvocationLog:
+    """関数呼び出し1回分のログの文脈を管理し、終了時に工程ごとの処理時間をまとめた要約ログを1件出力"""
+
+    def __init__(self, function_name: str, request_id: str = None):
+        self.function_name = function_name
+        self.request_id = request_id
+        # 詳細ログ（DEBUG）を出力するかは呼び出しごとに決める
+        self.sampled = random.random() < LOG_SAMPLE_RATE
+        self.status = "success"
+        self.stage_ms = {}
+        self.counts = {}
+        # saveLog(isWriteToDoc=True) でまだ書き込んでいないログ: (コレクション, ドキュメントID) -> ログのリスト
+        self.doc_logs = {}
+        self._started_at = None
+        self._token = None
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        self._token = _current_invocation.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.status = "error"
+        # 終了時に残っているドキュメントへのログを書き込む
+        flush_doc_logs()
+        logger.info(
+            f"📊 {self.function_name} finished: status={self.status}",
+            extra={"fields": {"summary": {
+                "status": self.status,
+                "total_ms": round((time.perf_counter() - self._started_at) * 1000, 1),
+                "stage_ms": self.stage_ms,
+                "counts": self.counts,
+            }}}
+        )
+        _current_invocation.reset(self._token)
+        return False
+
+    def add_stage_ms(self, name: str, elapsed_ms: float):
+        self.stage_ms[name] = round(self.stage_ms.get(name, 0) + elapsed_ms, 1)
+
+    def count(self, name: str, value: int = 1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+def current_invocation():
+    """実行中の関数呼び出しのInvocationLogを取得（関数の外ではNone）"""
+    return _current_invocation.get()
+
+@contextmanager
+def log_stage(name: str):
+    """with内の処理時間を工程nameの処理時間として要約ログに加算"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        invocation = current_invocation()
+        if invocation is not None:
+            invocation.add_stage_ms(name, (time.perf_counter() - started_at) * 1000)
+
+def log_invocation(func):
+    """Firestoreトリガー関数をInvocationLogで囲み、終了時に要約ログを出力するデコレーター"""
+    @wraps(func)
+    def wrapper(event, *args, **kwargs):
+        params = getattr(event, "params", None) or {}
+        with InvocationLog(func.__name__, request_id=params.get("requestId")):
+            return func(event, *args, **kwargs)
+    return wrapper
+
+# Cloud Run呼び出し用のIDトークンのキャッシュ（関数インスタンス内で使い回す）
+id_token_provider = IdTokenProvider()
+
+# 呼び出しごとのタイムアウト (接続, 読み取り) 秒
+CONVERTER_TIMEOUT = (5, 30)  # 非同期ジョブの受付（202が返るまで）
+CONVERTER_SYNC_TIMEOUT = (5, 280)  # 同期変換（関数のタイムアウト(300秒)より前に打ち切って失敗を記録する）
+ADK_SESSION_TIMEOUT = (5, 30)
+ADK_RUN_TIMEOUT = (5, 280)  # 関数のタイムアウト(300秒)より前に打ち切ってエラーを記録する（SSEではイベント間の待ち時間）
+# /run_sse の途中経過をリクエストドキュメントに書き込む間隔（秒）
+AGENT_PARTIAL_WRITE_INTERVAL_SEC = 1.0
+
+# Cloud Run呼び出し用のHTTPセッション（関数インスタンス内で接続を使い回す。接続プールと429/503の再試行の設定は http_session_helper を参照）
+http_session = create_http_session()
 
 def get_cloud_run_auth_headers(target_url: str) -> dict:
-    """Cloud Run認証用のヘッダーを取得"""
+    """Cloud Run認証用のヘッダーを取得（IDトークンはURLごとにキャッシュ）"""
     try:
-        from google.oauth2 import id_token
-        from google.auth.transport.requests import Request
-        
-        # IDトークンを取得（Cloud Run認証用）
-        auth_req = Request()
-        id_token_value = id_token.fetch_id_token(auth_req, target_url)
-        
-        logger.info(f"🔐 IDトークンを正常に取得しました for URL: {target_url}")
+        id_token_value = id_token_provider.get_token(target_url)
         
         return {
             "Content-Type": "application/json",
@@ -52,22 +194,16 @@ def get_cloud_run_auth_headers(target_url: str) -> dict:
         logger.error(f"❌ IDトークン取得エラー: {e}")
         # フォールバック: 従来のアクセストークンを使用
         logger.info("🔄 フォールバック: アクセストークンを使用します")
-        credentials, project = google.auth.default()
-        auth_req = Request()
-        credentials.refresh(auth_req)
+        access_token = id_token_provider.get_access_token()
         
         return {
             "Content-Type": "application/json",
-            "Authorization": f"Bearer {credentials.token}"
+            "Authorization": f"Bearer {access_token}"
         }
 
 # ロガーを初期化
 logger = setup_logging()
 
-# また、モジュールレベルのロガーも設定
-module_logger = logging.getLogger(__name__)
-module_logger.setLevel(logging.INFO)
-
 def extract_event_info_from_firestore_event(event: Event[DocumentSnapshot | None]):
     """Extract necessary information from Firestore event"""
     try:
@@ -98,27 +234,73 @@ def extract_organization_id_from_collection_name(path: str) -> str:
         logger.error(f"Failed to extract organization ID: {e}")
         return ""
 
+# saveLog(isWriteToDoc=True) のログは関数呼び出し中はバッファーにため、同じドキュメントの更新時・関数の終了時にまとめて書き込む
+# バッファーがこの件数に達した場合はその時点で書き込む
+DOC_LOG_BUFFER_MAX_ENTRIES = 50
+# ドキュメントのログの type はフロントエンドの型（info / warn / error）に合わせる
+DOC_LOG_TYPES = {"warning": "warn"}
+
+# Firestoreクライアント（関数インスタンス内で使い回す）
+_firestore_client = None
+_firestore_client_lock = threading.Lock()
+
+def get_firestore_client():
+    """Firestoreクライアントを取得（初回のみ作成し、以降は同じクライアントを返す）"""
+    global _firestore_client
+    if _firestore_client is None:
+        with _firestore_client_lock:
+            if _firestore_client is None:
+                import firebase_admin
+                from firebase_admin import firestore
+                if not firebase_admin._apps:
+                    firebase_admin.initialize_app()
+                _firestore_client = firestore.client()
+    return _firestore_client
+
 def update_document(collectionName, documentId, data):
-    """Update Firestore document"""
+    """Update Firestore document（バッファー中の同じドキュメントへのログも同じ書き込みに含める）"""
     try:
-        # 🎯 Target locked! Writing to collection and document
-        logger.info(f"🚀 FIRESTORE WRITE INCOMING! Collection: '{collectionName}' | Document: '{documentId}'")
+        invocation = current_invocation()
+        # バッファー中のログは書き込みに成功してから取り除く（失敗した場合は次の書き込み・終了時の書き込みで再度書き込む）
+        pending_logs = invocation.doc_logs.get((collectionName, documentId)) if invocation is not None else None
+        if pending_logs:
+            from firebase_admin import firestore
+            data = {**data, "logs": firestore.ArrayUnion(pending_logs)}
+        if not data:
+            return
         
-        from firebase_admin import firestore
-        db = firestore.client()
-        doc_ref = db.collection(collectionName).document(documentId)
-        doc_ref.update(data)
-        logger.info(f"✅ Document updated successfully: {collectionName}/{documentId}")
+        # 🎯 Target locked! Writing to collection and document
+        logger.debug(f"🚀 FIRESTORE WRITE INCOMING! Collection: '{collectionName}' | Document: '{documentId}'")
+        
+        with log_stage("firestore_write"):
+            doc_ref = get_firestore_client().collection(collectionName).document(documentId)
+            doc_ref.update(data)
+        if invocation is not None:
+            invocation.count("firestore_writes")
+            if pending_logs:
+                invocation.doc_logs.pop((collectionName, documentId), None)
+                invocation.count("doc_logs_written", len(pending_logs))
+        logger.debug(f"✅ Document updated successfully: {collectionName}/{documentId}")
     except Exception as e:
         logger.error(f"❌ Failed to update document: {e}")
 
+def flush_doc_logs():
+    """バッファー中のドキュメントへのログを、ドキュメントごとに1回の書き込みでまとめて書き込む"""
+    invocation = current_invocation()
+    if invocation is None:
+        return
+    for collection_name, document_id in list(invocation.doc_logs):
+        update_document(collection_name, document_id, {})
+    # 書き込みに失敗して残ったログは、ロガーには出力済みのためドキュメントへの書き込みのみ諦める
+    for (collection_name, document_id), pending_logs in invocation.doc_logs.items():
+        logger.error(f"❌ Dropped {len(pending_logs)} log entries for {collection_name}/{document_id}: Firestore write failed")
+        invocation.count("doc_logs_dropped", len(pending_logs))
+    invocation.doc_logs.clear()
+
 def saveLog(logType: str, logMessage: str, isWriteToDoc: bool = False, docInfo: dict = None):
     """Save log with improved Cloud Logging support"""
     try:
-        # Cloud Loggingに確実に出力するため、printも併用
-        log_entry = f"[{logType.upper()}] {logMessage}"
-        print(log_entry)  # Cloud Functionsでは print も Cloud Logging に転送される
-        
+        # ロガーは標準出力に1行のJSONとして出力し、Cloud Loggingに転送される（printとの二重出力はしない）
         if logType == "info":
             logger.info(logMessage)
         elif logType == "error":
@@ -129,28 +311,41 @@ def saveLog(logType: str, logMessage: str, isWriteToDoc: bool = False, docInfo:
             logger.debug(logMessage)
         
         if isWriteToDoc and docInfo:
-            from firebase_admin import firestore
-            update_document(
-                collectionName=docInfo["collectionName"],
-                documentId=docInfo["docId"],
-                data={
-                    f"logs": firestore.ArrayUnion([{
-                        "type": logType,
-                        "message": logMessage,
-                        "timestamp": firestore.SERVER_TIMESTAMP
-                    }])
-                }
-            )
+            # 配列の要素にはSERVER_TIMESTAMPを使えないため、記録した時刻を保存する（まとめて書き込んでも順序が保たれる）
+            log_entry = {
+                "type": DOC_LOG_TYPES.get(logType, logType),
+                "message": logMessage,
+                "timestamp": datetime.now(timezone.utc)
+            }
+            doc_key = (docInfo["collectionName"], docInfo["docId"])
+            invocation = current_invocation()
+            if invocation is None:
+                # 関数呼び出しの外では従来どおりすぐに書き込む
+                from firebase_admin import firestore
+                update_document(*doc_key, {"logs": firestore.ArrayUnion([log_entry])})
+                return
+            
+            buffered_logs = invocation.doc_logs.setdefault(doc_key, [])
+            buffered_logs.append(log_entry)
+            if len(buffered_logs) >= DOC_LOG_BUFFER_MAX_ENTRIES:
+                update_document(*doc_key, {})
     except Exception as e:
-        print(f"[ERROR] Failed to save log: {e}")
         logger.error(f"Failed to save log: {e}")
 
+# 変換の非同期ジョブの生存確認の設定
+# 非同期ジョブは変換サービスが進捗を書き込むたびに heartbeatAt を更新する。
+# heartbeatAt がこの時間(秒)以上更新されていない processing のジョブは、変換サービスのインスタンスの停止などで
+# 失われたとみなして failed にする
+CONVERSION_JOB_STALE_SEC = 15 * 60
+
 @firestore_fn.on_document_created(
     document="organizations/{organizationId}/requests/convertPdfToPngAndCaptureRequests/logs/{requestId}",
     memory=1024,
     timeout_sec=300
 )
+@log_invocation
 def convert_pdf_to_png_and_capture_job(event: Event[DocumentSnapshot | None]) -> None:
+    log_doc_info = None  # リクエストドキュメントが特定できるまではロガーにのみ出力する
     try:
         # Extract necessary information from event
         event_data = extract_event_info_from_firestore_event(event)
@@ -162,45 +357,118 @@ def convert_pdf_to_png_and_capture_job(event: Event[DocumentSnapshot | None]) ->
         request_id = doc_info["docId"]
         organization_id = fields["input"]["organizationId"]
         blueprint_id = fields["input"]["blueprintId"]
-        
-        # ログを強化して確実に出力
-        print(f"[INFO] Processing PDF conversion request: {request_id}")
-        logger.info(f"Fields: {fields}")
-        logger.info(f"Request ID: {request_id}")
-        logger.info(f"Organization ID: {organization_id}")
-        logger.info(f"Blueprint ID: {blueprint_id}")
+        # input.async が true の場合のみ、変換サービスに非同期ジョブとして受け付けさせる
+        # （レスポンス後も処理を続けるため、変換サービスのCloud Runで「CPUを常に割り当てる」設定が必要）
+        use_async = bool(fields["input"].get("async"))
+        # input.perceptualHash が true の場合のみ、版の比較用のページハッシュ(png/blueprint_phash.json)も保存させる
+        # （全ページをもう一度レンダリングするため、図面の改版を比較するリクエストでのみ指定する）
+        use_perceptual_hash = bool(fields["input"].get("perceptualHash"))
+        
+        # リクエストドキュメントへのログは関数の終了時・ステータスの更新時にまとめて書き込まれる
+        log_collection_path = f"organizations/{organization_id}/requests/convertPdfToPngAndCaptureRequests/logs"
+        log_doc_info = {"collectionName": log_collection_path, "docId": request_id}
+        saveLog("info", f"Processing PDF conversion request: {request_id} (organization={organization_id}, blueprint={blueprint_id}, async={use_async})", True, log_doc_info)
+        logger.debug(f"Fields: {truncate_for_log(fields)}")
         
         # Convert PDF to PNG and save
         url = "https://convert-pdf-to-png-and-capture-208707381956.us-central1.run.app/convert-pdf-to-png"
         payload = {
             "bucket_name": "knockai-106a4.firebasestorage.app",
             "gcsInputPdfFilePath": f"organizations/{organization_id}/blueprints/{blueprint_id}/pdf/blueprint.pdf",
-            "gcsOutputPreviewPngFilePath": f"organizations/{organization_id}/blueprints/{blueprint_id}/png/blueprint.png"
+            "gcsOutputPreviewPngFilePath": f"organizations/{organization_id}/blueprints/{blueprint_id}/png/blueprint.png",
+            "extractText": True,
+            "perceptualHash": use_perceptual_hash
         }
+        if use_async:
+            # 変換サービスは非同期ジョブとして受け付けて即座に202を返し、
+            # 進捗(pagesDone, bytes, elapsedMs)と完了ステータスをこのリクエストのログドキュメントに直接書き込みます
+            payload.update({
+                "async": True,
+                "jobId": request_id,
+                "firestoreLogDocumentPath": f"{log_collection_path}/{request_id}"
+            })
         
         # Get authentication headers for Cloud Run
-        headers = get_cloud_run_auth_headers(url)
+        with log_stage("auth"):
+            headers = get_cloud_run_auth_headers(url)
         
-        logger.info(f"Sending request to: {url}")
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
+        logger.debug(f"Sending request to: {url}")
+        with log_stage("convert_request"):
+            response = http_session.post(url, json=payload, headers=headers, timeout=CONVERTER_TIMEOUT if use_async else CONVERTER_SYNC_TIMEOUT)
+            response.raise_for_status()
         
-        print(f"[INFO] Successfully converted PDF to PNG: {response.json()}")
-        logger.info(f"Successfully converted PDF to PNG: {response.json()}")
+        if use_async:
+            saveLog("info", f"PDF conversion job accepted for request {request_id}", True, log_doc_info)
+            logger.debug(f"Converter response: {truncate_for_log(response.text)}")
+            return
+        
+        saveLog("info", f"Successfully converted PDF to PNG for request {request_id}", True, log_doc_info)
+        logger.debug(f"Converter response: {truncate_for_log(response.text)}")
         
         # Save Blueprint data to Firestore
         update_document(
-            collectionName=f"organizations/{organization_id}/requests/convertPdfToPngAndCaptureRequests/logs",
+            collectionName=log_collection_path,
             documentId=request_id,
             data={
                 "status": "completed",
+                "output": response.json(),
             }
         )
-        print(f"[INFO] Process completed successfully for request: {request_id}")
     except Exception as e:
+        current_invocation().status = "error"
         error_msg = f"Failed to convert PDF to PNG and capture pages: {e}"
-        print(f"[ERROR] {error_msg}")
-        logger.error(error_msg)
+        saveLog("error", error_msg, True, log_doc_info)
+        
+        # Update document status to failed（非同期ジョブの受付に失敗した場合も、processingのまま残さない）
+        try:
+            update_document(
+                collectionName=f"organizations/{organization_id}/requests/convertPdfToPngAndCaptureRequests/logs",
+                documentId=request_id,
+                data={
+                    "status": "failed",
+                    "output": {"status": "error", "message": error_msg},
+                }
+            )
+        except Exception as update_error:
+            update_error_msg = f"Failed to update document status to failed: {update_error}"
+            logger.error(update_error_msg)
+
+
+@scheduler_fn.on_schedule(schedule="every 10 minutes", memory=256, timeout_sec=120)
+@log_invocation
+def mark_stale_conversion_jobs(event: scheduler_fn.ScheduledEvent) -> None:
+    """heartbeatAt が CONVERSION_JOB_STALE_SEC 以上更新されていない processing の変換ジョブを failed にする"""
+    from google.cloud.firestore_v1.base_query import FieldFilter
+    
+    client = get_firestore_client()
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=CONVERSION_JOB_STALE_SEC)
+    # heartbeatAt は変換ジョブだけが書き込むため、他のリクエストのログドキュメントは対象にならない
+    query = (
+        client.collection_group("logs")
+        .where(filter=FieldFilter("status", "==", "processing"))
+        .where(filter=FieldFilter("heartbeatAt", "<", cutoff))
+    )
+    
+    with log_stage("query"):
+        stale_docs = list(query.stream())
+    
+    for doc in stale_docs:
+        message = f"Conversion job {doc.id} marked as failed: no progress since {doc.get('heartbeatAt')}"
+        try:
+            # 読み取り後にジョブが進捗・結果を書き込んでいた場合は上書きしない
+            doc.reference.update(
+                {
+                    "status": "failed",
+                    "output": {"status": "error", "message": message},
+                },
+                option=client.write_option(last_update_time=doc.update_time)
+            )
+            current_invocation().count("stale_jobs_failed")
+            logger.warning(f"⚠️ {message} ({doc.reference.path})")
+        except Exception as e:
+            logger.warning(f"Skipped marking conversion job {doc.reference.path} as failed: {e}")
+    
+    logger.info(f"Checked stale conversion jobs: {len(stale_docs)} found")
 
 
 @firestore_fn.on_document_created(
@@ -208,7 +476,9 @@ def convert_pdf_to_png_and_capture_job(event: Event[DocumentSnapshot | None]) ->
     memory=1024,
     timeout_sec=300
 )
+@log_invocation
 def start_estimate_create_process(event: Event[DocumentSnapshot | None]) -> None:
+    log_doc_info = None  # リクエストドキュメントが特定できるまではロガーにのみ出力する
     try:
         # Extract necessary information from event
         event_data = extract_event_info_from_firestore_event(event)
@@ -223,31 +493,30 @@ def start_estimate_create_process(event: Event[DocumentSnapshot | None]) -> None
         app_name = fields["input"]["appName"]
         user_id = fields["input"]["userId"]
         
-        # ログを強化して確実に出力
-        print(f"[INFO] Starting estimate create process: {session_id}")
-        logger.info(f"Fields: {fields}")
-        logger.info(f"Request ID: {request_id}")
-        logger.info(f"Organization ID: {organization_id}")
-        logger.info(f"Session ID: {session_id}")
-        logger.info(f"App Name: {app_name}")
-        logger.info(f"User ID: {user_id}")
+        log_doc_info = {"collectionName": f"organizations/{organization_id}/requests/startEstimateCreateProcessRequests/logs", "docId": request_id}
+        saveLog("info", f"Starting estimate create process: {session_id} (request={request_id}, organization={organization_id}, app={app_name}, user={user_id})", True, log_doc_info)
+        logger.debug(f"Fields: {truncate_for_log(fields)}")
         
         # Create new session
         session_url = f"https://adk-default-service-name-208707381956.us-central1.run.app/apps/{app_name}/users/{user_id}/sessions/{session_id}"
         
         # Get authentication headers for Cloud Run
-        headers = get_cloud_run_auth_headers(session_url)
+        with log_stage("auth"):
+            headers = get_cloud_run_auth_headers(session_url)
         
-        logger.info(f"Sending request to create session: {session_url}")
+        logger.debug(f"Sending request to create session: {session_url}")
         
         # Send POST request to create new session
-        response = requests.post(session_url, headers=headers)
-        response.raise_for_status()
+        with log_stage("create_session"):
+            response = http_session.post(session_url, headers=headers, timeout=ADK_SESSION_TIMEOUT)
+            response.raise_for_status()
         
-        print(f"[INFO] Successfully created new session: {response.text}")
-        logger.info(f"Successfully created new session: {response.text}")
+        logger.debug(f"Successfully created new session: {truncate_for_log(response.text)}")
+        
+        success_msg = f"Estimate create process started successfully for session_id: {session_id}"
+        saveLog("info", success_msg, True, log_doc_info)
         
-        # Update document status to completed
+        # Update document status to completed（バッファー中のログも同じ書き込みに含まれる）
         update_document(
             collectionName=f"organizations/{organization_id}/requests/startEstimateCreateProcessRequests/logs",
             documentId=request_id,
@@ -256,14 +525,10 @@ def start_estimate_create_process(event: Event[DocumentSnapshot | None]) -> None
             }
         )
         
-        success_msg = f"Estimate create process started successfully for session_id: {session_id}"
-        print(f"[INFO] {success_msg}")
-        logger.info(success_msg)
-        
     except Exception as e:
+        current_invocation().status = "error"
         error_msg = f"Failed to start estimate create process: {e}"
-        print(f"[ERROR] {error_msg}")
-        logger.error(error_msg)
+        saveLog("error", error_msg, True, log_doc_info)
         
         # Update document status to failed
         try:
@@ -276,16 +541,74 @@ def start_estimate_create_process(event: Event[DocumentSnapshot | None]) -> None
             )
         except Exception as update_error:
             update_error_msg = f"Failed to update document status to failed: {update_error}"
-            print(f"[ERROR] {update_error_msg}")
             logger.error(update_error_msg)
 
 
+def iter_sse_data(response):
+    """SSEレスポンスを受信しながら、イベントごとのdataフィールド（JSON文字列）を順に返す
+
+    data: 行が無いレスポンスは、本文全体を1つのJSONとして返す
+    """
+    data_lines = []
+    raw_lines = []
+    has_data = False
+    for line in response.iter_lines(decode_unicode=True):
+        line = line.strip() if line else ""
+        if line.startswith("data:"):
+            # 📝 "data: "プレフィックスを削除（複数行のdataは改行で連結）
+            data_lines.append(line[5:].lstrip())
+            has_data = True
+        elif not line:
+            # 空行でイベントが終わる
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+        elif not has_data:
+            raw_lines.append(line)
+    if data_lines:
+        yield "\n".join(data_lines)
+    elif not has_data and raw_lines:
+        logger.info(f"ℹ️ data行が見つかりません、元のテキストを単一JSONとして処理")
+        yield "\n".join(raw_lines)
+
+def extract_parts_from_agent_event(json_str: str, event_number: int):
+    """エージェントのイベント（JSON文字列）から content.parts と途中経過かどうかを取り出す"""
+    try:
+        response_data = json.loads(json_str)
+    except json.JSONDecodeError as json_error:
+        logger.error(f"❌ data行 {event_number} のJSON decode error: {json_error}")
+        # 🔄 JSONパースに失敗した場合はテキストとして追加
+        return [{"text": json_str}], False
+    
+    if not isinstance(response_data, dict) or "content" not in response_data:
+        logger.debug(f"⚠️ data行 {event_number} で'content'キーが見つかりません")
+        return [], False
+    
+    parts = (response_data["content"] or {}).get("parts")
+    if not parts:
+        logger.debug(f"⚠️ data行 {event_number} のcontent内で'parts'キーが見つかりません")
+        return [], False
+    
+    return parts, bool(response_data.get("partial"))
+
+def merge_partial_parts(partial_parts: list, parts: list) -> list:
+    """生成途中のテキストの差分を、直前のテキストパーツに連結する"""
+    merged = list(partial_parts)
+    for part in parts:
+        if merged and "text" in part and set(merged[-1]) == {"text"} and set(part) == {"text"}:
+            merged[-1] = {"text": merged[-1]["text"] + part["text"]}
+        else:
+            merged.append(part)
+    return merged
+
 @firestore_fn.on_document_created(
     document="organizations/{organizationId}/requests/sendQueryToGoogleAgentRequests/logs/{requestId}",
     memory=1024,
     timeout_sec=300
 )
+@log_invocation
 def send_query_to_google_agent(event: Event[DocumentSnapshot | None]) -> None:
+    log_doc_info = None  # リクエストドキュメントが特定できるまではロガーにのみ出力する
     try:
         # 🎯 イベントから必要な情報を抽出
         event_data = extract_event_info_from_firestore_event(event)
@@ -304,15 +627,11 @@ def send_query_to_google_agent(event: Event[DocumentSnapshot | None]) -> None:
         # 💾 エージェントレスポンスと共にドキュメントステータスを完了に更新
         collection_path = f"organizations/{organization_id}/requests/sendQueryToGoogleAgentRequests/logs"        
         
-        # 📝 ログを強化して確実に出力
-        logger.info(f"🤖 Google Agentにクエリを送信中: {query[:50]}...")
-        logger.info(f"📋 Fields: {fields}")
-        logger.info(f"🆔 Request ID: {request_id}")
-        logger.info(f"🏢 Organization ID: {organization_id}")
-        logger.info(f"💬 Session ID: {session_id}")
-        logger.info(f"📱 App Name: {app_name}")
-        logger.info(f"👤 User ID: {user_id}")
-        logger.info(f"❓ Query: {query}")
+        # 📝 識別子は1件にまとめ、クエリ本文などの詳細はサンプリングされた呼び出しでのみ出力
+        # リクエストドキュメントへのログは次のステータス更新（途中経過の書き込みを含む）にまとめて書き込まれる
+        log_doc_info = {"collectionName": collection_path, "docId": request_id}
+        saveLog("info", f"🤖 Google Agentにクエリを送信中: request={request_id}, organization={organization_id}, session={session_id}, app={app_name}, user={user_id}", True, log_doc_info)
+        logger.debug(f"❓ Query: {truncate_for_log(query)}")
         
         # 📦 Google Agent API用のペイロードを準備
         payload = {
@@ -324,147 +643,97 @@ def send_query_to_google_agent(event: Event[DocumentSnapshot | None]) -> None:
                 "parts": [{
                     "text": query
                 }]
-            }
+            },
+            # 生成途中のテキストもイベントとして受け取る
+            "streaming": True
         }
         
         # 🚀 Google Agentにクエリを送信
         agent_url = "https://adk-default-service-name-208707381956.us-central1.run.app/run_sse"
         
         # 🔐 認証ヘッダーを取得
-        headers = get_cloud_run_auth_headers(agent_url)
-        
-        logger.info(f"🌐 Google Agentにクエリを送信中: {agent_url}")
-        logger.info(f"📤 Payload: {payload}")
-        
-        # 📡 POSTリクエストをGoogle Agentに送信
-        response = requests.post(agent_url, json=payload, headers=headers)
-        response.raise_for_status()
-        
-        # 📊 レスポンスの詳細ログを強化
-        logger.info(f"✅ Google Agent response status: {response.status_code}")
-        logger.info(f"📋 Google Agent response headers: {dict(response.headers)}")
-        logger.info(f"📄 Google Agent raw response text (length: {len(response.text)}): {repr(response.text)}")
-        
-        # 🔍 レスポンスを解析してエージェントの返答を抽出
-        try:
-            # 📝 複数の data: プレフィックス付きJSON文字列を処理
-            response_text = response.text.strip()            
-            logger.info(f"🔍 レスポンステキストを処理中: {repr(response_text)}")
-            
-            # 🧹 複数の "data: " 行を分割して処理
-            data_lines = []
-            for line in response_text.split('\n'):
-                line = line.strip()
-                if line.startswith("data: "):
-                    json_str = line[6:]  # "data: "プレフィックスを削除
-                    data_lines.append(json_str)
-                    logger.info(f"🧹 data行を発見、JSON文字列: {repr(json_str)}")
-            
-            # 📊 見つかったdata行の数をログ出力
-            logger.info(f"📊 見つかったdata行の数: {len(data_lines)}")
-            
-            # 🔄 data行が見つからない場合は元のテキストを使用
-            if not data_lines:
-                logger.info(f"ℹ️ data行が見つかりません、元のテキストを単一JSONとして処理")
-                data_lines = [response_text]
-            
-            # 📝 全てのdata行からpartsを抽出
-            all_agent_parts = []
-            
-            for i, json_str in enumerate(data_lines):
-                try:
-                    logger.info(f"🔧 data行 {i+1}/{len(data_lines)} のJSONを解析中: {repr(json_str)}")
-                    response_data = json.loads(json_str)
-                    logger.info(f"✅ data行 {i+1} のJSONレスポンス解析に成功: {response_data}")
-                    
-                    # 📝 content.partsからテキストを抽出
-                    if "content" in response_data:
-                        logger.info(f"✅ data行 {i+1} で'content'キーを発見")
-                        
-                        if "parts" in response_data["content"]:
-                            logger.info(f"✅ data行 {i+1} のcontent内で'parts'を発見: {response_data['content']['parts']}")
-                            
-                            # 🔄 各パートを all_agent_parts に追加
-                            for j, part in enumerate(response_data["content"]["parts"]):
-                                logger.info(f"🔍 data行 {i+1} のパート {j} を処理中: {part}")
-                                all_agent_parts.append(part)
-                                logger.info(f"✅ data行 {i+1} のパート {j} を追加")
-                        else:
-                            logger.warning(f"⚠️ data行 {i+1} のcontent内で'parts'キーが見つかりません")
-                    else:
-                        logger.warning(f"⚠️ data行 {i+1} で'content'キーが見つかりません")
-                        
-                except json.JSONDecodeError as json_error:
-                    logger.error(f"❌ data行 {i+1} のJSON decode error: {json_error}")
-                    logger.error(f"❌ data行 {i+1} をJSONとして解析できませんでした: {repr(json_str)}")
-                    # 🔄 JSONパースに失敗した場合はテキストとして追加
-                    all_agent_parts.append({"text": json_str})
-                except Exception as parse_error:
-                    logger.error(f"❌ data行 {i+1} の解析エラー: {parse_error}")
-                    all_agent_parts.append({"text": json_str})
-            
-            # 🔄 パーツが見つからない場合はフォールバック
-            if not all_agent_parts:
-                logger.warning(f"⚠️ エージェントパーツが抽出されませんでした、フォールバックを使用")
-                all_agent_parts = [{"text": "No response content found"}]
-            
-            # 📊 最終的なagent_partsのログ出力
-            logger.info(f"🎯 最終的に抽出されたエージェントパーツ数: {len(all_agent_parts)}")
-            logger.info(f"🎯 最終的に抽出されたエージェントパーツ: {all_agent_parts}")
+        with log_stage("auth"):
+            headers = get_cloud_run_auth_headers(agent_url)
+        
+        logger.debug(f"📤 Payload: {truncate_for_log(payload)}")
+        
+        # 📡 POSTリクエストをGoogle Agentに送信し、SSEを受信しながら処理
+        # 応答全体を待たずにイベントごとにパーツを取り出し、途中経過を一定間隔でドキュメントに書き込む
+        agent_parts = []  # 確定したパーツ
+        partial_parts = []  # 生成途中のパーツ（トークン単位の差分を連結したもの）
+        event_count = 0
+        written_parts_count = 0
+        last_written_at = None  # 最初の途中経過は受信後すぐに書き込む
+        
+        stream_started_at = time.perf_counter()
+        with http_session.post(agent_url, json=payload, headers=headers, timeout=ADK_RUN_TIMEOUT, stream=True) as response:
+            response.raise_for_status()
+            logger.debug(f"📋 Google Agent response headers: {truncate_for_log(dict(response.headers))}")
             
-            agent_parts = all_agent_parts
-            
-            update_document(
-                collectionName=collection_path,
-                documentId=request_id,
-                data={
-                    "status": "completed",
-                    "output": {
-                        "parts": agent_parts
-                    }
-                }
-            )
-            
-        except json.JSONDecodeError as json_error:
-            logger.error(f"❌ JSON decode error: {json_error}")
-            logger.error(f"❌ レスポンスをJSONとして解析できませんでした。生レスポンス: {repr(response.text)}")
-            
-            # 🔄 JSONパースに失敗した場合、レスポンステキストをそのまま使用
-            collection_path = f"organizations/{organization_id}/requests/sendQueryToGoogleAgentRequests/logs"
-            update_document(
-                collectionName=collection_path,
-                documentId=request_id,
-                data={
-                    "status": "completed",
-                    "output": {
-                        "parts": [{"text": response.text}],
-                        "rawResponse": response.text
-                    }
-                }
-            )
-        except Exception as parse_error:
-            logger.error(f"Parse error: {parse_error}")
-            logger.error(f"Failed to parse response, treating as plain text. Raw response: {repr(response.text)}")
-            
-            # Fallback: treat response as plain text
-            collection_path = f"organizations/{organization_id}/requests/sendQueryToGoogleAgentRequests/logs"
-            update_document(
-                collectionName=collection_path,
-                documentId=request_id,
-                data={
-                    "status": "completed",
-                    "output": {
-                        "parts": [{"text": response.text}]
-                    }
-                }
-            )
+            for json_str in iter_sse_data(response):
+                event_count += 1
+                if event_count == 1:
+                    # ⏱️ 最初のイベントを受信するまでの時間
+                    current_invocation().add_stage_ms("agent_first_event", (time.perf_counter() - stream_started_at) * 1000)
+                parts, is_partial = extract_parts_from_agent_event(json_str, event_count)
+                if is_partial:
+                    partial_parts = merge_partial_parts(partial_parts, parts)
+                else:
+                    # 確定したイベントは、それまでの途中経過を置き換える
+                    agent_parts.extend(parts)
+                    partial_parts = []
+                
+                # ⏱️ 途中経過を AGENT_PARTIAL_WRITE_INTERVAL_SEC 秒ごとに書き込む
+                current_parts_count = len(agent_parts) + len(partial_parts)
+                if current_parts_count and (last_written_at is None or time.monotonic() - last_written_at >= AGENT_PARTIAL_WRITE_INTERVAL_SEC):
+                    update_document(
+                        collectionName=collection_path,
+                        documentId=request_id,
+                        data={
+                            "status": "streaming",
+                            "output": {
+                                "parts": agent_parts + partial_parts
+                            }
+                        }
+                    )
+                    written_parts_count = current_parts_count
+                    last_written_at = time.monotonic()
+        
+        # Firestoreへの書き込み時間を除いた、SSEの受信・解析にかかった時間
+        invocation = current_invocation()
+        invocation.add_stage_ms("agent_stream", (time.perf_counter() - stream_started_at) * 1000 - invocation.stage_ms.get("firestore_write", 0))
+        invocation.count("agent_events", event_count)
+        
+        # 途中で終了した生成途中のパーツも結果に含める
+        agent_parts.extend(partial_parts)
+        
+        # 🔄 パーツが見つからない場合はフォールバック
+        if not agent_parts:
+            saveLog("warning", f"⚠️ エージェントパーツが抽出されませんでした、フォールバックを使用", True, log_doc_info)
+            agent_parts = [{"text": "No response content found"}]
+        
+        # 📊 最終的なagent_partsのログ出力
+        invocation.count("agent_parts", len(agent_parts))
+        logger.debug(f"🎯 受信したイベント数: {event_count}, 途中経過として書き込んだパーツ数: {written_parts_count}")
         
         success_msg = f"Query sent successfully to Google Agent for session: {session_id}"
-        logger.info(success_msg)
+        saveLog("info", success_msg, True, log_doc_info)
+        
+        update_document(
+            collectionName=collection_path,
+            documentId=request_id,
+            data={
+                "status": "completed",
+                "output": {
+                    "parts": agent_parts
+                }
+            }
+        )
         
     except Exception as e:
+        current_invocation().status = "error"
         error_msg = f"Failed to send query to Google Agent: {e}"
-        logger.error(error_msg)
+        saveLog("error", error_msg, True, log_doc_info)
         
         # Update document status to failed
         try:
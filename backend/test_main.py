@@ -0,0 +1,79 @@
+import unittest
+from unittest import mock
+
+import main
+
+COLLECTION = "organizations/org/requests/convertPdfToPngAndCaptureRequests/logs"
+DOC_INFO = {"collectionName": COLLECTION, "docId": "request-1"}
+
+
+class SaveLogBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.client = mock.MagicMock()
+        patcher = mock.patch.object(main, "get_firestore_client", return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.document = self.client.collection.return_value.document.return_value
+
+    def written_logs(self, call):
+        return [(entry["type"], entry["message"]) for entry in call.args[0]["logs"].values]
+
+    def test_logs_are_written_with_the_next_status_update(self):
+        with main.InvocationLog("test_function", request_id="request-1"):
+            main.saveLog("info", "started", True, DOC_INFO)
+            main.saveLog("warning", "fallback used", True, DOC_INFO)
+            self.document.update.assert_not_called()
+
+            main.update_document(COLLECTION, "request-1", {"status": "completed"})
+
+        self.document.update.assert_called_once()
+        call = self.document.update.call_args
+        self.assertEqual(call.args[0]["status"], "completed")
+        self.assertEqual(self.written_logs(call), [("info", "started"), ("warn", "fallback used")])
+
+    def test_remaining_logs_are_flushed_in_one_write_on_exit(self):
+        with main.InvocationLog("test_function", request_id="request-1"):
+            for index in range(3):
+                main.saveLog("info", f"message {index}", True, DOC_INFO)
+
+        self.document.update.assert_called_once()
+        call = self.document.update.call_args
+        self.assertEqual(set(call.args[0]), {"logs"})
+        self.assertEqual(self.written_logs(call), [("info", "message 0"), ("info", "message 1"), ("info", "message 2")])
+
+    def test_buffer_is_written_when_it_reaches_the_limit(self):
+        with mock.patch.object(main, "DOC_LOG_BUFFER_MAX_ENTRIES", 2):
+            with main.InvocationLog("test_function", request_id="request-1"):
+                for index in range(3):
+                    main.saveLog("info", f"message {index}", True, DOC_INFO)
+                self.assertEqual(self.document.update.call_count, 1)
+
+        self.assertEqual(self.document.update.call_count, 2)
+        self.assertEqual(self.written_logs(self.document.update.call_args_list[1]), [("info", "message 2")])
+
+    def test_logs_are_kept_when_the_write_fails(self):
+        self.document.update.side_effect = [Exception("unavailable"), None]
+        with main.InvocationLog("test_function", request_id="request-1"):
+            main.saveLog("info", "started", True, DOC_INFO)
+            main.update_document(COLLECTION, "request-1", {"status": "processing"})
+            main.saveLog("info", "converted", True, DOC_INFO)
+            main.update_document(COLLECTION, "request-1", {"status": "completed"})
+
+        self.assertEqual(self.document.update.call_count, 2)
+        self.assertEqual(self.written_logs(self.document.update.call_args), [("info", "started"), ("info", "converted")])
+
+    def test_logs_outside_an_invocation_are_written_immediately(self):
+        main.saveLog("error", "failed", True, DOC_INFO)
+
+        self.document.update.assert_called_once()
+        self.assertEqual(self.written_logs(self.document.update.call_args), [("error", "failed")])
+
+    def test_logs_without_a_document_are_not_written(self):
+        with main.InvocationLog("test_function"):
+            main.saveLog("error", "failed before the request document was known", True, None)
+
+        self.document.update.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
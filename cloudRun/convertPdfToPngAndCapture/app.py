@@ -1,13 +1,37 @@
 import os
+import io
 import sys
+import re
+import json
+import math
+import time
+import uuid
+import hashlib
 import tempfile
+import threading
+import itertools
 import subprocess
 import logging
+import xml.etree.ElementTree as ElementTree
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from PIL import Image
+# プロセス内でPDFをレンダリングするライブラリ (未インストールの場合はpdftoppmを使用します)
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
 # Google Cloud Storage クライアント
 from google.cloud import storage
+from google.api_core.exceptions import NotFound
+# Firestore クライアント (非同期ジョブの進捗書き込み用)
+from google.cloud import firestore
 # Flask ウェブフレームワーク
 from flask import Flask, request, jsonify
-from pdf2image import convert_from_path
+# 版の比較(ページハッシュの差分)
+from page_hash_diff import diff_page_hashes
 
 # ロガーの設定
 logger = logging.getLogger(__name__)
@@ -19,8 +43,1071 @@ app = Flask(__name__)
 # GCS クライアントはアプリケーション起動時に一度だけ作成します
 storage_client = storage.Client()
 
+# Firestore クライアントも同様にアプリケーション起動時に一度だけ作成します
+firestore_client = firestore.Client()
+
+# 複数ページ変換用のプロセスプールのサイズ (デフォルトはコンテナのCPUコア数)
+RENDER_POOL_SIZE = int(os.environ.get("RENDER_POOL_SIZE", os.cpu_count() or 1))
+
+# プロセスプールは起動時に一度だけ作成し、リクエスト間で使い回します (ワーカープロセスは常駐します)
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+# プロセスプールに投入できる未完了レンダリングの上限 (超えた場合は空きが出るまで待機します)
+RENDER_QUEUE_LIMIT = int(os.environ.get("RENDER_QUEUE_LIMIT", RENDER_POOL_SIZE * 4))
+_render_queue_slots = threading.BoundedSemaphore(RENDER_QUEUE_LIMIT)
+
+# ページのレンダリング方式
+# pdfium: 常駐ワーカープロセス内でPDFiumを使ってレンダリングします (リクエストごとのfork/execやフォント初期化が不要)
+# poppler: ページごとにpdftoppmを起動します (従来方式)
+RENDER_BACKEND = os.environ.get("RENDER_BACKEND", "pdfium" if pdfium else "poppler")
+
+# 変換済み出力のインデックス(レンダーキャッシュ)を保存するバケット内のプレフィックス
+RENDER_CACHE_PREFIX = os.environ.get("RENDER_CACHE_PREFIX", "_renderCache")
+# レンダーキャッシュのインデックスの形式のバージョン (形式を変えた場合に上げると、古いインデックスは参照されなくなります)
+RENDER_CACHE_VERSION = 2
+
+# 名前付きの変換プロファイル
+# dpi: 変換解像度 / max_width, max_height: 最大サイズ(px) / grayscale: グレースケール化 / format: 出力形式 / quality: 非可逆圧縮の品質
+# profilesを指定しない場合は従来通り original (200dpiのPNG) のみを出力します
+RENDER_PROFILES = {
+    "original": {"dpi": 200, "max_width": None, "max_height": None, "grayscale": False, "format": "PNG", "quality": None},
+    "thumbnail": {"dpi": 72, "max_width": 320, "max_height": 320, "grayscale": False, "format": "WEBP", "quality": 75},
+    "preview": {"dpi": 110, "max_width": 1600, "max_height": 1600, "grayscale": False, "format": "WEBP", "quality": 85},
+    "analysis": {"dpi": 300, "max_width": None, "max_height": None, "grayscale": True, "format": "PNG", "quality": None},
+}
+DEFAULT_RENDER_PROFILE = "original"
+
+# 出力形式ごとの拡張子とContent-Type
+IMAGE_FORMATS = {
+    "PNG": {"extension": ".png", "content_type": "image/png"},
+    "WEBP": {"extension": ".webp", "content_type": "image/webp"},
+    "JPEG": {"extension": ".jpg", "content_type": "image/jpeg"},
+}
+
+# タイル分割レンダリング(tilesモード)のデフォルト設定
+DEFAULT_TILE_SIZE = int(os.environ.get("DEFAULT_TILE_SIZE", 1024))
+DEFAULT_TILE_DPI = RENDER_PROFILES["analysis"]["dpi"]
+
+# バッチ変換の同時実行数と1リクエストあたりの最大件数
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+MAX_BATCH_ITEMS = int(os.environ.get("MAX_BATCH_ITEMS", 50))
+# バッチ変換で新しいアイテムの処理を開始してよい時間(秒)
+# Cloud Runのリクエストタイムアウト(デフォルト300秒)より前にレスポンスを返すため、これを過ぎたアイテムは処理せずに
+# skipped として返します (処理済みのアイテムの結果は失われず、呼び出し元はskippedのアイテムだけを再送できます)
+BATCH_TIME_BUDGET_SEC = float(os.environ.get("BATCH_TIME_BUDGET_SEC", 240))
+
+# 非同期ジョブを処理するバックグラウンドワーカー数と、Firestoreへの進捗書き込みの最小間隔(秒)
+# ※非同期ジョブ(async)はリクエストごとの指定でのみ使用します。レスポンス返却後も処理を続けるため、
+#   asyncを使う場合はCloud Runで「CPUを常に割り当てる」設定(--no-cpu-throttling)が必要です
+# ※進捗を書き込むたびにログドキュメントの heartbeatAt を更新します。更新が途絶えたジョブは
+#   呼び出し元(backend)の定期実行関数が failed にします
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_PROGRESS_INTERVAL_SEC = float(os.environ.get("JOB_PROGRESS_INTERVAL_SEC", 1.0))
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="conversion-job")
+
+# テキスト抽出(extractText)で寸法注記とみなすトークンのパターン
+# 例: W1200, φ20, R5, M6, t=1.6, 1,200mm, 600×900, ±0.1
+DIMENSION_PATTERN = re.compile(
+    r'^(?:[WDHL]\s*=?\s*\d[\d,]*(?:\.\d+)?'
+    r'|[φΦøØ]\s*\d+(?:\.\d+)?'
+    r'|R\s*\d+(?:\.\d+)?'
+    r'|M\d+(?:\.\d+)?'
+    r'|t\s*=?\s*\d+(?:\.\d+)?'
+    r'|\d[\d,]*(?:\.\d+)?\s*(?:mm|cm|m)'
+    r'|\d+(?:\.\d+)?\s*[×xX*]\s*\d+(?:\.\d+)?(?:\s*[×xX*]\s*\d+(?:\.\d+)?)?'
+    r'|±\s*\d+(?:\.\d+)?'
+    r'|\d{2,}(?:,\d{3})*(?:\.\d+)?)$'
+)
+
+# 版の比較(perceptualHash)用のページハッシュの設定
+# ページを出力プロファイルに依存しない固定DPIのグレースケールでレンダリングして二値化し、
+# ページ全体と1インチ(72pt)角のセルごとにハッシュを計算します。
+# アンチエイリアスや色の違いは二値化で吸収し、寸法注記1文字の修正でもセル単位で検出できます。
+PAGE_HASH_VERSION = 1
+PAGE_HASH_DPI = 100
+PAGE_HASH_CELL_PT = 72
+PAGE_HASH_BINARIZE_THRESHOLD = 128
+
 # LibreOfficeの実行可能ファイル名 (環境によって 'libreoffice' または 'soffice')
 
+
+def initialize_render_worker():
+    """
+    レンダリングワーカープロセスの初期化処理です。
+    PDFiumを使う場合は空のページを1度レンダリングし、初回リクエストでの初期化コストを先に払っておきます。
+    """
+    if RENDER_BACKEND == "pdfium":
+        document = pdfium.PdfDocument.new()
+        page = document.new_page(72, 72)
+        page.render().close()
+        page.close()
+        document.close()
+
+
+def get_render_pool():
+    """レンダリング用のプロセスプールを取得します (未作成の場合は作成)"""
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            logger.info(f"Creating render process pool: max_workers={RENDER_POOL_SIZE}, backend={RENDER_BACKEND}")
+            _render_pool = ProcessPoolExecutor(max_workers=RENDER_POOL_SIZE, initializer=initialize_render_worker)
+    return _render_pool
+
+
+def reset_render_pool(broken_pool):
+    """
+    ワーカープロセスが異常終了して壊れたプロセスプールを破棄します (次回のget_render_poolで作り直します)。
+    既に別のスレッドが作り直している場合は何もしません。
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is not broken_pool:
+            return
+        # 壊れたプールの残りのワーカープロセスは、プールの管理スレッドが終了させます
+        _render_pool = None
+    logger.warning("Render process pool is broken (a worker process died). Recreating it.")
+
+
+def submit_render(function, *args):
+    """
+    レンダリング処理をプロセスプールに投入します。
+    未完了の投入数がRENDER_QUEUE_LIMITに達している場合は、空きが出るまで待機します。
+    ワーカープロセスが異常終了(OOMなど)してプールが壊れている場合は、プールを作り直して投入し直します。
+    異常終了時に処理中だったレンダリングはBrokenProcessPoolで失敗します (そのリクエストのみ失敗し、以降のリクエストは新しいプールで処理します)。
+    """
+    _render_queue_slots.acquire()
+    try:
+        pool = get_render_pool()
+        try:
+            future = pool.submit(function, *args)
+        except BrokenProcessPool:
+            reset_render_pool(pool)
+            pool = get_render_pool()
+            future = pool.submit(function, *args)
+    except Exception:
+        _render_queue_slots.release()
+        raise
+
+    def on_done(done_future):
+        _render_queue_slots.release()
+        if not done_future.cancelled() and isinstance(done_future.exception(), BrokenProcessPool):
+            reset_render_pool(pool)
+
+    future.add_done_callback(on_done)
+    return future
+
+
+def render_as_completed(function, task_args):
+    """
+    task_argsの引数ごとにレンダリング処理をプロセスプールに投入し、終わったものから順に結果を返すジェネレーターです。
+    未完了の投入はRENDER_QUEUE_LIMIT件までとし、結果を返して(呼び出し元がアップロードして)から次を投入するため、
+    全ページ(タイル)の投入を待たずに処理を始められ、メモリ上に保持する結果も同時に投入した分だけになります。
+    途中で例外が発生した場合は、まだ開始していないレンダリングを取り消します。
+    """
+    task_args = iter(task_args)
+    pending = set()
+    try:
+        while True:
+            for args in itertools.islice(task_args, RENDER_QUEUE_LIMIT - len(pending)):
+                pending.add(submit_render(function, *args))
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def warm_up_render_pool():
+    """起動時にワーカープロセスを全て立ち上げ、レンダラーを初期化しておきます"""
+    futures = [get_render_pool().submit(os.getpid) for _ in range(RENDER_POOL_SIZE)]
+    worker_pids = {future.result() for future in futures}
+    logger.info(f"Render pool is warm: {len(worker_pids)} worker processes")
+
+
+@contextmanager
+def open_pdf_source(input_blob):
+    """
+    GCS上のPDFを一時ディレクトリに直接ダウンロードし、変換用のソースとしてファイルパスを返します。
+    プロセスプールのワーカーにはPDFのバイト列ではなくこのパスを渡し、投入ごとにPDFがpickleされてコピーが積み上がらないようにします。
+    (Cloud Runの一時ディレクトリはメモリ上にあるため、バイト列をメモリに保持したまま書き出すことはしません)
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        input_local_path = os.path.join(tmp_dir, os.path.basename(input_blob.name))
+        input_blob.download_to_filename(input_local_path)
+        logger.info(f"Downloaded GCS file {input_blob.name} to {input_local_path} ({input_blob.size} bytes)")
+        yield input_local_path
+
+
+def run_poppler(command, pdf_source, trailing_args=()):
+    """
+    popplerのコマンドを実行し、標準出力のバイト列を返します。
+    trailing_argsはPDFファイル指定の後ろに付ける引数です (pdftotextの出力先 '-' など)。
+    """
+    completed = subprocess.run(command + [pdf_source, *trailing_args], capture_output=True)
+
+    if completed.returncode != 0:
+        raise RuntimeError(f"{command[0]} failed: {completed.stderr.decode('utf-8', errors='replace').strip()}")
+    return completed.stdout
+
+
+def get_page_count(pdf_source):
+    """pdfinfoでPDFのページ数を取得します"""
+    output = run_poppler(['pdfinfo'], pdf_source).decode('utf-8', errors='replace')
+    for line in output.splitlines():
+        if line.startswith('Pages:'):
+            return int(line.split(':', 1)[1])
+    raise RuntimeError("Failed to read page count from pdfinfo output")
+
+
+def is_passthrough_profile(profile):
+    """pdftoppmの出力をそのまま使えるプロファイル(リサイズ不要のPNG)かどうかを判定します"""
+    return profile["format"] == "PNG" and not profile["max_width"] and not profile["max_height"]
+
+
+def encode_profile_image(image, render_dpi, profile):
+    """
+    レンダリング済みの画像からプロファイルに合わせて縮小・グレースケール化・エンコードしたバイト列を返します。
+    """
+    if profile["grayscale"] and image.mode != 'L':
+        image = image.convert('L')
+
+    scale = profile["dpi"] / render_dpi
+    if profile["max_width"]:
+        scale = min(scale, profile["max_width"] / image.width)
+    if profile["max_height"]:
+        scale = min(scale, profile["max_height"] / image.height)
+
+    if scale < 1:
+        target_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+
+    buffer = io.BytesIO()
+    if profile["format"] == "PNG":
+        image.save(buffer, 'PNG')
+    elif profile["format"] == "WEBP":
+        image.save(buffer, 'WEBP', quality=profile["quality"], method=4)
+    else:
+        image.save(buffer, 'JPEG', quality=profile["quality"], optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def render_profiles_with_poppler(pdf_source, page_number, profile_names, render_dpi, grayscale_only):
+    """
+    pdftoppmでページをレンダリングし、プロファイルごとのエンコード済みバイト列を返します。
+    リサイズ不要のPNGプロファイル1つだけの場合は、pdftoppmのPNG出力をそのまま使用します。
+    """
+    profiles = [RENDER_PROFILES[name] for name in profile_names]
+    command = ['pdftoppm', '-singlefile', '-r', str(render_dpi), '-f', str(page_number), '-l', str(page_number)]
+    if grayscale_only:
+        command.append('-gray')
+
+    if len(profiles) == 1 and is_passthrough_profile(profiles[0]):
+        return [{"profile": profile_names[0], "data": run_poppler(command + ['-png'], pdf_source)}]
+
+    # PPM(非圧縮)で受け取り、PNGの圧縮・展開を1回分省きます
+    image = Image.open(io.BytesIO(run_poppler(command, pdf_source)))
+    image.load()
+    return [
+        {"profile": name, "data": encode_profile_image(image, render_dpi, profile)}
+        for name, profile in zip(profile_names, profiles)
+    ]
+
+
+def render_profiles_with_pdfium(pdf_source, page_number, profile_names, render_dpi, grayscale_only):
+    """
+    PDFiumでワーカープロセス内で直接ページをレンダリングし、プロファイルごとのエンコード済みバイト列を返します。
+    PDFiumはスレッドセーフではないため、必ずプロセスプールのワーカーから呼び出します。
+    """
+    document = pdfium.PdfDocument(pdf_source)
+    try:
+        page = document[page_number - 1]
+        try:
+            bitmap = page.render(scale=render_dpi / 72, grayscale=grayscale_only)
+            try:
+                # ビットマップを解放する前に全プロファイルのエンコードを済ませます
+                image = bitmap.to_pil()
+                return [
+                    {"profile": name, "data": encode_profile_image(image, render_dpi, RENDER_PROFILES[name])}
+                    for name in profile_names
+                ]
+            finally:
+                bitmap.close()
+        finally:
+            page.close()
+    finally:
+        document.close()
+
+
+def render_page(pdf_source, page_number, profile_names):
+    """
+    PDFの指定ページを一度だけレンダリングし、指定された全プロファイルの画像を生成します。
+    レンダリングは要求されたプロファイルの最大DPIで行い、各プロファイルはそこから縮小して作成します。
+    プロセスプールのワーカーで実行し、レンダリング方式はRENDER_BACKENDで切り替えます。
+    """
+    started_at = time.perf_counter()
+    render_dpi = max(RENDER_PROFILES[name]["dpi"] for name in profile_names)
+    grayscale_only = all(RENDER_PROFILES[name]["grayscale"] for name in profile_names)
+
+    if RENDER_BACKEND == "pdfium":
+        outputs = render_profiles_with_pdfium(pdf_source, page_number, profile_names, render_dpi, grayscale_only)
+    else:
+        outputs = render_profiles_with_poppler(pdf_source, page_number, profile_names, render_dpi, grayscale_only)
+
+    if not all(output["data"] for output in outputs):
+        raise RuntimeError(f"Failed to convert page {page_number} to image")
+
+    return {
+        "page": page_number,
+        "outputs": outputs,
+        "render_ms": round((time.perf_counter() - started_at) * 1000, 1)
+    }
+
+
+def compute_page_hash(image):
+    """
+    レンダリング済みのページ画像を二値化し、ページ全体のハッシュとセルごとのハッシュを計算します。
+    セルは左上から行優先で並べます。
+    """
+    binary = image.convert('L').point(lambda value: 255 if value >= PAGE_HASH_BINARIZE_THRESHOLD else 0, mode='1')
+    cell_px = PAGE_HASH_DPI * PAGE_HASH_CELL_PT // 72
+    columns = math.ceil(binary.width / cell_px)
+    rows = math.ceil(binary.height / cell_px)
+
+    cells = []
+    for row in range(rows):
+        for col in range(columns):
+            box = (col * cell_px, row * cell_px, min((col + 1) * cell_px, binary.width), min((row + 1) * cell_px, binary.height))
+            cells.append(hashlib.blake2b(binary.crop(box).tobytes(), digest_size=8).hexdigest())
+
+    return {
+        "columns": columns,
+        "rows": rows,
+        "page_hash": hashlib.blake2b(binary.tobytes(), digest_size=16).hexdigest(),
+        "cells": cells
+    }
+
+
+def hash_page(pdf_source, page_number):
+    """
+    ページをPAGE_HASH_DPIのグレースケールでレンダリングし、ページハッシュを返します。
+    プロセスプールのワーカーで実行し、レンダリング方式はRENDER_BACKENDで切り替えます。
+    """
+    if RENDER_BACKEND == "pdfium":
+        document = pdfium.PdfDocument(pdf_source)
+        try:
+            page = document[page_number - 1]
+            try:
+                bitmap = page.render(scale=PAGE_HASH_DPI / 72, grayscale=True)
+                try:
+                    page_hash = compute_page_hash(bitmap.to_pil())
+                finally:
+                    bitmap.close()
+            finally:
+                page.close()
+        finally:
+            document.close()
+    else:
+        command = ['pdftoppm', '-singlefile', '-gray', '-r', str(PAGE_HASH_DPI), '-f', str(page_number), '-l', str(page_number)]
+        page_hash = compute_page_hash(Image.open(io.BytesIO(run_poppler(command, pdf_source))))
+
+    return {"page": page_number, **page_hash}
+
+
+def upload_image(bucket, output_gcs_path, image_bytes, content_type):
+    """画像のバイト列をメモリ上のバッファから直接GCSにアップロードし、オブジェクトの世代(generation)を返します"""
+    blob = bucket.blob(output_gcs_path)
+    blob.upload_from_file(io.BytesIO(image_bytes), size=len(image_bytes), content_type=content_type)
+    return blob.generation
+
+
+def upload_rendered_page(bucket, result, output_path_for):
+    """
+    render_pageの結果をプロファイルごとにGCSへアップロードし、マニフェストのエントリを返します。
+    """
+    entries = []
+    for output in result["outputs"]:
+        image_format = IMAGE_FORMATS[RENDER_PROFILES[output["profile"]]["format"]]
+        output_gcs_path = output_path_for(result["page"], output["profile"])
+
+        upload_started_at = time.perf_counter()
+        generation = upload_image(bucket, output_gcs_path, output["data"], image_format["content_type"])
+        upload_ms = round((time.perf_counter() - upload_started_at) * 1000, 1)
+        logger.info(f"Uploaded page {result['page']} ({output['profile']}) to GCS {output_gcs_path} (render={result['render_ms']}ms, upload={upload_ms}ms)")
+
+        entries.append({
+            "page": result["page"],
+            "profile": output["profile"],
+            "output_gcs_path": output_gcs_path,
+            "generation": generation,
+            "bytes": len(output["data"]),
+            "render_ms": result["render_ms"],
+            "upload_ms": upload_ms
+        })
+    return entries
+
+
+def build_output_path(output_gcs_path, page_number=None, profile_name=None):
+    """
+    出力パスからページ・プロファイルごとの出力パスを組み立てます。
+    例: output/preview.png -> output/preview_page001.png / output/preview_page001_thumbnail.webp
+    """
+    root, ext = os.path.splitext(output_gcs_path)
+    if page_number is not None:
+        root = f"{root}_page{page_number:03d}"
+    if profile_name is not None:
+        root = f"{root}_{profile_name}"
+        ext = IMAGE_FORMATS[RENDER_PROFILES[profile_name]["format"]]["extension"]
+    return f"{root}{ext or '.png'}"
+
+
+def resolve_page_range(pdf_source, request_data):
+    """
+    リクエストの firstPage / lastPage とPDFのページ数から変換対象のページ範囲を決定します。
+    """
+    page_count = get_page_count(pdf_source)
+    first_page = int(request_data.get('firstPage') or 1)
+    last_page = int(request_data.get('lastPage') or page_count)
+
+    if first_page < 1 or last_page > page_count or first_page > last_page:
+        raise ValueError(f"Invalid page range: {first_page}-{last_page} (document has {page_count} pages)")
+    return first_page, last_page
+
+
+def convert_pages_in_parallel(bucket, pdf_path, first_page, last_page, profile_names, output_path_for, on_progress=None):
+    """
+    指定範囲のページをプロセスプールで並列に変換し、変換が終わったページから順にGCSへアップロードします。
+    pdf_pathにはopen_pdf_sourceでダウンロードしたPDFのパスを指定します。
+    ページ・プロファイルごとのGCSパスと処理時間をまとめたマニフェストを返します。
+    on_progressを指定した場合は、ページのアップロードが終わるたびに進捗を通知します。
+    """
+    pages_total = last_page - first_page + 1
+    results = render_as_completed(render_page, (
+        (pdf_path, page_number, profile_names)
+        for page_number in range(first_page, last_page + 1)
+    ))
+
+    manifest = []
+    for pages_done, result in enumerate(results, start=1):
+        manifest.extend(upload_rendered_page(bucket, result, output_path_for))
+        if on_progress:
+            on_progress({
+                "pagesDone": pages_done,
+                "pagesTotal": pages_total,
+                "bytes": sum(entry["bytes"] for entry in manifest)
+            })
+
+    return sorted(manifest, key=lambda entry: (entry["page"], profile_names.index(entry["profile"])))
+
+
+def get_page_size_points(pdf_source, page_number):
+    """
+    pdfinfoで指定ページのサイズ(pt)を取得します。ページの回転を考慮した表示上の幅・高さを返します。
+    """
+    output = run_poppler(['pdfinfo', '-f', str(page_number), '-l', str(page_number)], pdf_source).decode('utf-8', errors='replace')
+
+    size = None
+    rotation = 0
+    for line in output.splitlines():
+        size_match = re.match(r'Page\s+\d+\s+size:\s+([\d.]+) x ([\d.]+)', line)
+        if size_match:
+            size = (float(size_match.group(1)), float(size_match.group(2)))
+        rotation_match = re.match(r'Page\s+\d+\s+rot:\s+(\d+)', line)
+        if rotation_match:
+            rotation = int(rotation_match.group(1))
+
+    if size is None:
+        raise ValueError(f"Page {page_number} does not exist in the document")
+    if rotation % 180 == 90:
+        return size[1], size[0]
+    return size
+
+
+def plan_tile_levels(width_pt, height_pt, dpi, tile_size, with_pyramid):
+    """
+    タイル分割のレベル構成を計算します。
+    with_pyramidの場合はDPIを半分ずつ下げ、ページ全体が1タイルに収まるまでレベルを追加します。
+    レベル番号はDeep Zoomと同じく、最大解像度を ceil(log2(最大辺)) とし、1段下がるごとに1ずつ減らします。
+    """
+    levels = []
+    level_dpi = dpi
+    while True:
+        width = math.ceil(width_pt * level_dpi / 72)
+        height = math.ceil(height_pt * level_dpi / 72)
+        levels.append({
+            "dpi": round(level_dpi, 3),
+            "width": width,
+            "height": height,
+            "columns": math.ceil(width / tile_size),
+            "rows": math.ceil(height / tile_size)
+        })
+        if not with_pyramid or (width <= tile_size and height <= tile_size):
+            break
+        level_dpi /= 2
+
+    max_level = math.ceil(math.log2(max(levels[0]["width"], levels[0]["height"])))
+    for index, level in enumerate(levels):
+        level["level"] = max_level - index
+    return levels
+
+
+def render_tile(pdf_source, page_number, level, column, row, tile_size):
+    """
+    ページの1タイル分の領域だけをpdftoppmでPNGに変換します。
+    pdftoppmは指定領域のみをラスタライズするため、メモリ使用量はタイルサイズに比例します。
+    """
+    started_at = time.perf_counter()
+    x = column * tile_size
+    y = row * tile_size
+    width = min(tile_size, level["width"] - x)
+    height = min(tile_size, level["height"] - y)
+
+    png_bytes = run_poppler(
+        ['pdftoppm', '-png', '-singlefile', '-r', str(level["dpi"]),
+         '-f', str(page_number), '-l', str(page_number),
+         '-x', str(x), '-y', str(y), '-W', str(width), '-H', str(height)],
+        pdf_source
+    )
+    if not png_bytes:
+        raise RuntimeError(f"Failed to render tile {column}_{row} at level {level['level']}")
+
+    return {
+        "level": level["level"],
+        "column": column,
+        "row": row,
+        "png_bytes": png_bytes,
+        "render_ms": round((time.perf_counter() - started_at) * 1000, 1)
+    }
+
+
+def build_tiles_prefix(output_gcs_path, page_number):
+    """
+    タイルの保存先プレフィックスを組み立てます。
+    例: output/preview.png -> output/preview_page001_tiles
+    """
+    root, _ = os.path.splitext(output_gcs_path)
+    return f"{root}_page{page_number:03d}_tiles"
+
+
+def convert_page_to_tiles(bucket, pdf_path, page_number, output_gcs_path, dpi, tile_size, with_pyramid, on_progress=None):
+    """
+    指定ページをタイルに分割してプロセスプールで並列にレンダリングし、完成したタイルから順にGCSへアップロードします。
+    タイルは {prefix}/{level}/{column}_{row}.png に保存し、レベル構成を manifest.json として保存します。
+    on_progressを指定した場合は、タイルのアップロードが終わるたびに進捗を通知します。
+    """
+    if dpi <= 0 or tile_size <= 0:
+        raise ValueError(f"Invalid tile settings: dpi={dpi}, tileSize={tile_size}")
+
+    started_at = time.perf_counter()
+    width_pt, height_pt = get_page_size_points(pdf_path, page_number)
+    levels = plan_tile_levels(width_pt, height_pt, dpi, tile_size, with_pyramid)
+    tiles_prefix = build_tiles_prefix(output_gcs_path, page_number)
+
+    tile_count = 0
+    total_bytes = 0
+    tiles_total = sum(level["rows"] * level["columns"] for level in levels)
+    tiles = render_as_completed(render_tile, (
+        (pdf_path, page_number, level, column, row, tile_size)
+        for level in levels
+        for row in range(level["rows"])
+        for column in range(level["columns"])
+    ))
+
+    for tile in tiles:
+        tile_path = f"{tiles_prefix}/{tile['level']}/{tile['column']}_{tile['row']}.png"
+        upload_image(bucket, tile_path, tile["png_bytes"], 'image/png')
+        tile_count += 1
+        total_bytes += len(tile["png_bytes"])
+        if on_progress:
+            on_progress({"tilesDone": tile_count, "tilesTotal": tiles_total, "bytes": total_bytes})
+
+    manifest = {
+        "page": page_number,
+        "tile_size": tile_size,
+        "format": "png",
+        "width": levels[0]["width"],
+        "height": levels[0]["height"],
+        "max_level": levels[0]["level"],
+        "min_level": levels[-1]["level"],
+        "tile_path_template": f"{tiles_prefix}/{{level}}/{{column}}_{{row}}.png",
+        "levels": levels,
+        "tile_count": tile_count,
+        "bytes": total_bytes,
+        "elapsed_ms": round((time.perf_counter() - started_at) * 1000, 1)
+    }
+    manifest_path = f"{tiles_prefix}/manifest.json"
+    bucket.blob(manifest_path).upload_from_string(json.dumps(manifest), content_type='application/json')
+    logger.info(f"Rendered page {page_number} into {tile_count} tiles ({len(levels)} levels) in {manifest['elapsed_ms']}ms")
+
+    return {**manifest, "manifest_gcs_path": manifest_path}
+
+
+def extract_text_layer(pdf_source):
+    """
+    pdftotext -bbox-layout でPDF全ページのテキストを座標付きで抽出し、
+    ページごとのサイズ・テキスト・行・寸法注記をまとめた辞書を返します。座標の単位はptです。
+    """
+    started_at = time.perf_counter()
+    xhtml = run_poppler(['pdftotext', '-bbox-layout', '-enc', 'UTF-8'], pdf_source, trailing_args=['-'])
+    root = ElementTree.fromstring(xhtml)
+    namespace = {'x': 'http://www.w3.org/1999/xhtml'}
+
+    def bbox_of(element):
+        return [round(float(element.get(key)), 1) for key in ('xMin', 'yMin', 'xMax', 'yMax')]
+
+    pages = []
+    for page_number, page_element in enumerate(root.iterfind('.//x:page', namespace), start=1):
+        lines = []
+        dimensions = []
+        for line_element in page_element.iterfind('.//x:line', namespace):
+            words = [(word.text or '').strip() for word in line_element.iterfind('x:word', namespace)]
+            line_text = ' '.join(word for word in words if word)
+            if not line_text:
+                continue
+            lines.append({"text": line_text, "bbox": bbox_of(line_element)})
+
+            for word_element in line_element.iterfind('x:word', namespace):
+                word_text = (word_element.text or '').strip()
+                if DIMENSION_PATTERN.match(word_text):
+                    dimensions.append({"text": word_text, "bbox": bbox_of(word_element)})
+
+        pages.append({
+            "page": page_number,
+            "width": round(float(page_element.get('width')), 1),
+            "height": round(float(page_element.get('height')), 1),
+            "text": '\n'.join(line["text"] for line in lines),
+            "lines": lines,
+            "dimensions": dimensions
+        })
+
+    return {
+        "page_count": len(pages),
+        "pages": pages,
+        "extract_ms": round((time.perf_counter() - started_at) * 1000, 1)
+    }
+
+
+def build_text_sidecar_path(output_gcs_path):
+    """
+    テキスト抽出結果(JSONサイドカー)の保存先をPNGの出力パスの隣に組み立てます。
+    例: output/preview.png -> output/preview_text.json
+    """
+    root, _ = os.path.splitext(output_gcs_path)
+    return f"{root}_text.json"
+
+
+def upload_text_sidecar(bucket, sidecar_gcs_path, input_gcs_path, text_layer):
+    """テキスト抽出結果をJSONサイドカーとしてGCSにアップロードし、オブジェクトの世代(generation)を返します"""
+    sidecar = {"input_gcs_path": input_gcs_path, **text_layer}
+    sidecar_bytes = json.dumps(sidecar, ensure_ascii=False).encode('utf-8')
+    blob = bucket.blob(sidecar_gcs_path)
+    blob.upload_from_string(sidecar_bytes, content_type='application/json')
+    logger.info(f"Uploaded text sidecar to GCS {sidecar_gcs_path} ({text_layer['page_count']} pages, {len(sidecar_bytes)} bytes, {text_layer['extract_ms']}ms)")
+    return blob.generation
+
+
+def build_hash_sidecar_path(output_gcs_path):
+    """
+    ページハッシュ(JSONサイドカー)の保存先をPNGの出力パスの隣に組み立てます。
+    例: output/preview.png -> output/preview_phash.json
+    """
+    root, _ = os.path.splitext(output_gcs_path)
+    return f"{root}_phash.json"
+
+
+def compute_page_hashes(pdf_path):
+    """PDFの全ページのページハッシュをプロセスプールで並列に計算し、ページ順のリストで返します (pdf_pathは書き出し済みのPDFのパス)"""
+    started_at = time.perf_counter()
+    pages = sorted(
+        render_as_completed(hash_page, ((pdf_path, page_number) for page_number in range(1, get_page_count(pdf_path) + 1))),
+        key=lambda page: page["page"]
+    )
+    logger.info(f"Computed page hashes for {len(pages)} pages in {round((time.perf_counter() - started_at) * 1000, 1)}ms")
+    return pages
+
+
+def upload_hash_sidecar(bucket, sidecar_gcs_path, input_gcs_path, pages):
+    """全ページのページハッシュをJSONサイドカーとしてGCSにアップロードし、オブジェクトの世代(generation)を返します"""
+    sidecar = {
+        "input_gcs_path": input_gcs_path,
+        "hash_version": PAGE_HASH_VERSION,
+        "renderer": RENDER_BACKEND,
+        "cell_pt": PAGE_HASH_CELL_PT,
+        "page_count": len(pages),
+        "pages": pages
+    }
+    sidecar_bytes = json.dumps(sidecar).encode('utf-8')
+    blob = bucket.blob(sidecar_gcs_path)
+    blob.upload_from_string(sidecar_bytes, content_type='application/json')
+    logger.info(f"Uploaded page hash sidecar to GCS {sidecar_gcs_path} ({len(pages)} pages, {len(sidecar_bytes)} bytes)")
+    return blob.generation
+
+
+def build_render_cache_key(input_blob, render_params):
+    """
+    入力PDFの内容ハッシュ(GCSのmd5)と変換パラメータからレンダーキャッシュのキーを計算します。
+    出力を左右するレンダリング方式・プロファイルの定義(DPI・形式など)・ページハッシュの設定もキーに含め、
+    これらを変更した場合は以前の変換結果を使わないようにします。
+    キャッシュはバケット内の全組織で共有するため、衝突し得る32bitのcrc32cだけを内容の識別には使いません。
+    md5が無いオブジェクト(コンポジットオブジェクトなど)は、crc32c・サイズに加えてオブジェクト名と世代(generation)を
+    キーに含め、同じオブジェクトの同じ世代の間でのみキャッシュを使います。
+    内容を識別できない場合はNoneを返します (キャッシュを使用しません)。
+    """
+    if input_blob.md5_hash:
+        content = {"md5": input_blob.md5_hash}
+    elif input_blob.crc32c and input_blob.size is not None and input_blob.generation:
+        content = {
+            "crc32c": input_blob.crc32c,
+            "size": input_blob.size,
+            "name": input_blob.name,
+            "generation": input_blob.generation
+        }
+    else:
+        return None
+
+    canonical = json.dumps({
+        "version": RENDER_CACHE_VERSION,
+        "content": content,
+        "renderer": RENDER_BACKEND,
+        "profiles": {name: RENDER_PROFILES[name] for name in render_params["profiles"]},
+        "page_hash": [PAGE_HASH_VERSION, PAGE_HASH_DPI, PAGE_HASH_CELL_PT, PAGE_HASH_BINARIZE_THRESHOLD] if render_params["perceptualHash"] else None,
+        "params": render_params
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_render_cache_index_blob(bucket, cache_key):
+    """レンダーキャッシュのインデックスオブジェクトを取得します"""
+    return bucket.blob(f"{RENDER_CACHE_PREFIX}/{cache_key}.json")
+
+
+def copy_cached_object(bucket, source_path, source_generation, target_path):
+    """
+    キャッシュ済みのオブジェクトを今回の出力パスにGCS内でコピーし、コピー先の世代(generation)を返します。
+    コピー元はキャッシュ登録時の世代を指定してコピーするため、その後に別の内容で上書き・削除されている場合は
+    Noneを返します (キャッシュミスとして扱います)。
+    """
+    if source_generation is None:
+        return None
+    try:
+        if source_path == target_path:
+            blob = bucket.get_blob(source_path)
+            if blob is None or blob.generation != source_generation:
+                logger.warning(f"Cached output has been overwritten: {source_path}")
+                return None
+            return blob.generation
+        return bucket.copy_blob(bucket.blob(source_path), bucket, target_path, source_generation=source_generation).generation
+    except NotFound:
+        logger.warning(f"Cached output no longer exists or has been overwritten: {source_path} (generation={source_generation})")
+        return None
+
+
+def restore_from_render_cache(bucket, cache_key, output_path_for, sidecar_paths=None):
+    """
+    キャッシュキーに一致する変換済み出力があれば、GCS内のコピーで今回の出力パスに配置し、
+    マニフェストを返します。キャッシュが存在しない、または出力が削除されている場合はNoneを返します。
+    sidecar_pathsには種類ごとのサイドカー(テキスト抽出結果など)のコピー先を指定します。
+    """
+    try:
+        cache_entry = json.loads(get_render_cache_index_blob(bucket, cache_key).download_as_bytes())
+    except NotFound:
+        return None
+
+    manifest = []
+    for cached_page in cache_entry["pages"]:
+        target_path = output_path_for(cached_page["page"], cached_page["profile"])
+        generation = copy_cached_object(bucket, cached_page["output_gcs_path"], cached_page.get("generation"), target_path)
+        if generation is None:
+            return None
+        manifest.append({**cached_page, "output_gcs_path": target_path, "generation": generation, "render_ms": 0, "upload_ms": 0})
+
+    cached_sidecars = cache_entry.get("sidecars", {})
+    for kind, target_path in (sidecar_paths or {}).items():
+        cached_sidecar = cached_sidecars.get(kind)
+        if cached_sidecar is None or copy_cached_object(bucket, cached_sidecar["gcs_path"], cached_sidecar.get("generation"), target_path) is None:
+            return None
+
+    return manifest
+
+
+def save_render_cache_entry(bucket, cache_key, input_gcs_path, manifest, sidecars=None):
+    """
+    変換結果をレンダーキャッシュのインデックスに登録します。
+    出力オブジェクトごとに世代(generation)を記録し、復元時に上書きされていないことを確認します。
+    sidecarsには種類ごとのサイドカーの {"gcs_path": ..., "generation": ...} を指定します。
+    """
+    cache_entry = {
+        "input_gcs_path": input_gcs_path,
+        "created_at": time.time(),
+        "sidecars": sidecars or {},
+        "pages": [
+            {
+                "page": entry["page"],
+                "profile": entry["profile"],
+                "output_gcs_path": entry["output_gcs_path"],
+                "generation": entry["generation"],
+                "bytes": entry["bytes"]
+            }
+            for entry in manifest
+        ]
+    }
+    get_render_cache_index_blob(bucket, cache_key).upload_from_string(
+        json.dumps(cache_entry), content_type='application/json'
+    )
+
+
+def validate_conversion_request(request_data):
+    """
+    変換リクエストの必須フィールド・モード・プロファイルを検証し、エラーメッセージを返します (問題なければNone)。
+    """
+    required_fields = ['bucket_name', 'gcsInputPdfFilePath', 'gcsOutputPreviewPngFilePath']
+    for field in required_fields:
+        if field not in request_data or not request_data[field]:
+            return f"Missing required field: {field}"
+
+    mode = request_data.get('mode', 'firstPage')
+    if mode not in ('firstPage', 'allPages', 'tiles'):
+        return f"Unsupported mode: {mode}"
+
+    unknown_profiles = [name for name in request_data.get('profiles') or [] if name not in RENDER_PROFILES]
+    if unknown_profiles:
+        return f"Unknown render profiles: {unknown_profiles}"
+
+    return None
+
+
+def convert_pdf_to_png(bucket, request_data, on_progress=None):
+    """
+    検証済みの変換リクエストを1件処理し、(レスポンスボディ, HTTPステータスコード) を返します。
+    単体変換・バッチ変換の両エンドポイントと非同期ジョブから使用します。
+    on_progressを指定した場合は、ページ(タイル)ごとの進捗を通知します。
+    """
+    input_gcs_path = request_data['gcsInputPdfFilePath']
+    output_gcs_path = request_data['gcsOutputPreviewPngFilePath']
+    mode = request_data.get('mode', 'firstPage')
+    profile_names = request_data.get('profiles') or [DEFAULT_RENDER_PROFILE]
+
+    logger.info(f"Conversion task: bucket={bucket.name}, input={input_gcs_path}, output={output_gcs_path}, mode={mode}, profiles={profile_names}")
+
+    use_cache = request_data.get('useCache', True)
+    render_params = {
+        "mode": mode,
+        "firstPage": request_data.get('firstPage'),
+        "lastPage": request_data.get('lastPage'),
+        "profiles": profile_names,
+        "extractText": bool(request_data.get('extractText')),
+        "perceptualHash": bool(request_data.get('perceptualHash'))
+    }
+
+    # テキスト抽出・ページハッシュを指定した場合は、PNGの隣にJSONサイドカーを保存します
+    sidecar_paths = {}
+    if request_data.get('extractText'):
+        sidecar_paths["text"] = build_text_sidecar_path(output_gcs_path)
+    if request_data.get('perceptualHash'):
+        sidecar_paths["phash"] = build_hash_sidecar_path(output_gcs_path)
+
+    # profilesを指定しない従来のリクエストでは、出力パスにプロファイル名を付けません
+    has_explicit_profiles = 'profiles' in request_data and bool(request_data['profiles'])
+
+    def output_path_for(page_number, profile_name):
+        return build_output_path(
+            output_gcs_path,
+            page_number if mode == 'allPages' else None,
+            profile_name if has_explicit_profiles else None
+        )
+
+    try:
+        started_at = time.perf_counter()
+
+        # 1. PDFファイルのメタデータを取得 (内容ハッシュをレンダーキャッシュのキーに使います)
+        input_blob = bucket.get_blob(input_gcs_path)
+        if input_blob is None:
+            logger.error(f"Error: Input file not found in GCS: {input_gcs_path}")
+            return {"status": "error", "message": f"Input file not found in GCS: {input_gcs_path}"}, 404
+
+        # 大判図面はタイル単位でレンダリングし、ページ全体を1枚の画像として展開しません
+        if mode == 'tiles':
+            with open_pdf_source(input_blob) as pdf_path:
+                try:
+                    tile_manifest = convert_page_to_tiles(
+                        bucket,
+                        pdf_path,
+                        int(request_data.get('page') or 1),
+                        output_gcs_path,
+                        float(request_data.get('dpi') or DEFAULT_TILE_DPI),
+                        int(request_data.get('tileSize') or DEFAULT_TILE_SIZE),
+                        bool(request_data.get('pyramid', False)),
+                        on_progress
+                    )
+                except ValueError as e:
+                    logger.error(f"Error: {e}")
+                    return {"status": "error", "message": str(e)}, 400
+
+            return {
+                "status": "success",
+                "input_gcs_path": input_gcs_path,
+                "tiles": tile_manifest,
+                "message": f"Page successfully rendered into {tile_manifest['tile_count']} tiles and uploaded to GCS."
+            }, 200
+
+        # 2. 同じ内容・同じパラメータの変換済み出力があればコピーして返します
+        cache_key = build_render_cache_key(input_blob, render_params) if use_cache else None
+        pages = restore_from_render_cache(bucket, cache_key, output_path_for, sidecar_paths) if cache_key else None
+        cache_hit = pages is not None
+        if cache_hit:
+            logger.info(f"Render cache hit: key={cache_key}, input={input_gcs_path}")
+
+        else:
+            with open_pdf_source(input_blob) as pdf_path:
+                # 3. PDFを画像に変換し、メモリから直接GCSにアップロード
+                if mode == 'allPages':
+                    try:
+                        first_page, last_page = resolve_page_range(pdf_path, request_data)
+                    except ValueError as e:
+                        logger.error(f"Error: {e}")
+                        return {"status": "error", "message": str(e)}, 400
+
+                    pages = convert_pages_in_parallel(bucket, pdf_path, first_page, last_page, profile_names, output_path_for, on_progress)
+                else:
+                    result = submit_render(render_page, pdf_path, 1, profile_names).result()
+                    logger.info(f"Converted PDF page 1 to {len(result['outputs'])} images ({result['render_ms']}ms)")
+                    pages = upload_rendered_page(bucket, result, output_path_for)
+                    if on_progress:
+                        on_progress({"pagesDone": 1, "pagesTotal": 1, "bytes": sum(entry["bytes"] for entry in pages)})
+
+                # 4. ダウンロード済みのPDFから、同じパスでテキスト・寸法注記・ページサイズを抽出
+                sidecar_generations = {}
+                if "text" in sidecar_paths:
+                    sidecar_generations["text"] = upload_text_sidecar(bucket, sidecar_paths["text"], input_gcs_path, extract_text_layer(pdf_path))
+
+                # 5. 版の比較用に、ダウンロード済みのPDFから全ページのページハッシュを計算して保存
+                if "phash" in sidecar_paths:
+                    sidecar_generations["phash"] = upload_hash_sidecar(bucket, sidecar_paths["phash"], input_gcs_path, compute_page_hashes(pdf_path))
+
+            if cache_key:
+                save_render_cache_entry(bucket, cache_key, input_gcs_path, pages, {
+                    kind: {"gcs_path": sidecar_paths[kind], "generation": generation}
+                    for kind, generation in sidecar_generations.items()
+                })
+
+        elapsed_ms = round((time.perf_counter() - started_at) * 1000, 1)
+        page_count = len({entry["page"] for entry in pages})
+        logger.info(f"Converted {page_count} pages into {len(pages)} images in {elapsed_ms}ms (cache_hit={cache_hit})")
+
+        if mode == 'allPages':
+            return {
+                "status": "success",
+                "input_gcs_path": input_gcs_path,
+                "page_count": page_count,
+                "pages": pages,
+                "text_sidecar_gcs_path": sidecar_paths.get("text"),
+                "hash_sidecar_gcs_path": sidecar_paths.get("phash"),
+                "cache_hit": cache_hit,
+                "elapsed_ms": elapsed_ms,
+                "message": f"{page_count} pages successfully converted and uploaded to GCS."
+            }, 200
+
+        response_body = {
+            "status": "success",
+            "input_gcs_path": input_gcs_path,
+            "output_gcs_path": pages[0]["output_gcs_path"],
+            "text_sidecar_gcs_path": sidecar_paths.get("text"),
+            "hash_sidecar_gcs_path": sidecar_paths.get("phash"),
+            "cache_hit": cache_hit,
+            "message": "PDF successfully converted to PNG and uploaded to GCS."
+        }
+        if has_explicit_profiles:
+            response_body["outputs"] = pages
+            response_body["message"] = f"PDF successfully converted to {len(pages)} images and uploaded to GCS."
+        return response_body, 200
+
+    except Exception as e:
+        logger.error(f"An error occurred during conversion: {e}")
+        return {
+            "status": "error",
+            "message": f"Conversion failed: {str(e)}"
+        }, 500
+
+
+def build_job_log_entry(log_type, message):
+    """
+    ログドキュメントの logs に追加するエントリを作成します (backendのsaveLogと同じ形式)。
+    配列の要素にはSERVER_TIMESTAMPを使えないため記録した時刻を保存し、同じメッセージが繰り返されても別のエントリとして残るようにします。
+    """
+    return {"type": log_type, "message": message, "timestamp": datetime.now(timezone.utc)}
+
+
+def create_job_progress_reporter(document_ref, started_at):
+    """
+    非同期ジョブの進捗をFirestoreのログドキュメントに書き込むコールバックを作成します。
+    書き込みはJOB_PROGRESS_INTERVAL_SEC間隔に間引き、最後のページ(タイル)の進捗は必ず書き込みます。
+    """
+    last_written_at = 0.0
+
+    def report(progress):
+        nonlocal last_written_at
+        now = time.perf_counter()
+        done = progress.get("pagesDone", progress.get("tilesDone"))
+        total = progress.get("pagesTotal", progress.get("tilesTotal"))
+        if done != total and now - last_written_at < JOB_PROGRESS_INTERVAL_SEC:
+            return
+
+        last_written_at = now
+        try:
+            document_ref.update({
+                "status": "processing",
+                "heartbeatAt": firestore.SERVER_TIMESTAMP,
+                "progress": {**progress, "elapsedMs": round((now - started_at) * 1000, 1)}
+            })
+        except Exception as e:
+            # 進捗の書き込み失敗で変換自体は止めません
+            logger.warning(f"Failed to write job progress to Firestore: {e}")
+
+    return report
+
+
+def run_conversion_job(job_id, bucket, request_data, document_path):
+    """
+    バックグラウンドワーカーで変換ジョブを実行し、進捗と結果をFirestoreのログドキュメントに書き込みます。
+    """
+    started_at = time.perf_counter()
+    document_ref = firestore_client.document(document_path)
+    logger.info(f"Started conversion job {job_id}: document={document_path}")
+
+    try:
+        document_ref.update({
+            "status": "processing",
+            "heartbeatAt": firestore.SERVER_TIMESTAMP,
+            "progress": {"elapsedMs": 0},
+            "logs": firestore.ArrayUnion([build_job_log_entry("info", f"Conversion job {job_id} started")])
+        })
+        response_body, status_code = convert_pdf_to_png(
+            bucket, request_data, on_progress=create_job_progress_reporter(document_ref, started_at)
+        )
+    except Exception as e:
+        logger.error(f"Conversion job {job_id} failed: {e}")
+        response_body, status_code = {"status": "error", "message": f"Conversion failed: {str(e)}"}, 500
+
+    elapsed_ms = round((time.perf_counter() - started_at) * 1000, 1)
+    succeeded = status_code == 200
+    try:
+        document_ref.update({
+            "status": "completed" if succeeded else "failed",
+            "output": {**response_body, "job_id": job_id, "elapsed_ms": elapsed_ms},
+            "logs": firestore.ArrayUnion([build_job_log_entry(
+                "info" if succeeded else "error",
+                f"Conversion job {job_id} {'completed' if succeeded else 'failed'} in {elapsed_ms}ms: {response_body.get('message')}"
+            )])
+        })
+    except Exception as e:
+        logger.error(f"Failed to write job result to Firestore for job {job_id}: {e}")
+
+    logger.info(f"Finished conversion job {job_id}: status_code={status_code}, elapsed={elapsed_ms}ms")
+
+
 @app.route('/convert-pdf-to-png', methods=['POST'])
 def convert_pdf_to_png_endpoint():
     """
@@ -30,78 +1117,232 @@ def convert_pdf_to_png_endpoint():
     {
         "bucket_name": "your-gcs-bucket-name",
         "gcsInputPdfFilePath": "input/path/to/document.pdf",
-        "gcsOutputPreviewPngFilePath": "output/path/to/preview.png"
+        "gcsOutputPreviewPngFilePath": "output/path/to/preview.png",
+        "mode": "allPages",  # 任意: 指定すると複数ページを並列に変換します
+        "firstPage": 1,      # 任意 (allPagesモードのみ)
+        "lastPage": 30,      # 任意 (allPagesモードのみ)
+        "useCache": true,    # 任意: falseの場合はレンダーキャッシュを使用しません
+        "profiles": ["thumbnail", "preview"],  # 任意: RENDER_PROFILESの名前 (1回のレンダリングから全て生成します)
+        "page": 1,           # 任意 (tilesモードのみ)
+        "dpi": 300,          # 任意 (tilesモードのみ)
+        "tileSize": 1024,    # 任意 (tilesモードのみ)
+        "pyramid": true,     # 任意 (tilesモードのみ): 縮小レベルも生成します
+        "extractText": true, # 任意: 全ページのテキスト・寸法注記・ページサイズをJSONサイドカーとして保存します
+        "perceptualHash": true,  # 任意: 版の比較用に全ページのページハッシュをJSONサイドカーとして保存します
+        "async": true,       # 任意: 受け付けてすぐに202を返し、バックグラウンドで変換します
+        "firestoreLogDocumentPath": "organizations/.../logs/{requestId}",  # asyncの場合は必須: 進捗と結果の書き込み先
+        "jobId": "..."       # 任意 (asyncの場合のみ): 省略時は自動採番します
     }
+    allPagesモードでは各ページを output/path/to/preview_page001.png のように保存し、
+    ページごとのGCSパスと処理時間のマニフェストを返します。
+    profilesを指定した場合は output/path/to/preview_thumbnail.webp のようにプロファイル名と形式の拡張子を付けて保存します。
+    tilesモードでは大判図面を一定サイズのタイルに分割してレンダリングし、
+    output/path/to/preview_page001_tiles/ 以下にタイルとマニフェストを保存します。
+    同じ内容のPDFを同じパラメータで変換済みの場合は、再変換せずにGCS内で出力をコピーします。
+    extractTextの場合は output/path/to/preview_text.json にテキスト抽出結果を保存します。
+    perceptualHashの場合は output/path/to/preview_phash.json に全ページのページハッシュを保存します
+    (/convert-pdf-to-png/diff で2つの版を比較できます)。
+    asyncの場合はジョブIDを返し、進捗(pagesDone, bytes, elapsedMs)と結果をfirestoreLogDocumentPathに書き込みます。
     """
     logger.info(f"Received request: {request.url} {request.method}")
 
     request_data = request.get_json()
-    required_fields = ['bucket_name', 'gcsInputPdfFilePath', 'gcsOutputPreviewPngFilePath']
     
     if not request_data:
         logger.error("Error: Request body is empty or not valid JSON.")
         return jsonify({"status": "error", "message": "Request body must be valid JSON"}), 400
-        
+
+    validation_error = validate_conversion_request(request_data)
+    if validation_error:
+        logger.error(f"Error: {validation_error}")
+        return jsonify({"status": "error", "message": validation_error}), 400
+
+    bucket = storage_client.bucket(request_data['bucket_name'])
+    logger.info(f"Connected to GCS bucket: {request_data['bucket_name']}")
+
+    if request_data.get('async'):
+        document_path = request_data.get('firestoreLogDocumentPath')
+        if not document_path:
+            logger.error("Error: Missing required field for async mode: firestoreLogDocumentPath")
+            return jsonify({"status": "error", "message": "Missing required field for async mode: firestoreLogDocumentPath"}), 400
+
+        job_id = request_data.get('jobId') or str(uuid.uuid4())
+        # 202を返す前に受付を記録し、ワーカーの空き待ちの間に失われたジョブも heartbeatAt から検出できるようにします
+        try:
+            firestore_client.document(document_path).update({
+                "status": "processing",
+                "heartbeatAt": firestore.SERVER_TIMESTAMP,
+                "progress": {"elapsedMs": 0}
+            })
+        except Exception as e:
+            logger.error(f"Error: Failed to record conversion job {job_id} in Firestore: {e}")
+            return jsonify({"status": "error", "message": f"Failed to record conversion job in Firestore: {str(e)}"}), 500
+
+        _job_executor.submit(run_conversion_job, job_id, bucket, request_data, document_path)
+        logger.info(f"Accepted conversion job {job_id}")
+
+        return jsonify({
+            "status": "accepted",
+            "job_id": job_id,
+            "firestore_log_document_path": document_path,
+            "message": "Conversion job accepted. Progress will be written to the Firestore log document."
+        }), 202
+
+    response_body, status_code = convert_pdf_to_png(bucket, request_data)
+    return jsonify(response_body), status_code
+
+
+@app.route('/convert-pdf-to-png/batch', methods=['POST'])
+def convert_pdf_to_png_batch_endpoint():
+    """
+    複数のPDFの変換をまとめて受け付け、同時実行数を制限しながら並列に処理します。
+    リクエストボディは以下のJSON形式を期待します:
+    {
+        "bucket_name": "your-gcs-bucket-name",
+        "defaults": {"profiles": ["thumbnail"]},  # 任意: 全アイテム共通の変換オプション
+        "items": [
+            {
+                "gcsInputPdfFilePath": "input/path/to/document1.pdf",
+                "gcsOutputPreviewPngFilePath": "output/path/to/preview1.png"
+            },
+            ...
+        ]
+    }
+    各アイテムには /convert-pdf-to-png と同じオプションを指定でき、defaultsより優先されます。
+    GCSのバケットハンドルは全アイテムで共有し、アイテムごとの結果を results として返します。
+    1リクエストの件数はMAX_BATCH_ITEMSまでです。BATCH_TIME_BUDGET_SECを過ぎても開始できなかったアイテムは
+    status: skipped (status_code: 503) として返すため、それらのアイテムだけを再送してください。
+    """
+    logger.info(f"Received request: {request.url} {request.method}")
+
+    request_data = request.get_json()
+
+    if not request_data:
+        logger.error("Error: Request body is empty or not valid JSON.")
+        return jsonify({"status": "error", "message": "Request body must be valid JSON"}), 400
+
+    bucket_name = request_data.get('bucket_name')
+    items = request_data.get('items')
+    if not bucket_name:
+        logger.error("Error: Missing required field: bucket_name")
+        return jsonify({"status": "error", "message": "Missing required field: bucket_name"}), 400
+    if not isinstance(items, list) or not items:
+        logger.error("Error: items must be a non-empty list")
+        return jsonify({"status": "error", "message": "items must be a non-empty list"}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        logger.error(f"Error: Too many items: {len(items)} (max {MAX_BATCH_ITEMS})")
+        return jsonify({"status": "error", "message": f"Too many items: {len(items)} (max {MAX_BATCH_ITEMS})"}), 400
+    defaults = request_data.get('defaults') or {}
+    if not isinstance(defaults, dict):
+        logger.error("Error: defaults must be an object")
+        return jsonify({"status": "error", "message": "defaults must be an object"}), 400
+
+    started_at = time.perf_counter()
+    bucket = storage_client.bucket(bucket_name)
+    logger.info(f"Batch conversion task: bucket={bucket_name}, items={len(items)}, concurrency={BATCH_CONCURRENCY}")
+
+    def process_item(item):
+        if time.perf_counter() - started_at > BATCH_TIME_BUDGET_SEC:
+            return {"status": "skipped", "message": f"Not started within the batch time budget ({BATCH_TIME_BUDGET_SEC}s). Please resubmit this item."}, 503
+        if not isinstance(item, dict):
+            return {"status": "error", "message": "Each item must be an object"}, 400
+        item_request = {**defaults, **item, "bucket_name": bucket_name}
+        validation_error = validate_conversion_request(item_request)
+        if validation_error:
+            return {"status": "error", "message": validation_error}, 400
+        return convert_pdf_to_png(bucket, item_request)
+
+    results = [None] * len(items)
+    with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(items))) as executor:
+        futures = {executor.submit(process_item, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            index = futures[future]
+            response_body, status_code = future.result()
+            results[index] = {"index": index, "status_code": status_code, **response_body}
+
+    succeeded = sum(1 for result in results if result["status"] == "success")
+    skipped = sum(1 for result in results if result["status"] == "skipped")
+    failed = len(results) - succeeded - skipped
+    elapsed_ms = round((time.perf_counter() - started_at) * 1000, 1)
+    logger.info(f"Batch conversion finished: succeeded={succeeded}, failed={failed}, skipped={skipped}, elapsed={elapsed_ms}ms")
+
+    return jsonify({
+        "status": "success" if succeeded == len(results) else ("partial" if succeeded else "error"),
+        "succeeded": succeeded,
+        "failed": failed,
+        "skipped": skipped,
+        "results": results,
+        "elapsed_ms": elapsed_ms,
+        "message": f"{succeeded} of {len(results)} PDFs successfully converted."
+    }), 200
+
+
+
+@app.route('/convert-pdf-to-png/diff', methods=['POST'])
+def convert_pdf_to_png_diff_endpoint():
+    """
+    perceptualHashで保存した2つの版のページハッシュを比較し、変更のあったページを返します。
+    リクエストボディは以下のJSON形式を期待します:
+    {
+        "bucket_name": "your-gcs-bucket-name",
+        "baseHashesGcsPath": "output/path/to/revA_phash.json",   # 旧版
+        "targetHashesGcsPath": "output/path/to/revB_phash.json"  # 新版
+    }
+    PDFの再レンダリングは行わず、保存済みのサイドカーのみを比較します。
+    unchanged_pages / moved_pages の新版ページは、base_pageの旧版の解析結果を再利用できます。
+    """
+    logger.info(f"Received request: {request.url} {request.method}")
+
+    request_data = request.get_json()
+
+    if not request_data:
+        logger.error("Error: Request body is empty or not valid JSON.")
+        return jsonify({"status": "error", "message": "Request body must be valid JSON"}), 400
+
+    required_fields = ['bucket_name', 'baseHashesGcsPath', 'targetHashesGcsPath']
     for field in required_fields:
         if field not in request_data or not request_data[field]:
             logger.error(f"Error: Missing required field: {field}")
             return jsonify({"status": "error", "message": f"Missing required field: {field}"}), 400
 
-    bucket_name = request_data['bucket_name']
-    input_gcs_path = request_data['gcsInputPdfFilePath']
-    output_gcs_path = request_data['gcsOutputPreviewPngFilePath']
-
-    logger.info(f"Conversion task: bucket={bucket_name}, input={input_gcs_path}, output={output_gcs_path}")
+    bucket = storage_client.bucket(request_data['bucket_name'])
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        logger.info(f"Created temporary directory: {tmp_dir}")
-        
-        input_local_path = None
-        output_local_path = None
-        
+    sidecars = {}
+    for field in ('baseHashesGcsPath', 'targetHashesGcsPath'):
         try:
-            bucket = storage_client.bucket(bucket_name)
-            logger.info(f"Connected to GCS bucket: {bucket_name}")
-
-            # 1. PDFファイルをGCSから一時ディレクトリにダウンロード
-            input_blob = bucket.blob(input_gcs_path)
-            if not input_blob.exists():
-                logger.error(f"Error: Input file not found in GCS: {input_gcs_path}")
-                return jsonify({"status": "error", "message": f"Input file not found in GCS: {input_gcs_path}"}), 404
-
-            input_filename = os.path.basename(input_gcs_path)
-            input_local_path = os.path.join(tmp_dir, input_filename)
-            input_blob.download_to_filename(input_local_path)
-            logger.info(f"Downloaded GCS file {input_gcs_path} to {input_local_path}")
-
-            # 2. PDFの1ページ目をPNGに変換
-            output_filename = os.path.basename(output_gcs_path)
-            output_local_path = os.path.join(tmp_dir, output_filename)
-            
-            # PDFの1ページ目をPNGに変換
-            images = convert_from_path(input_local_path, first_page=1, last_page=1)
-            if not images:
-                raise RuntimeError("Failed to convert PDF to PNG")
-            
-            # 変換された画像を保存
-            images[0].save(output_local_path, 'PNG')
-            logger.info(f"Converted PDF to PNG: {output_local_path}")
-
-            # 3. 変換されたPNGファイルをGCSにアップロード
-            output_blob = bucket.blob(output_gcs_path)
-            output_blob.upload_from_filename(output_local_path)
-            logger.info(f"Uploaded converted PNG {output_local_path} to GCS {output_gcs_path}")
-
-            return jsonify({
-                "status": "success",
-                "input_gcs_path": input_gcs_path,
-                "output_gcs_path": output_gcs_path,
-                "message": "PDF successfully converted to PNG and uploaded to GCS."
-            }), 200
+            sidecars[field] = json.loads(bucket.blob(request_data[field]).download_as_bytes())
+        except NotFound:
+            logger.error(f"Error: Page hash sidecar not found in GCS: {request_data[field]}")
+            return jsonify({"status": "error", "message": f"Page hash sidecar not found in GCS: {request_data[field]}"}), 404
 
-        except Exception as e:
-            logger.error(f"An error occurred during conversion: {e}")
-            return jsonify({
-                "status": "error",
-                "message": f"Conversion failed: {str(e)}"
-            }), 500
\ No newline at end of file
+    base_sidecar = sidecars['baseHashesGcsPath']
+    target_sidecar = sidecars['targetHashesGcsPath']
+    # 異なる条件で計算したハッシュ同士は比較できないため、再変換を促します
+    for key in ('hash_version', 'renderer', 'cell_pt'):
+        if base_sidecar.get(key) != target_sidecar.get(key):
+            message = f"Page hashes are not comparable ({key}: {base_sidecar.get(key)} != {target_sidecar.get(key)}). Please re-convert both PDFs with perceptualHash."
+            logger.error(f"Error: {message}")
+            return jsonify({"status": "error", "message": message}), 400
+
+    pages = diff_page_hashes(base_sidecar["pages"], target_sidecar["pages"], target_sidecar["cell_pt"])
+
+    def pages_with_status(*statuses, key="page"):
+        return [page[key] for page in pages if page["status"] in statuses]
+
+    changed_pages = pages_with_status("changed", "added")
+    logger.info(f"Diffed page hashes {request_data['baseHashesGcsPath']} -> {request_data['targetHashesGcsPath']}: {len(changed_pages)} of {target_sidecar['page_count']} pages changed")
+
+    return jsonify({
+        "status": "success",
+        "base_hashes_gcs_path": request_data['baseHashesGcsPath'],
+        "target_hashes_gcs_path": request_data['targetHashesGcsPath'],
+        "changed_pages": changed_pages,
+        "unchanged_pages": pages_with_status("unchanged"),
+        "moved_pages": pages_with_status("moved"),
+        "removed_base_pages": pages_with_status("removed", key="base_page"),
+        "pages": pages,
+        "message": f"{len(changed_pages)} of {target_sidecar['page_count']} pages changed."
+    }), 200
+
+# ワーカープロセスを起動時に立ち上げておき、最初のリクエストでプロセス起動・レンダラー初期化のコストを払わないようにします
+warm_up_render_pool()
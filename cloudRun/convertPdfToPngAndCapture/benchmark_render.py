@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+PDF→PNG変換のレンダリング方式を比較するベンチマークスクリプト
+
+比較する方式:
+- cold:   リクエストごとにpdftoppmのサブプロセスを起動 (従来方式)
+- pooled: 常駐ワーカープロセス内でPDFiumを使ってレンダリング (app.py の RENDER_BACKEND=pdfium)
+
+どちらもPDFのバイト列を渡してPNGのバイト列を受け取るまでを1回のレイテンシとして計測し、
+p50 / p99 / 平均 を出力します。
+
+使用方法:
+    python benchmark_render.py path/to/corpus_dir --dpi 200 --iterations 5 --workers 4
+
+corpus_dir 直下の *.pdf を固定のコーパスとして、全ページを順番にレンダリングします。
+GCSやFirestoreには接続しません (poppler-utils と pypdfium2 が必要です)。
+"""
+
+import os
+import io
+import sys
+import glob
+import math
+import time
+import argparse
+import statistics
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import pypdfium2 as pdfium
+
+
+def percentile(values, ratio):
+    """最近傍順位法でパーセンタイル値を返します"""
+    ordered = sorted(values)
+    index = max(0, math.ceil(ratio * len(ordered)) - 1)
+    return ordered[index]
+
+
+def get_page_count(pdf_bytes):
+    """PDFのページ数を返します"""
+    document = pdfium.PdfDocument(pdf_bytes)
+    try:
+        return len(document)
+    finally:
+        document.close()
+
+
+def render_with_cold_subprocess(pdf_bytes, page_number, dpi):
+    """pdftoppmを起動してPDFの指定ページをPNGに変換します (従来方式)"""
+    completed = subprocess.run(
+        ['pdftoppm', '-png', '-singlefile', '-r', str(dpi), '-f', str(page_number), '-l', str(page_number), '-'],
+        input=pdf_bytes,
+        capture_output=True,
+        check=True
+    )
+    return completed.stdout
+
+
+def initialize_worker():
+    """ワーカープロセスでPDFiumを初期化します"""
+    document = pdfium.PdfDocument.new()
+    page = document.new_page(72, 72)
+    page.render().close()
+    page.close()
+    document.close()
+
+
+def render_with_pdfium(pdf_bytes, page_number, dpi):
+    """常駐ワーカー内でPDFiumを使ってPDFの指定ページをPNGに変換します"""
+    document = pdfium.PdfDocument(pdf_bytes)
+    try:
+        page = document[page_number - 1]
+        try:
+            bitmap = page.render(scale=dpi / 72)
+            try:
+                buffer = io.BytesIO()
+                bitmap.to_pil().save(buffer, 'PNG')
+                return buffer.getvalue()
+            finally:
+                bitmap.close()
+        finally:
+            page.close()
+    finally:
+        document.close()
+
+
+def run_benchmark(name, render, corpus, iterations):
+    """コーパスの全ページをiterations回レンダリングし、1回ごとのレイテンシ(ms)を返します"""
+    latencies = []
+    for iteration in range(iterations):
+        for pdf_name, pdf_bytes, page_count in corpus:
+            for page_number in range(1, page_count + 1):
+                started_at = time.perf_counter()
+                png_bytes = render(pdf_bytes, page_number)
+                latencies.append((time.perf_counter() - started_at) * 1000)
+                if not png_bytes:
+                    raise RuntimeError(f"{name}: empty output for {pdf_name} page {page_number}")
+        print(f"   ⏱️ {name}: iteration {iteration + 1}/{iterations} completed")
+    return latencies
+
+
+def print_report(name, latencies):
+    """レイテンシの統計を出力します"""
+    print(
+        f"{name:>8}: renders={len(latencies):5d}  "
+        f"p50={percentile(latencies, 0.50):8.1f}ms  "
+        f"p99={percentile(latencies, 0.99):8.1f}ms  "
+        f"mean={statistics.mean(latencies):8.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cold subprocess と pooled rendering のレイテンシ比較")
+    parser.add_argument("corpus_dir", help="ベンチマークに使うPDFを置いたディレクトリ")
+    parser.add_argument("--dpi", type=int, default=200)
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    pdf_paths = sorted(glob.glob(os.path.join(args.corpus_dir, "*.pdf")))
+    if not pdf_paths:
+        print(f"❌ PDFが見つかりません: {args.corpus_dir}")
+        sys.exit(1)
+
+    corpus = []
+    for pdf_path in pdf_paths:
+        with open(pdf_path, 'rb') as f:
+            pdf_bytes = f.read()
+        corpus.append((os.path.basename(pdf_path), pdf_bytes, get_page_count(pdf_bytes)))
+
+    total_pages = sum(page_count for _, _, page_count in corpus)
+    print(f"🚀 Corpus: {len(corpus)} PDFs / {total_pages} pages, dpi={args.dpi}, iterations={args.iterations}, workers={args.workers}")
+
+    cold_latencies = run_benchmark(
+        "cold",
+        lambda pdf_bytes, page_number: render_with_cold_subprocess(pdf_bytes, page_number, args.dpi),
+        corpus,
+        args.iterations
+    )
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=initialize_worker) as pool:
+        # 計測前に全ワーカーを起動しておきます
+        for future in [pool.submit(os.getpid) for _ in range(args.workers)]:
+            future.result()
+
+        pooled_latencies = run_benchmark(
+            "pooled",
+            lambda pdf_bytes, page_number: pool.submit(render_with_pdfium, pdf_bytes, page_number, args.dpi).result(),
+            corpus,
+            args.iterations
+        )
+
+    print()
+    print("📊 Results (per-render latency)")
+    print_report("cold", cold_latencies)
+    print_report("pooled", pooled_latencies)
+
+
+if __name__ == "__main__":
+    main()
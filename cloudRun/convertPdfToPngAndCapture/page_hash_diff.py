@@ -0,0 +1,174 @@
+"""
+perceptualHashで保存したページハッシュ(app.compute_page_hashの結果)を2つの版の間で比較します。
+GCSやレンダラーに依存しない純粋な処理のため、app.pyから分けています。
+"""
+
+# 内容が一致しないページ同士を同じページの改訂とみなす、一致するセルの割合の下限
+# これを下回る組み合わせは対応付けず、新版のページは added、旧版のページは removed とします
+PAGE_MATCH_MIN_SIMILARITY = 0.5
+
+
+def page_similarity(base, target):
+    """
+    2つのページのセルハッシュが一致する割合(0〜1)を返します。
+    用紙サイズ・向きが異なりセルの並びが一致しない場合は0を返します。
+    """
+    if (base["columns"], base["rows"]) != (target["columns"], target["rows"]) or not target["cells"]:
+        return 0.0
+    same_cells = sum(1 for base_cell, target_cell in zip(base["cells"], target["cells"]) if base_cell == target_cell)
+    return same_cells / len(target["cells"])
+
+
+def longest_increasing_pairs(pairs):
+    """
+    新版のページ順に並んだ (新版のページ番号, 旧版のページ番号) の組から、旧版のページ番号も昇順になる最長の部分列を返します。
+    ページの並べ替えがあっても、順序を保っている組だけを差分の区切り(アンカー)として使うためのものです。
+    """
+    # tails[k]: 長さk+1の部分列の末尾の組のインデックス (旧版のページ番号が最小のもの)
+    tails = []
+    previous = [None] * len(pairs)
+    for index, (_, base_page) in enumerate(pairs):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if pairs[tails[middle]][1] < base_page:
+                low = middle + 1
+            else:
+                high = middle
+        previous[index] = tails[low - 1] if low > 0 else None
+        if low == len(tails):
+            tails.append(index)
+        else:
+            tails[low] = index
+
+    result = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        result.append(pairs[index])
+        index = previous[index]
+    return result[::-1]
+
+
+def align_gap(gap_targets, gap_bases):
+    """
+    アンカーの間に残った新版・旧版のページを対応付け、{新版のページ番号: 旧版のページ番号} を返します。
+    一致するセルの割合が高い組から順に対応付け (同じ割合の場合は区間内の位置が近い組を優先)、
+    PAGE_MATCH_MIN_SIMILARITYを下回る組は対応付けません。
+    ただし、区間に新版・旧版のページが1ページずつ残った場合は、同じ位置のページの改訂 (用紙サイズの変更を含む) とみなして対応付けます。
+    """
+    candidates = []
+    for target_index, target in enumerate(gap_targets):
+        for base_index, base in enumerate(gap_bases):
+            similarity = page_similarity(base, target)
+            if similarity >= PAGE_MATCH_MIN_SIMILARITY:
+                candidates.append((-similarity, abs(target_index - base_index), target["page"], base["page"]))
+
+    paired = {}
+    used_base_pages = set()
+    for _, _, target_page, base_page in sorted(candidates):
+        if target_page in paired or base_page in used_base_pages:
+            continue
+        paired[target_page] = base_page
+        used_base_pages.add(base_page)
+
+    remaining_targets = [page["page"] for page in gap_targets if page["page"] not in paired]
+    remaining_bases = [page["page"] for page in gap_bases if page["page"] not in used_base_pages]
+    if len(remaining_targets) == 1 and len(remaining_bases) == 1:
+        paired[remaining_targets[0]] = remaining_bases[0]
+    return paired
+
+
+def build_changed_result(base, target, cell_pt):
+    """対応付けた旧版のページと内容が異なる新版のページの差分結果 (差分のあったセルの範囲) を作成します"""
+    if (base["columns"], base["rows"]) != (target["columns"], target["rows"]):
+        # 用紙サイズ・向きが変わったページはページ全体を差分とします
+        return {"page": target["page"], "status": "changed", "base_page": base["page"], "changed_cells": None, "changed_bbox": None}
+
+    changed_cells = [
+        index for index, (base_cell, target_cell) in enumerate(zip(base["cells"], target["cells"]))
+        if base_cell != target_cell
+    ]
+    changed_columns = [index % target["columns"] for index in changed_cells]
+    changed_rows = [index // target["columns"] for index in changed_cells]
+    return {
+        "page": target["page"],
+        "status": "changed",
+        "base_page": base["page"],
+        "changed_cells": len(changed_cells),
+        "changed_bbox": [
+            min(changed_columns) * cell_pt,
+            min(changed_rows) * cell_pt,
+            (max(changed_columns) + 1) * cell_pt,
+            (max(changed_rows) + 1) * cell_pt
+        ] if changed_cells else None
+    }
+
+
+def diff_page_hashes(base_pages, target_pages, cell_pt):
+    """
+    2つの版のページハッシュを比較し、新しい版(target)のページごとの差分結果を返します。
+    status: unchanged (差分なし) / moved (別のページ番号の旧ページと一致) / changed (差分あり) /
+            added (対応する旧ページなし) / removed (新版に対応するページが無い旧ページ)
+    まずハッシュが一致するページを対応付け、そのうち両方の版でページ順を保っている組をアンカーとします。
+    残りのページは、隣り合うアンカーの間の同じ区間にある旧ページとだけ比較し、セルが最も多く一致するページと対応付けます
+    (シートの挿入・削除・並べ替えでページ番号がずれても、区間をまたいで誤って対応付けないようにします)。
+    base_pageには対応付けた旧版のページ番号を (removedの場合はpageがNone)、changedの場合は差分のあったセルの範囲を
+    changed_bbox (pt, [x0, y0, x1, y1]) として返します。cell_ptはページハッシュのセルの大きさ(pt)です。
+    """
+    base_by_page = {page["page"]: page for page in base_pages}
+    base_pages_by_hash = {}
+    for page in sorted(base_pages, key=lambda page: page["page"]):
+        base_pages_by_hash.setdefault(page["page_hash"], []).append(page["page"])
+    target_pages = sorted(target_pages, key=lambda page: page["page"])
+
+    # 1. ハッシュが一致するページを対応付けます (同じページ番号を優先)
+    matched = {}
+    for target in target_pages:
+        same_page = base_by_page.get(target["page"])
+        if same_page is not None and same_page["page_hash"] == target["page_hash"]:
+            matched[target["page"]] = same_page["page"]
+    matched_base_pages = set(matched.values())
+    for target in target_pages:
+        if target["page"] in matched:
+            continue
+        moved_from = next((
+            page_number for page_number in base_pages_by_hash.get(target["page_hash"], [])
+            if page_number not in matched_base_pages
+        ), None)
+        if moved_from is not None:
+            matched[target["page"]] = moved_from
+            matched_base_pages.add(moved_from)
+
+    # 2. 一致したページのうち、ページ順を保っている組をアンカーとし、アンカーの間の区間ごとに残りのページを対応付けます
+    anchors = longest_increasing_pairs([(target["page"], matched[target["page"]]) for target in target_pages if target["page"] in matched])
+    unmatched_targets = [target for target in target_pages if target["page"] not in matched]
+    unmatched_bases = [base_by_page[page_number] for page_number in sorted(base_by_page) if page_number not in matched_base_pages]
+
+    paired = {}
+    previous_target_page, previous_base_page = float("-inf"), float("-inf")
+    for next_target_page, next_base_page in anchors + [(float("inf"), float("inf"))]:
+        paired.update(align_gap(
+            [target for target in unmatched_targets if previous_target_page < target["page"] < next_target_page],
+            [base for base in unmatched_bases if previous_base_page < base["page"] < next_base_page]
+        ))
+        previous_target_page, previous_base_page = next_target_page, next_base_page
+
+    # 3. 新版のページ順に差分結果を作成し、最後に対応するページが無かった旧ページを removed として加えます
+    results = []
+    for target in target_pages:
+        if target["page"] in matched:
+            base_page = matched[target["page"]]
+            status = "unchanged" if base_page == target["page"] else "moved"
+            results.append({"page": target["page"], "status": status, "base_page": base_page})
+        elif target["page"] in paired:
+            results.append(build_changed_result(base_by_page[paired[target["page"]]], target, cell_pt))
+        else:
+            results.append({"page": target["page"], "status": "added"})
+
+    used_base_pages = matched_base_pages | set(paired.values())
+    results.extend(
+        {"page": None, "status": "removed", "base_page": page_number}
+        for page_number in sorted(base_by_page)
+        if page_number not in used_base_pages
+    )
+    return results
@@ -0,0 +1,93 @@
+import unittest
+
+from page_hash_diff import diff_page_hashes
+
+CELL_PT = 72
+COLUMNS = 4
+ROWS = 3
+
+
+def make_page(page_number, sheet, edited_cells=()):
+    """図面シートsheetのページハッシュを作成します (edited_cellsのセルだけ内容を変えます)"""
+    cells = [f"{sheet}-{index}" for index in range(COLUMNS * ROWS)]
+    for index in edited_cells:
+        cells[index] = f"{sheet}-{index}-edited"
+    return {
+        "page": page_number,
+        "columns": COLUMNS,
+        "rows": ROWS,
+        "page_hash": "|".join(cells),
+        "cells": cells
+    }
+
+
+def make_pages(*sheets):
+    """シート名(または (シート名, 変更したセル) の組)の並びから、1ページ目からのページハッシュを作成します"""
+    pages = []
+    for page_number, sheet in enumerate(sheets, start=1):
+        if isinstance(sheet, tuple):
+            pages.append(make_page(page_number, sheet[0], sheet[1]))
+        else:
+            pages.append(make_page(page_number, sheet))
+    return pages
+
+
+def summarize(results):
+    return [(result["page"], result["status"], result.get("base_page")) for result in results]
+
+
+class DiffPageHashesTest(unittest.TestCase):
+    def test_identical_revisions_are_unchanged(self):
+        results = diff_page_hashes(make_pages("A", "B", "C"), make_pages("A", "B", "C"), CELL_PT)
+        self.assertEqual(summarize(results), [(1, "unchanged", 1), (2, "unchanged", 2), (3, "unchanged", 3)])
+
+    def test_inserted_page(self):
+        results = diff_page_hashes(make_pages("A", "B", "C"), make_pages("A", "X", "B", "C"), CELL_PT)
+        self.assertEqual(summarize(results), [(1, "unchanged", 1), (2, "added", None), (3, "moved", 2), (4, "moved", 3)])
+
+    def test_deleted_page(self):
+        results = diff_page_hashes(make_pages("A", "B", "C"), make_pages("A", "C"), CELL_PT)
+        self.assertEqual(summarize(results), [(1, "unchanged", 1), (2, "moved", 3), (None, "removed", 2)])
+
+    def test_reordered_pages(self):
+        results = diff_page_hashes(make_pages("A", "B", "C"), make_pages("C", "A", "B"), CELL_PT)
+        self.assertEqual(summarize(results), [(1, "moved", 3), (2, "moved", 1), (3, "moved", 2)])
+
+    def test_inserted_page_before_edited_page(self):
+        base_pages = make_pages("A", "B", "C")
+        target_pages = make_pages("A", "X", ("B", [5]), "C")
+        results = diff_page_hashes(base_pages, target_pages, CELL_PT)
+
+        self.assertEqual(summarize(results), [(1, "unchanged", 1), (2, "added", None), (3, "changed", 2), (4, "moved", 3)])
+        # セル5は2行目の2列目 (列1, 行1)
+        self.assertEqual(results[2]["changed_cells"], 1)
+        self.assertEqual(results[2]["changed_bbox"], [72, 72, 144, 144])
+
+    def test_deleted_page_before_edited_page(self):
+        base_pages = make_pages("A", "B", "C", "D")
+        target_pages = make_pages("A", ("C", [0, 11]), "D")
+        results = diff_page_hashes(base_pages, target_pages, CELL_PT)
+
+        self.assertEqual(summarize(results), [(1, "unchanged", 1), (2, "changed", 3), (3, "moved", 4), (None, "removed", 2)])
+        self.assertEqual(results[1]["changed_bbox"], [0, 0, 288, 216])
+
+    def test_unmatched_pages_are_only_compared_within_their_gap(self):
+        # 改訂されたBは、アンカーCをまたいだ後ろの区間にある旧ページとは対応付けません
+        base_pages = make_pages("A", "B", "C", "D")
+        target_pages = make_pages("A", "C", ("B", [1]), "D")
+        results = diff_page_hashes(base_pages, target_pages, CELL_PT)
+
+        self.assertEqual(summarize(results), [(1, "unchanged", 1), (2, "moved", 3), (3, "added", None), (4, "unchanged", 4), (None, "removed", 2)])
+
+    def test_resized_page_in_same_position_is_changed(self):
+        base_pages = make_pages("A", "B", "C")
+        target_pages = make_pages("A", "B", "C")
+        target_pages[1] = {**target_pages[1], "columns": ROWS, "rows": COLUMNS, "page_hash": "rotated"}
+        results = diff_page_hashes(base_pages, target_pages, CELL_PT)
+
+        self.assertEqual(summarize(results), [(1, "unchanged", 1), (2, "changed", 2), (3, "unchanged", 3)])
+        self.assertIsNone(results[1]["changed_bbox"])
+
+
+if __name__ == "__main__":
+    unittest.main()
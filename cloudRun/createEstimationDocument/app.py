@@ -1,10 +1,19 @@
 import os
+import io
+import re
 import sys
+import time
 import tempfile
 import subprocess
 import logging
 import json
-from datetime import datetime
+import hashlib
+import threading
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta, timezone
 # Google Cloud Storage クライアント
 from google.cloud import storage
 # Flask ウェブフレームワーク
@@ -12,8 +21,15 @@ from flask import Flask, request, jsonify
 from pdf2image import convert_from_path
 # 新規追加
 import google.generativeai as genai
-from jinja2 import Template
+from jinja2 import Environment, select_autoescape
 import pdfkit
+# 見積書と部品明細書のPDFを1つに結合するライブラリ
+from pypdf import PdfWriter
+# プロセス内でHTMLをPDFに変換するライブラリ (未インストール、またはPango等のOSライブラリが無い場合はwkhtmltopdfを使用します)
+try:
+    from weasyprint import HTML
+except (ImportError, OSError):
+    HTML = None
 # 環境変数読み込み用
 from dotenv import load_dotenv
 
@@ -31,6 +47,7 @@ app = Flask(__name__)
 storage_client = storage.Client()
 
 # Gemini APIの設定
+GEMINI_MODEL_NAME = 'gemini-2.0-flash-exp'
 gemini_api_key = os.getenv("GEMINI_API_KEY")
 if not gemini_api_key:
     logger.warning("GEMINI_API_KEY environment variable not set. Gemini API features will be disabled.")
@@ -39,7 +56,7 @@ else:
     try:
         genai.configure(api_key=gemini_api_key)
         model = genai.GenerativeModel(
-            'gemini-2.0-flash-exp',
+            GEMINI_MODEL_NAME,
             location="us-central1"
         )
         logger.info("Gemini API configured successfully")
@@ -47,6 +64,281 @@ else:
         logger.error(f"Failed to configure Gemini API: {e}")
         model = None
 
+# HTML生成方式
+# template: コンパイル済みのJinja2テンプレートで描画します (デフォルト。LLMを呼ばないため数ミリ秒で決定的に生成されます)
+# gemini: Gemini APIでHTMLを生成し、失敗した場合はテンプレートで描画します
+# リクエストの "htmlEngine" で上書きできます
+HTML_ENGINES = ("template", "gemini")
+DEFAULT_HTML_ENGINE = os.environ.get("DEFAULT_HTML_ENGINE", "template")
+
+# 出力形式
+# separate: 見積書(estimation.pdf)と部品明細書(inner.pdf)を別々のPDFとして保存します (デフォルト)
+# merged: 2つの帳票をしおり付きの1つのPDF(estimate_bundle.pdf)に結合して保存します
+# リクエストの "outputMode" で指定し、"zipBundle": true の場合は2つのPDFをまとめたZIPも保存します
+OUTPUT_MODES = ("separate", "merged")
+MERGED_PDF_FILE_NAME = "estimate_bundle.pdf"
+ZIP_BUNDLE_FILE_NAME = "estimate_bundle.zip"
+
+# 生成したファイルのGCSメタデータに保存するリクエストのフィンガープリント
+# 同じ内容のリクエスト(再試行・Step 4の再実行)では、保存済みのファイルを再生成せずに返します
+# REQUEST_FINGERPRINT_VERSION は生成結果が変わる変更を行った際に更新し、古いファイルを再利用しないようにします
+REQUEST_FINGERPRINT_VERSION = 1
+FINGERPRINT_METADATA_KEY = "requestFingerprint"
+SHA256_METADATA_KEY = "contentSha256"
+_inflight_generations = {}
+_inflight_generations_lock = threading.Lock()
+
+# 見積書・部品明細書のデフォルト値
+DEFAULT_ISSUER = {
+    "name": "株式会社サンプル",
+    "zip_code": "〒100-0001",
+    "address": "東京都千代田区千代田1-1-1",
+    "tel": "03-1234-5678",
+    "email": "info@sample.co.jp",
+}
+DEFAULT_CLIENT = {
+    "name": "お客様会社名",
+    "contact_person": "ご担当者",
+    "zip_code": "〒000-0000",
+    "address_line1": "住所未設定",
+    "address_line2": "",
+}
+DEFAULT_PAYMENT_TERMS = "月末締め翌月末払い"
+DEFAULT_DUE_DATE = "発行日から30日間"
+DEFAULT_NOTES = "ご不明な点がございましたらお気軽にお問い合わせください。"
+DEFAULT_QUOTE_NUMBER = "EST-001"
+DEFAULT_PARTS_DOCUMENT_NUMBER = "PARTS-001"
+DEFAULT_PRICE_SOURCE = "AI推定価格"
+
+# 消費税率と、見積書の明細テーブルの最低行数 (不足分は空白行で埋めます)
+TAX_RATE = 0.1
+ESTIMATE_TABLE_ROWS = 12
+
+# 部品明細書で1ページに載せる部品の行数
+# 部品数が多い製品は、この行数ごとに表を分割して改ページします (各製品の最初のページは製品名・集計欄の分だけ少なくします)
+PARTS_ROWS_FIRST_PAGE = int(os.environ.get("PARTS_ROWS_FIRST_PAGE", 24))
+PARTS_ROWS_PER_PAGE = int(os.environ.get("PARTS_ROWS_PER_PAGE", 34))
+# 部品の合計数がこれを超える場合はプロンプトが大きくなりすぎるため、htmlEngine: gemini でもテンプレートで描画します
+GEMINI_MAX_PARTS = int(os.environ.get("GEMINI_MAX_PARTS", 200))
+
+# 部品カテゴリごとの明細行のCSSクラス (該当しないカテゴリは category-other)
+PART_CATEGORY_CLASSES = {
+    "金属部品": "category-metal",
+    "樹脂部品": "category-resin",
+    "電子部品": "category-electronic",
+}
+
+# 発行日はCloud Run(UTC)上でも日本時間の日付を使用します
+JST = timezone(timedelta(hours=9))
+
+# wkhtmltopdfのPDF変換オプション
+PDF_OPTIONS = {
+    'page-size': 'A4',
+    'margin-top': '0.75in',
+    'margin-right': '0.75in',
+    'margin-bottom': '0.75in',
+    'margin-left': '0.75in',
+    'encoding': "UTF-8",
+    'no-outline': None,
+    'enable-local-file-access': None
+}
+
+# Geminiで生成したHTMLのキャッシュ設定 (htmlEngine: gemini の場合のみ使用)
+# 同じテンプレート・同じ内容のリクエスト(再試行や再生成)ではGeminiを呼ばずに前回の生成結果を返します
+# GEMINI_PROMPT_VERSION はプロンプトやデフォルト値を変更した際に更新し、古い生成結果を使わないようにします
+GEMINI_PROMPT_VERSION = 2
+GEMINI_CACHE_TTL_SEC = int(os.environ.get("GEMINI_CACHE_TTL_SEC", 24 * 60 * 60))
+GEMINI_CACHE_MAX_ENTRIES = int(os.environ.get("GEMINI_CACHE_MAX_ENTRIES", 256))
+# 設定した場合は生成結果をGCSにも保存し、インスタンスが入れ替わってもキャッシュを利用します
+GEMINI_CACHE_BUCKET = os.environ.get("GEMINI_CACHE_BUCKET")
+GEMINI_CACHE_PREFIX = os.environ.get("GEMINI_CACHE_PREFIX", "_geminiHtmlCache")
+
+# Geminiの応答をストリーミングで受信し、受信しながらHTMLとして妥当か検査します
+# 不正な応答やGEMINI_LATENCY_BUDGET_SECを超えた場合は、応答の完了を待たずにテンプレート描画に切り替えます
+GEMINI_STREAMING = os.environ.get("GEMINI_STREAMING", "true").lower() == "true"
+GEMINI_LATENCY_BUDGET_SEC = float(os.environ.get("GEMINI_LATENCY_BUDGET_SEC", 60))
+# 応答の先頭この文字数までにHTMLの開始(<!DOCTYPE html> / <html> / コードブロック)が無ければ不正とみなします
+GEMINI_STREAM_VALIDATION_CHARS = 512
+# 帳票のHTMLとして大きすぎる応答は打ち切ります
+GEMINI_MAX_HTML_CHARS = 200000
+GEMINI_HTML_START_PATTERN = re.compile(r'```|<!doctype\s+html|<html', re.IGNORECASE)
+_gemini_html_cache = OrderedDict()
+_gemini_html_cache_lock = threading.Lock()
+
+# HTML→PDF変換の方式
+# weasyprint: 常駐ワーカープロセス内でWeasyPrintを使って変換します (日本語フォントの読み込みはワーカー起動時の1回のみ)
+# wkhtmltopdf: 変換ごとにwkhtmltopdfを起動します (従来方式。HTMLとPDFは標準入出力で受け渡します)
+PDF_RENDERER = os.environ.get("PDF_RENDERER", "weasyprint" if HTML else "wkhtmltopdf")
+if PDF_RENDERER == "weasyprint" and HTML is None:
+    # WeasyPrintを読み込めない環境でワーカーを起動すると、初期化処理で全ワーカーが失敗してプールが壊れるため、従来方式で変換します
+    logger.error("PDF_RENDERER=weasyprint but WeasyPrint could not be imported (package or Pango/OS libraries missing). Falling back to wkhtmltopdf.")
+    PDF_RENDERER = "wkhtmltopdf"
+
+# gunicornのスレッド数 (dockerfileのCMDと同じ環境変数)
+# 1リクエストで2つの帳票を並行して変換するため、同時に変換できる帳票数の上限はスレッド数の2倍とします
+GUNICORN_THREADS = int(os.environ.get("GUNICORN_THREADS", 4))
+PDF_RENDER_CONCURRENCY = GUNICORN_THREADS * 2
+_pdf_render_slots = threading.BoundedSemaphore(PDF_RENDER_CONCURRENCY)
+
+# PDF変換用のプロセスプールのサイズ (デフォルトはCPUコア数と同時変換数の小さい方)
+PDF_RENDER_POOL_SIZE = int(os.environ.get("PDF_RENDER_POOL_SIZE", min(os.cpu_count() or 1, PDF_RENDER_CONCURRENCY)))
+
+# プロセスプールは起動時に一度だけ作成し、リクエスト間で使い回します (ワーカープロセスは常駐します)
+_pdf_render_pool = None
+_pdf_render_pool_lock = threading.Lock()
+
+
+def format_currency(value):
+    """金額を3桁区切りの整数で表示します (未設定の場合は0)"""
+    try:
+        return f"{int(round(float(value or 0))):,}"
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def format_date(value, date_format='%Y年%m月%d日'):
+    """日付(date/datetime/ISO形式の文字列)を 'YYYY年MM月DD日' 形式で表示します"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.strftime(date_format)
+
+
+def format_part_category_class(category):
+    """部品カテゴリから明細行のCSSクラスを返します"""
+    return PART_CATEGORY_CLASSES.get(category, "category-other")
+
+
+# 帳票テンプレート描画用のJinja2環境 (差し込む値はHTMLエスケープします)
+jinja_env = Environment(autoescape=select_autoescape(['html']))
+jinja_env.filters['currency'] = format_currency
+jinja_env.filters['date'] = format_date
+jinja_env.filters['category_class'] = format_part_category_class
+
+# 帳票テンプレートのファイル名 (app.pyと同じディレクトリに配置します)
+TEMPLATE_DIR = os.path.dirname(os.path.abspath(__file__))
+ESTIMATE_TEMPLATE_NAME = 'template.html'
+PARTS_BREAKDOWN_TEMPLATE_NAME = 'template2.html'
+
+# テンプレートの更新を検知して再読み込みするか (開発時のみ有効にします)
+TEMPLATE_HOT_RELOAD = os.environ.get("TEMPLATE_HOT_RELOAD", "false").lower() == "true"
+
+# テンプレート名ごとの登録情報 (ソース文字列・コンパイル済みテンプレート・更新時刻・バージョン)
+_template_registry = {}
+_template_registry_lock = threading.Lock()
+
+
+def load_template(name):
+    """テンプレートファイルを読み込んでコンパイルし、登録情報を返します"""
+    path = os.path.join(TEMPLATE_DIR, name)
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, 'r', encoding='utf-8') as f:
+        source = f.read()
+
+    return {
+        "name": name,
+        "mtime": mtime,
+        "source": source,
+        "template": jinja_env.from_string(source),
+        # テンプレートの内容が変わると変わる識別子 (ログや生成結果のキャッシュキーに使用します)
+        "version": hashlib.sha256(source.encode('utf-8')).hexdigest()[:12],
+    }
+
+
+def get_template_entry(name):
+    """
+    テンプレートの登録情報を返します。テンプレートは起動時に一度だけ読み込んでコンパイルし、リクエスト間で使い回します。
+    TEMPLATE_HOT_RELOADの場合は、ファイルの更新時刻が変わったときのみ再読み込みします。
+    """
+    entry = _template_registry.get(name)
+    if entry is not None and not TEMPLATE_HOT_RELOAD:
+        return entry
+
+    mtime = os.stat(os.path.join(TEMPLATE_DIR, name)).st_mtime_ns if entry is not None else None
+    if entry is not None and entry["mtime"] == mtime:
+        return entry
+
+    with _template_registry_lock:
+        entry = _template_registry.get(name)
+        if entry is None or entry["mtime"] != mtime:
+            entry = load_template(name)
+            _template_registry[name] = entry
+            logger.info(f"Loaded template {name} (version={entry['version']})")
+    return entry
+
+
+# 起動時に全テンプレートを読み込み、構文エラーがあれば起動時に検出します
+for template_name in (ESTIMATE_TEMPLATE_NAME, PARTS_BREAKDOWN_TEMPLATE_NAME):
+    get_template_entry(template_name)
+
+
+def initialize_pdf_render_worker():
+    """
+    PDF変換ワーカープロセスの初期化処理です。
+    日本語を含む小さなHTMLを1度変換し、フォント(Noto CJK)の読み込みを初回リクエストの前に済ませておきます。
+    """
+    HTML(string='<p>見積書 部品明細書 ¥0</p>').write_pdf()
+
+
+def get_pdf_render_pool():
+    """PDF変換用のプロセスプールを取得します (未作成の場合は作成)"""
+    global _pdf_render_pool
+    with _pdf_render_pool_lock:
+        if _pdf_render_pool is None:
+            logger.info(f"Creating PDF render process pool: max_workers={PDF_RENDER_POOL_SIZE}, concurrency={PDF_RENDER_CONCURRENCY}")
+            _pdf_render_pool = ProcessPoolExecutor(max_workers=PDF_RENDER_POOL_SIZE, initializer=initialize_pdf_render_worker)
+    return _pdf_render_pool
+
+
+def reset_pdf_render_pool(broken_pool):
+    """
+    ワーカープロセスが異常終了して壊れたプロセスプールを破棄します (次回のget_pdf_render_poolで作り直します)。
+    既に別のスレッドが作り直している場合は何もしません。
+    """
+    global _pdf_render_pool
+    with _pdf_render_pool_lock:
+        if _pdf_render_pool is not broken_pool:
+            return
+        # 壊れたプールの残りのワーカープロセスは、プールの管理スレッドが終了させます
+        _pdf_render_pool = None
+    logger.warning("PDF render process pool is broken (a worker process died). Recreating it.")
+
+
+def warm_up_pdf_render_pool():
+    """起動時にPDF変換のワーカープロセスを全て立ち上げ、フォントを読み込んでおきます"""
+    futures = [get_pdf_render_pool().submit(os.getpid) for _ in range(PDF_RENDER_POOL_SIZE)]
+    worker_pids = {future.result() for future in futures}
+    logger.info(f"PDF render pool is warm: {len(worker_pids)} worker processes")
+
+
+def render_pdf_with_weasyprint(html_content):
+    """WeasyPrintでHTMLをPDFのバイト列に変換します。プロセスプールのワーカーで実行します"""
+    return HTML(string=html_content, base_url=os.path.dirname(os.path.abspath(__file__))).write_pdf()
+
+
+def convert_html_to_pdf(html_content):
+    """
+    HTMLの文字列をPDFのバイト列に変換します。変換方式はPDF_RENDERERで切り替えます。
+    同時に変換する帳票数はPDF_RENDER_CONCURRENCYまでに制限し、超えた場合は空きが出るまで待機します。
+    ワーカープロセスが異常終了(OOMなど)してプールが壊れた場合はプールを作り直します。
+    異常終了時に変換中だった帳票はBrokenProcessPoolで失敗します (そのリクエストのみ失敗し、以降のリクエストは新しいプールで変換します)。
+    """
+    with _pdf_render_slots:
+        if PDF_RENDERER == "weasyprint":
+            pool = get_pdf_render_pool()
+            try:
+                future = pool.submit(render_pdf_with_weasyprint, html_content)
+            except BrokenProcessPool:
+                reset_pdf_render_pool(pool)
+                pool = get_pdf_render_pool()
+                future = pool.submit(render_pdf_with_weasyprint, html_content)
+            try:
+                return future.result()
+            except BrokenProcessPool:
+                reset_pdf_render_pool(pool)
+                raise
+        # 出力先にFalseを指定すると、一時ファイルを使わずに標準入出力でPDFのバイト列を受け取ります
+        return pdfkit.from_string(html_content, False, options=PDF_OPTIONS)
+
 # LibreOfficeの実行可能ファイル名 (環境によって 'libreoffice' または 'soffice')
 
 @app.route('/convert-pdf-to-png', methods=['POST'])
@@ -166,7 +458,12 @@ def create_organizationIdt_endpoint():
             }
         ],
         "bucket_name": "your-gcs-bucket-name",
-        "parentFolderPath": "estimates/project_001/"
+        "parentFolderPath": "estimates/project_001/",
+        "htmlEngine": "template",  # 任意: template (デフォルト) / gemini
+        "issueDate": "2025-06-22",  # 任意: 発行日 (省略時は日本時間の今日)
+        "outputMode": "separate",  # 任意: separate (デフォルト) / merged
+        "zipBundle": false,  # 任意: trueの場合は2つのPDFをまとめたZIPも保存
+        "forceRegenerate": false  # 任意: trueの場合は同じ内容で生成済みのファイルがあっても再生成
     }
     """
     logger.info(f"Received request: {request.url} {request.method}")
@@ -187,92 +484,590 @@ def create_organizationIdt_endpoint():
     parts_breakdown = request_data['partsBreakdown']
     bucket_name = request_data['bucket_name']
     parent_folder_path = request_data['parentFolderPath'].rstrip('/')
+    html_engine = request_data.get('htmlEngine') or DEFAULT_HTML_ENGINE
+    output_mode = request_data.get('outputMode') or "separate"
+    zip_bundle = bool(request_data.get('zipBundle', False))
+
+    if html_engine not in HTML_ENGINES:
+        logger.error(f"Error: Unsupported htmlEngine: {html_engine}")
+        return jsonify({"status": "error", "message": f"Unsupported htmlEngine: {html_engine}"}), 400
+
+    if output_mode not in OUTPUT_MODES:
+        logger.error(f"Error: Unsupported outputMode: {output_mode}")
+        return jsonify({"status": "error", "message": f"Unsupported outputMode: {output_mode}"}), 400
+
+    try:
+        issue_date = date.fromisoformat(request_data['issueDate']) if request_data.get('issueDate') else get_today()
+    except ValueError:
+        logger.error(f"Error: Invalid issueDate: {request_data['issueDate']}")
+        return jsonify({"status": "error", "message": f"Invalid issueDate: {request_data['issueDate']}"}), 400
 
     # 出力ファイルパスを構築
-    estimate_gcs_path = f"{parent_folder_path}/estimation.pdf"
-    inner_gcs_path = f"{parent_folder_path}/inner.pdf"
+    output_paths = {
+        "estimation": f"{parent_folder_path}/estimation.pdf",
+        "inner": f"{parent_folder_path}/inner.pdf",
+        "merged": f"{parent_folder_path}/{MERGED_PDF_FILE_NAME}",
+        "zip": f"{parent_folder_path}/{ZIP_BUNDLE_FILE_NAME}",
+    }
+    fingerprint = build_request_fingerprint(estimate_data, parts_breakdown, issue_date, html_engine, output_mode, zip_bundle)
 
-    logger.info(f"Document generation task: bucket={bucket_name}, folder={parent_folder_path}")
+    logger.info(f"Document generation task: bucket={bucket_name}, folder={parent_folder_path}, html_engine={html_engine}, output_mode={output_mode}, zip_bundle={zip_bundle}, fingerprint={fingerprint}")
 
-    with tempfile.TemporaryDirectory() as tmp_dir:
-        logger.info(f"Created temporary directory: {tmp_dir}")
-        
-        try:
-            bucket = storage_client.bucket(bucket_name)
-            logger.info(f"Connected to GCS bucket: {bucket_name}")
+    try:
+        started_at = time.perf_counter()
+        bucket = storage_client.bucket(bucket_name)
+        logger.info(f"Connected to GCS bucket: {bucket_name}")
 
-            # 1. 見積書HTMLを生成
-            estimate_html = generate_html_with_gemini(estimate_data)
-            estimate_html_path = os.path.join(tmp_dir, "estimation.html")
-            with open(estimate_html_path, 'w', encoding='utf-8') as f:
-                f.write(estimate_html)
-            logger.info("Generated estimate HTML")
-
-            # 2. 部品明細書HTMLを生成
-            inner_html = generate_parts_breakdown_html_with_gemini(parts_breakdown)
-            inner_html_path = os.path.join(tmp_dir, "inner.html")
-            with open(inner_html_path, 'w', encoding='utf-8') as f:
-                f.write(inner_html)
-            logger.info("Generated parts breakdown HTML")
-
-            # 3. HTMLをPDFに変換
-            pdf_options = {
-                'page-size': 'A4',
-                'margin-top': '0.75in',
-                'margin-right': '0.75in',
-                'margin-bottom': '0.75in',
-                'margin-left': '0.75in',
-                'encoding': "UTF-8",
-                'no-outline': None,
-                'enable-local-file-access': None
-            }
-            
-            # 見積書PDF
-            estimate_pdf_path = os.path.join(tmp_dir, "estimation.pdf")
-            pdfkit.from_file(estimate_html_path, estimate_pdf_path, options=pdf_options)
-            logger.info("Converted estimate HTML to PDF")
-
-            # 部品明細書PDF
-            inner_pdf_path = os.path.join(tmp_dir, "inner.pdf")
-            pdfkit.from_file(inner_html_path, inner_pdf_path, options=pdf_options)
-            logger.info("Converted parts breakdown HTML to PDF")
-
-            # 4. PDFファイルをGCSにアップロード
-            # 見積書PDF
-            estimate_blob = bucket.blob(estimate_gcs_path)
-            estimate_blob.upload_from_filename(estimate_pdf_path)
-            logger.info(f"Uploaded estimate PDF to GCS: {estimate_gcs_path}")
-
-            # 部品明細書PDF
-            inner_blob = bucket.blob(inner_gcs_path)
-            inner_blob.upload_from_filename(inner_pdf_path)
-            logger.info(f"Uploaded parts breakdown PDF to GCS: {inner_gcs_path}")
+        # 同じリクエストで生成済みのファイルがあれば、再生成せずにそのまま返します (再試行・再実行対策)
+        if not request_data.get('forceRegenerate', False):
+            manifest = find_reusable_outputs(bucket, get_expected_output_paths(output_paths, output_mode, zip_bundle), fingerprint)
+            if manifest is not None:
+                lookup_ms = round((time.perf_counter() - started_at) * 1000, 1)
+                logger.info(f"Reusing documents generated for fingerprint {fingerprint} in {parent_folder_path} (lookup={lookup_ms}ms)")
+                timings = {"lookup_ms": lookup_ms, "total_ms": lookup_ms}
+                return jsonify(build_generation_response(html_engine, output_mode, zip_bundle, output_paths, manifest, timings, fingerprint, reused=True)), 200
 
-            return jsonify({
-                "status": "success",
-                "estimate_gcs_path": estimate_gcs_path,
-                "inner_gcs_path": inner_gcs_path,
-                "message": "Both estimate and parts breakdown documents successfully generated and uploaded to GCS."
-            }), 200
+        # 同じインスタンスで同じリクエストを処理中の場合は、その完了を待って結果を共有します
+        (manifest, timings), shared = run_once_per_fingerprint(
+            f"{bucket_name}/{parent_folder_path}/{fingerprint}",
+            lambda: generate_documents(bucket, estimate_data, parts_breakdown, issue_date, html_engine, output_mode, zip_bundle, output_paths, fingerprint)
+        )
+        if shared:
+            logger.info(f"Shared in-flight generation result for fingerprint {fingerprint}")
+
+        return jsonify(build_generation_response(html_engine, output_mode, zip_bundle, output_paths, manifest, timings, fingerprint, reused=shared)), 200
+
+    except Exception as e:
+        logger.error(f"An error occurred during document generation: {e}")
+        return jsonify({
+            "status": "error",
+            "message": f"Document generation failed: {str(e)}"
+        }), 500
+
+
+def build_request_fingerprint(estimate_data, parts_breakdown, issue_date, html_engine, output_mode, zip_bundle):
+    """
+    生成結果に影響するリクエストの内容・テンプレートのバージョン・PDF変換方式を正規化したJSONのハッシュを返します。
+    生成したファイルのメタデータに保存し、同じリクエストの再実行時に再利用できるか判定します。
+    """
+    canonical = json.dumps({
+        "fingerprint_version": REQUEST_FINGERPRINT_VERSION,
+        "estimate_data": estimate_data,
+        "parts_breakdown": parts_breakdown,
+        "issue_date": issue_date.isoformat(),
+        "html_engine": html_engine,
+        "output_mode": output_mode,
+        "zip_bundle": zip_bundle,
+        "templates": [get_template_entry(name)["version"] for name in (ESTIMATE_TEMPLATE_NAME, PARTS_BREAKDOWN_TEMPLATE_NAME)],
+        "pdf_renderer": PDF_RENDERER,
+    }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def get_expected_output_paths(output_paths, output_mode, zip_bundle):
+    """出力形式に応じて保存されるファイルのパスを、マニフェストと同じ順序で返します"""
+    if output_mode == "separate":
+        gcs_paths = [output_paths["estimation"], output_paths["inner"]]
+    else:
+        gcs_paths = [output_paths["merged"]]
+    if zip_bundle:
+        gcs_paths.append(output_paths["zip"])
+    return gcs_paths
+
+
+def find_reusable_outputs(bucket, gcs_paths, fingerprint):
+    """
+    全ての出力ファイルが同じフィンガープリントで保存済みの場合はマニフェストを返します。
+    1つでも存在しない、またはフィンガープリントが異なる場合はNoneを返します (途中で失敗した生成結果は再利用しません)。
+    """
+    manifest = []
+    for gcs_path in gcs_paths:
+        blob = bucket.get_blob(gcs_path)
+        metadata = (blob.metadata or {}) if blob is not None else {}
+        if metadata.get(FINGERPRINT_METADATA_KEY) != fingerprint:
+            return None
+        manifest.append({
+            "name": os.path.basename(gcs_path),
+            "gcs_path": gcs_path,
+            "content_type": blob.content_type,
+            "size_bytes": blob.size,
+            "sha256": metadata.get(SHA256_METADATA_KEY)
+        })
+    return manifest
+
+
+def run_once_per_fingerprint(key, generate):
+    """
+    同じキーの生成がこのインスタンスで実行中であれば完了を待って結果を共有し、そうでなければ生成を実行します。
+    (結果, 他のリクエストの結果を共有したか) を返します。
+    """
+    with _inflight_generations_lock:
+        future = _inflight_generations.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _inflight_generations[key] = future
+
+    if not owner:
+        return future.result(), True
+
+    try:
+        result = generate()
+        future.set_result(result)
+        return result, False
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_generations_lock:
+            _inflight_generations.pop(key, None)
 
+
+def generate_documents(bucket, estimate_data, parts_breakdown, issue_date, html_engine, output_mode, zip_bundle, output_paths, fingerprint):
+    """
+    見積書と部品明細書を生成してGCSに保存し、(マニフェスト, 処理時間) を返します。
+    保存するファイルにはリクエストのフィンガープリントをメタデータとして付けます。
+    """
+    started_at = time.perf_counter()
+    # merged の場合は個別のPDFはアップロードせず、結合したPDFのみを保存します
+    upload_separately = output_mode == "separate"
+
+    # 見積書と部品明細書は互いに依存しないため、HTML生成・PDF変換・アップロードをそれぞれ並行して実行します
+    # HTMLとPDFはメモリ上でのみ受け渡し、一時ファイルは使用しません
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="estimate-document") as executor:
+        estimate_future = executor.submit(
+            build_document_pdf, bucket, "estimation", output_paths["estimation"] if upload_separately else None,
+            lambda: generate_estimate_html(estimate_data, issue_date, html_engine), fingerprint
+        )
+        inner_future = executor.submit(
+            build_document_pdf, bucket, "inner", output_paths["inner"] if upload_separately else None,
+            lambda: generate_parts_breakdown_html(parts_breakdown, issue_date, html_engine), fingerprint
+        )
+        # 両方の完了を待ってから結果を確認します (失敗した場合は例外が送出されます)
+        estimate_pdf, estimate_artifact, estimate_timings = estimate_future.result()
+        inner_pdf, inner_artifact, inner_timings = inner_future.result()
+
+    # アップロードしたファイルの一覧 (パス・サイズ・SHA-256)
+    manifest = [artifact for artifact in (estimate_artifact, inner_artifact) if artifact is not None]
+
+    bundle_started_at = time.perf_counter()
+    if output_mode == "merged":
+        merged_pdf = merge_pdfs([("見積書", estimate_pdf), ("部品明細書", inner_pdf)])
+        manifest.append(upload_artifact(bucket, output_paths["merged"], merged_pdf, 'application/pdf', fingerprint))
+        logger.info(f"Uploaded merged PDF to GCS: {output_paths['merged']} ({len(merged_pdf)} bytes)")
+    if zip_bundle:
+        zip_bytes = build_zip_bundle([("estimation.pdf", estimate_pdf), ("inner.pdf", inner_pdf)])
+        manifest.append(upload_artifact(bucket, output_paths["zip"], zip_bytes, 'application/zip', fingerprint))
+        logger.info(f"Uploaded ZIP bundle to GCS: {output_paths['zip']} ({len(zip_bytes)} bytes)")
+    bundle_ms = round((time.perf_counter() - bundle_started_at) * 1000, 1)
+
+    total_ms = round((time.perf_counter() - started_at) * 1000, 1)
+    logger.info(f"Generated both documents in {total_ms}ms (estimate={estimate_timings['total_ms']}ms, inner={inner_timings['total_ms']}ms, bundle={bundle_ms}ms)")
+
+    return manifest, {
+        "estimate": estimate_timings,
+        "inner": inner_timings,
+        "bundle_ms": bundle_ms,
+        "total_ms": total_ms
+    }
+
+
+def build_generation_response(html_engine, output_mode, zip_bundle, output_paths, manifest, timings, fingerprint, reused):
+    """/create-estimate-document の成功時のレスポンスを組み立てます"""
+    response = {
+        "status": "success",
+        "html_engine": html_engine,
+        "output_mode": output_mode,
+        "request_fingerprint": fingerprint,
+        # 生成済みのファイルを再利用した場合はtrue
+        "reused": reused,
+        "manifest": manifest,
+        "timings": timings,
+    }
+    if output_mode == "separate":
+        response["estimate_gcs_path"] = output_paths["estimation"]
+        response["inner_gcs_path"] = output_paths["inner"]
+        response["message"] = "Both estimate and parts breakdown documents successfully generated and uploaded to GCS."
+    else:
+        response["merged_gcs_path"] = output_paths["merged"]
+        response["message"] = "Estimate and parts breakdown documents successfully generated, merged into a single PDF and uploaded to GCS."
+    if zip_bundle:
+        response["zip_gcs_path"] = output_paths["zip"]
+    return response
+
+
+def build_document_pdf(bucket, document_name, gcs_path, generate_html, fingerprint):
+    """
+    1つの帳票についてHTML生成・PDF変換・GCSへのアップロードを順に行い、
+    PDFのバイト列・マニフェストの項目・工程ごとの処理時間(ms)を返します。
+    HTMLとPDFはディスクに書き出さず、メモリ上のバッファのまま受け渡します。
+    gcs_pathがNoneの場合はアップロードしません (結合したPDFのみを保存する場合)。
+    見積書と部品明細書でそれぞれ別スレッドから呼び出します。
+    """
+    started_at = time.perf_counter()
+
+    # 1. HTMLを生成
+    html_content = generate_html()
+    html_done_at = time.perf_counter()
+    logger.info(f"Generated {document_name} HTML")
+
+    # 2. HTMLをメモリ上で渡してPDFに変換
+    pdf_bytes = convert_html_to_pdf(html_content)
+    pdf_done_at = time.perf_counter()
+    logger.info(f"Converted {document_name} HTML to PDF with {PDF_RENDERER} ({len(pdf_bytes)} bytes)")
+
+    # 3. PDFをメモリ上のバッファから直接GCSにアップロード
+    artifact = None
+    if gcs_path is not None:
+        artifact = upload_artifact(bucket, gcs_path, pdf_bytes, 'application/pdf', fingerprint)
+        logger.info(f"Uploaded {document_name} PDF to GCS: {gcs_path}")
+    upload_done_at = time.perf_counter()
+
+    return pdf_bytes, artifact, {
+        "html_ms": round((html_done_at - started_at) * 1000, 1),
+        "pdf_ms": round((pdf_done_at - html_done_at) * 1000, 1),
+        "upload_ms": round((upload_done_at - pdf_done_at) * 1000, 1),
+        "total_ms": round((upload_done_at - started_at) * 1000, 1)
+    }
+
+
+def upload_artifact(bucket, gcs_path, data, content_type, fingerprint):
+    """
+    メモリ上のバイト列をGCSにアップロードし、マニフェストの項目(ファイル名・パス・サイズ・SHA-256)を返します。
+    リクエストのフィンガープリントとSHA-256はオブジェクトのメタデータにも保存します。
+    """
+    sha256 = hashlib.sha256(data).hexdigest()
+    blob = bucket.blob(gcs_path)
+    blob.metadata = {FINGERPRINT_METADATA_KEY: fingerprint, SHA256_METADATA_KEY: sha256}
+    blob.upload_from_file(io.BytesIO(data), size=len(data), content_type=content_type)
+    return {
+        "name": os.path.basename(gcs_path),
+        "gcs_path": gcs_path,
+        "content_type": content_type,
+        "size_bytes": len(data),
+        "sha256": sha256
+    }
+
+
+def merge_pdfs(documents):
+    """
+    (しおりの見出し, PDFのバイト列) のリストを順に結合し、1つのPDFのバイト列を返します。
+    各帳票の先頭ページにしおりを付け、帳票内のしおり(部品明細書の製品ごとの見出し)はその下に配置します。
+    """
+    writer = PdfWriter()
+    for title, pdf_bytes in documents:
+        writer.append(io.BytesIO(pdf_bytes), outline_item=title)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def build_zip_bundle(files):
+    """
+    (ファイル名, バイト列) のリストをまとめたZIPのバイト列を返します。
+    PDFは圧縮済みのため、再圧縮はせずに格納のみ行います。
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+        for file_name, data in files:
+            zip_file.writestr(file_name, data)
+    return buffer.getvalue()
+
+
+def get_today():
+    """日本時間の今日の日付を返します"""
+    return datetime.now(JST).date()
+
+
+def build_estimate_context(estimate_data, issue_date):
+    """見積書テンプレート(template.html)に渡す値を組み立てます"""
+    items = [
+        {
+            "name": product.get('productName', ''),
+            "quantity": product.get('quantity', 0),
+            "unit_price": product.get('price', 0),
+            "amount": product.get('quantity', 0) * product.get('price', 0),
+        }
+        for product in estimate_data.get('products', [])
+    ]
+
+    # 小計、消費税、合計の計算
+    subtotal = estimate_data.get('totalPrice', sum(item["amount"] for item in items))
+    tax = int(subtotal * TAX_RATE)
+
+    return {
+        "client": DEFAULT_CLIENT,
+        "issuer": DEFAULT_ISSUER,
+        "issue_date": issue_date,
+        "quote_number": DEFAULT_QUOTE_NUMBER,
+        "payment_terms": DEFAULT_PAYMENT_TERMS,
+        "due_date": DEFAULT_DUE_DATE,
+        "notes": DEFAULT_NOTES,
+        "items": items,
+        "table_rows": ESTIMATE_TABLE_ROWS,
+        "calculations": {"subtotal": subtotal, "tax": tax, "total": subtotal + tax},
+    }
+
+
+def paginate_parts(parts):
+    """
+    部品の行をページごとに分割します。
+    製品の最初のページはPARTS_ROWS_FIRST_PAGE行、以降はPARTS_ROWS_PER_PAGE行ずつに区切るため、
+    同じ入力からは常に同じ位置で改ページされます。
+    """
+    pages = [parts[:PARTS_ROWS_FIRST_PAGE]]
+    for start in range(PARTS_ROWS_FIRST_PAGE, len(parts), PARTS_ROWS_PER_PAGE):
+        pages.append(parts[start:start + PARTS_ROWS_PER_PAGE])
+    return pages
+
+
+def iter_parts_breakdown_products(parts_breakdown):
+    """
+    部品明細書の製品セクションを1製品ずつ組み立てて返します。
+    テンプレートの描画中に順次呼び出されるため、ページ分割した製品セクションを全製品分まとめて保持しません。
+    """
+    for product in parts_breakdown:
+        parts = product.get('parts') or []
+        yield {
+            **product,
+            "parts_count": len(parts),
+            # 製品の合計が無い場合は部品から集計します
+            "total_quantity": product.get('total_quantity', sum(part.get('total_quantity', 0) for part in parts)),
+            "total_price": product.get('total_price', sum(part.get('total_price', 0) for part in parts)),
+            "pages": paginate_parts(parts),
+        }
+
+
+def count_parts(parts_breakdown):
+    """部品明細データに含まれる部品の合計数を返します"""
+    return sum(len(product.get('parts') or []) for product in parts_breakdown)
+
+
+def build_parts_breakdown_context(parts_breakdown, issue_date):
+    """部品明細書テンプレート(template2.html)に渡す値を組み立てます"""
+    products = iter_parts_breakdown_products(parts_breakdown)
+
+    return {
+        "issuer": DEFAULT_ISSUER,
+        "issue_date": issue_date,
+        "document_number": DEFAULT_PARTS_DOCUMENT_NUMBER,
+        "quote_number": DEFAULT_QUOTE_NUMBER,
+        "price_source": DEFAULT_PRICE_SOURCE,
+        "products": products,
+    }
+
+
+def render_estimate_html(estimate_data, issue_date=None):
+    """
+    コンパイル済みのJinja2テンプレートで見積書のHTMLを描画する
+    """
+    started_at = time.perf_counter()
+    template = get_template_entry(ESTIMATE_TEMPLATE_NAME)["template"]
+    html_content = template.render(build_estimate_context(estimate_data, issue_date or get_today()))
+    logger.info(f"Rendered estimate HTML from template in {round((time.perf_counter() - started_at) * 1000, 1)}ms")
+    return html_content
+
+
+def render_parts_breakdown_html(parts_breakdown, issue_date=None):
+    """
+    コンパイル済みのJinja2テンプレートで部品明細書のHTMLを描画する
+    """
+    started_at = time.perf_counter()
+    template = get_template_entry(PARTS_BREAKDOWN_TEMPLATE_NAME)["template"]
+    html_content = template.render(build_parts_breakdown_context(parts_breakdown, issue_date or get_today()))
+    logger.info(f"Rendered parts breakdown HTML from template in {round((time.perf_counter() - started_at) * 1000, 1)}ms")
+    return html_content
+
+
+def generate_estimate_html(estimate_data, issue_date, html_engine):
+    """
+    指定されたHTML生成方式で見積書のHTMLを生成する
+    """
+    if html_engine == "gemini":
+        if model is not None:
+            return generate_html_with_gemini(estimate_data, issue_date)
+        logger.warning("Gemini API is not configured. Rendering estimate HTML from template instead.")
+    return render_estimate_html(estimate_data, issue_date)
+
+
+def generate_parts_breakdown_html(parts_breakdown, issue_date, html_engine):
+    """
+    指定されたHTML生成方式で部品明細書のHTMLを生成する
+    """
+    if html_engine == "gemini":
+        part_count = count_parts(parts_breakdown)
+        if part_count > GEMINI_MAX_PARTS:
+            logger.warning(f"Parts breakdown has {part_count} parts (limit: {GEMINI_MAX_PARTS}). Rendering parts breakdown HTML from template instead.")
+        elif model is not None:
+            return generate_parts_breakdown_html_with_gemini(parts_breakdown, issue_date)
+        else:
+            logger.warning("Gemini API is not configured. Rendering parts breakdown HTML from template instead.")
+    return render_parts_breakdown_html(parts_breakdown, issue_date)
+
+
+def extract_html_from_response(html_content):
+    """
+    Geminiの応答からHTMLドキュメントを取り出す
+    """
+    # HTMLタグで囲まれていない場合の処理
+    if not html_content.strip().startswith('<!DOCTYPE html>'):
+        # コードブロックから抽出
+        if '```html' in html_content:
+            html_content = html_content.split('```html')[1].split('```')[0].strip()
+        elif '```' in html_content:
+            html_content = html_content.split('```')[1].split('```')[0].strip()
+    return html_content
+
+
+def build_gemini_cache_key(document_kind, template_name, payload, issue_date):
+    """
+    テンプレートのバージョン・リクエスト内容・発行日などを正規化したJSONのハッシュからキャッシュキーを計算します
+    """
+    canonical = json.dumps({
+        "document": document_kind,
+        "template_version": get_template_entry(template_name)["version"],
+        "prompt_version": GEMINI_PROMPT_VERSION,
+        "model": GEMINI_MODEL_NAME,
+        "issue_date": issue_date.isoformat(),
+        "payload": payload,
+    }, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def build_gemini_cache_object_name(cache_key):
+    """GCS上のキャッシュオブジェクト名を返します"""
+    return f"{GEMINI_CACHE_PREFIX}/{cache_key}.html"
+
+
+def get_cached_gemini_html(cache_key):
+    """
+    キャッシュ済みの生成結果を返します (無い場合、またはGEMINI_CACHE_TTL_SECを過ぎた場合はNone)。
+    メモリ上のキャッシュに無い場合は、GEMINI_CACHE_BUCKETが設定されていればGCSも確認します。
+    """
+    now = time.time()
+    with _gemini_html_cache_lock:
+        entry = _gemini_html_cache.get(cache_key)
+        if entry is not None:
+            if now - entry["created_at"] < GEMINI_CACHE_TTL_SEC:
+                _gemini_html_cache.move_to_end(cache_key)
+                return entry["html"]
+            del _gemini_html_cache[cache_key]
+
+    if not GEMINI_CACHE_BUCKET:
+        return None
+
+    try:
+        blob = storage_client.bucket(GEMINI_CACHE_BUCKET).get_blob(build_gemini_cache_object_name(cache_key))
+        if blob is None or now - blob.time_created.timestamp() >= GEMINI_CACHE_TTL_SEC:
+            return None
+        html_content = blob.download_as_text(encoding='utf-8')
+    except Exception as e:
+        # キャッシュの読み込み失敗ではリクエストを失敗させません
+        logger.warning(f"Failed to read Gemini HTML cache from GCS: {e}")
+        return None
+
+    store_in_memory_cache(cache_key, html_content, blob.time_created.timestamp())
+    return html_content
+
+
+def store_in_memory_cache(cache_key, html_content, created_at):
+    """メモリ上のキャッシュに保存し、GEMINI_CACHE_MAX_ENTRIESを超えた分を古い順に削除します"""
+    with _gemini_html_cache_lock:
+        _gemini_html_cache[cache_key] = {"html": html_content, "created_at": created_at}
+        _gemini_html_cache.move_to_end(cache_key)
+        while len(_gemini_html_cache) > GEMINI_CACHE_MAX_ENTRIES:
+            _gemini_html_cache.popitem(last=False)
+
+
+def save_gemini_html_to_cache(cache_key, html_content):
+    """生成結果をメモリ上のキャッシュと (設定されていれば) GCSに保存します"""
+    store_in_memory_cache(cache_key, html_content, time.time())
+
+    if GEMINI_CACHE_BUCKET:
+        try:
+            storage_client.bucket(GEMINI_CACHE_BUCKET).blob(build_gemini_cache_object_name(cache_key)).upload_from_string(html_content, content_type='text/html; charset=utf-8')
         except Exception as e:
-            logger.error(f"An error occurred during document generation: {e}")
-            return jsonify({
-                "status": "error",
-                "message": f"Document generation failed: {str(e)}"
-            }), 500
+            logger.warning(f"Failed to write Gemini HTML cache to GCS: {e}")
+
+
+def inspect_streamed_html(text, last_chunk):
+    """
+    ストリーミングで受信途中のGeminiの応答を検査します。
+    </html> まで受信済みならTrue、受信途中ならFalseを返し、HTMLとして明らかに不正な場合はValueErrorを送出します。
+    """
+    if len(text) > GEMINI_MAX_HTML_CHARS:
+        raise ValueError(f"Gemini response exceeded {GEMINI_MAX_HTML_CHARS} characters")
+
+    head = text.lstrip()[:GEMINI_STREAM_VALIDATION_CHARS]
+    if len(head) >= GEMINI_STREAM_VALIDATION_CHARS and not GEMINI_HTML_START_PATTERN.search(head):
+        raise ValueError(f"Gemini response does not start with an HTML document: {head[:80]!r}")
+
+    # 終了タグが前回のチャンクとの境界にまたがる場合も検出できるよう、末尾だけを確認します
+    return '</html>' in text[-(len(last_chunk) + len('</html>')):].lower()
 
 
-def generate_html_with_gemini(estimate_data):
+def stream_html_from_gemini(prompt):
     """
-    Gemini APIを使用して見積書のHTMLを動的生成する
+    Geminiの応答をストリーミングで受信してHTMLドキュメントを生成します。
+    </html> を受信した時点で残りの応答を待たずに返します。
+    """
+    started_at = time.monotonic()
+    deadline = started_at + GEMINI_LATENCY_BUDGET_SEC
+    # チャンク間で待ち続けないよう、API呼び出し自体にもタイムアウトを設定します
+    response = model.generate_content(
+        prompt,
+        stream=True,
+        request_options={"timeout": GEMINI_LATENCY_BUDGET_SEC}
+    )
+
+    text = ""
+    completed = False
+    for chunk in response:
+        text += chunk.text
+        if inspect_streamed_html(text, chunk.text):
+            completed = True
+            break
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Gemini response exceeded the latency budget of {GEMINI_LATENCY_BUDGET_SEC}s")
+
+    if not completed:
+        raise ValueError("Gemini response ended before </html>")
+
+    logger.info(f"Gemini streaming completed: chars={len(text)}, elapsed_ms={(time.monotonic() - started_at) * 1000:.0f}")
+    return extract_html_from_response(text)
+
+
+def request_html_from_gemini(prompt, cache_key):
+    """
+    Geminiにプロンプトを送信してHTMLドキュメントを生成します。
+    同じキャッシュキーの生成結果があればGeminiを呼ばずにそれを返します。
+    """
+    cached_html = get_cached_gemini_html(cache_key)
+    if cached_html is not None:
+        logger.info(f"Gemini HTML cache hit: key={cache_key}")
+        return cached_html
+
+    if GEMINI_STREAMING:
+        html_content = stream_html_from_gemini(prompt)
+    else:
+        response = model.generate_content(prompt)
+        html_content = extract_html_from_response(response.text)
+
+    # HTMLドキュメントとして不完全な応答はキャッシュしません
+    if '<html' in html_content.lower():
+        save_gemini_html_to_cache(cache_key, html_content)
+    return html_content
+
+
+def generate_html_with_gemini(estimate_data, issue_date=None):
+    """
+    Gemini APIを使用して見積書のHTMLを動的生成する (htmlEngine: gemini の場合のみ使用)
     """
     logger.info("Starting HTML generation with Gemini API")
+    issue_date = issue_date or get_today()
     
-    # template.htmlを読み込み
-    template_path = os.path.join(os.path.dirname(__file__), 'template.html')
-    with open(template_path, 'r', encoding='utf-8') as f:
-        template_content = f.read()
+    # 読み込み済みのtemplate.htmlを使用
+    template_content = get_template_entry(ESTIMATE_TEMPLATE_NAME)["source"]
     
     # Gemini用のプロンプトを作成
     prompt = f"""
@@ -288,133 +1083,45 @@ def generate_html_with_gemini(estimate_data):
 1. テンプレートのJinja2変数を実際の値に置き換えてください
 2. estimate_data.products配列の各要素を明細行として表示してください
 3. 合計金額はestimate_data.totalPriceを使用してください
-4. 発行日は今日の日付を使用してください
+4. 発行日は {format_date(issue_date)} を使用してください
 5. 発行者情報は以下のデフォルト値を使用してください：
-   - 会社名: "株式会社サンプル"
-   - 住所: "〒100-0001 東京都千代田区千代田1-1-1"
-   - 電話: "03-1234-5678"
-   - メール: "info@sample.co.jp"
+   - 会社名: "{DEFAULT_ISSUER['name']}"
+   - 住所: "{DEFAULT_ISSUER['zip_code']} {DEFAULT_ISSUER['address']}"
+   - 電話: "{DEFAULT_ISSUER['tel']}"
+   - メール: "{DEFAULT_ISSUER['email']}"
 6. 顧客情報は以下のデフォルト値を使用してください：
-   - 会社名: "お客様会社名"
-   - 担当者: "ご担当者"
-   - 住所: "〒000-0000 住所未設定"
-7. 支払条件: "月末締め翌月末払い"
-8. 有効期限: "発行日から30日間"
-9. 備考: "ご不明な点がございましたらお気軽にお問い合わせください。"
+   - 会社名: "{DEFAULT_CLIENT['name']}"
+   - 担当者: "{DEFAULT_CLIENT['contact_person']}"
+   - 住所: "{DEFAULT_CLIENT['zip_code']} {DEFAULT_CLIENT['address_line1']}"
+7. 支払条件: "{DEFAULT_PAYMENT_TERMS}"
+8. 有効期限: "{DEFAULT_DUE_DATE}"
+9. 備考: "{DEFAULT_NOTES}"
 
 完全なHTMLドキュメントのみを返してください。説明や追加のテキストは不要です。
 """
 
     try:
-        response = model.generate_content(prompt)
-        html_content = response.text
-        
-        # HTMLタグで囲まれていない場合の処理
-        if not html_content.strip().startswith('<!DOCTYPE html>'):
-            # コードブロックから抽出
-            if '```html' in html_content:
-                html_content = html_content.split('```html')[1].split('```')[0].strip()
-            elif '```' in html_content:
-                html_content = html_content.split('```')[1].split('```')[0].strip()
+        cache_key = build_gemini_cache_key("estimate", ESTIMATE_TEMPLATE_NAME, estimate_data, issue_date)
+        html_content = request_html_from_gemini(prompt, cache_key)
         
         logger.info("HTML generation completed successfully")
         return html_content
         
     except Exception as e:
         logger.error(f"Error generating HTML with Gemini: {e}")
-        # フォールバック: 簡単なテンプレート処理
-        return generate_html_fallback(estimate_data)
+        # フォールバック: テンプレートで描画
+        return render_estimate_html(estimate_data, issue_date)
 
 
-def generate_html_fallback(estimate_data):
-    """
-    Gemini APIが失敗した場合のフォールバック処理
+def generate_parts_breakdown_html_with_gemini(parts_breakdown, issue_date=None):
     """
-    logger.info("Using fallback HTML generation")
-    
-    # 現在の日付
-    current_date = datetime.now().strftime('%Y年%m月%d日')
-    
-    # 明細行の生成
-    items_html = ""
-    for product in estimate_data['products']:
-        items_html += f"""
-        <tr>
-            <td>{product['productName']}</td>
-            <td class="text-right">{product['quantity']}</td>
-            <td class="text-right">¥{product['price']:,}</td>
-            <td class="text-right">¥{product['quantity'] * product['price']:,}</td>
-        </tr>
-        """
-    
-    # 空白行の追加（最大12行まで）
-    for i in range(12 - len(estimate_data['products'])):
-        items_html += """
-        <tr>
-            <td>&nbsp;</td>
-            <td></td>
-            <td></td>
-            <td></td>
-        </tr>
-        """
-    
-    # 小計、消費税、合計の計算
-    subtotal = estimate_data['totalPrice']
-    tax = int(subtotal * 0.1)  # 10%の消費税
-    total = subtotal + tax
-    
-    # HTMLテンプレートの読み込みと置換
-    template_path = os.path.join(os.path.dirname(__file__), 'template.html')
-    with open(template_path, 'r', encoding='utf-8') as f:
-        template_content = f.read()
-    
-    # 簡単な文字列置換
-    html_content = template_content.replace('{{ client.zip_code }}', '〒000-0000')
-    html_content = html_content.replace('{{ client.address_line1 }}', '住所未設定')
-    html_content = html_content.replace('{{ client.address_line2 }}', '')
-    html_content = html_content.replace('{{ client.name }}', 'お客様会社名')
-    html_content = html_content.replace('{{ client.contact_person }}', 'ご担当者')
-    html_content = html_content.replace('{{ issue_date }}', current_date)
-    html_content = html_content.replace('{{ quote_number }}', 'EST-001')
-    html_content = html_content.replace('{{ issuer.name }}', '株式会社サンプル')
-    html_content = html_content.replace('{{ issuer.zip_code }}', '〒100-0001')
-    html_content = html_content.replace('{{ issuer.address }}', '東京都千代田区千代田1-1-1')
-    html_content = html_content.replace('{{ issuer.tel }}', '03-1234-5678')
-    html_content = html_content.replace('{{ issuer.email }}', 'info@sample.co.jp')
-    html_content = html_content.replace('{{ calculations.total | currency }}', f'{total:,}')
-    html_content = html_content.replace('{{ payment_terms }}', '月末締め翌月末払い')
-    html_content = html_content.replace('{{ due_date }}', '発行日から30日間')
-    html_content = html_content.replace('{{ calculations.subtotal | currency }}', f'{subtotal:,}')
-    html_content = html_content.replace('{{ calculations.tax | currency }}', f'{tax:,}')
-    html_content = html_content.replace('{{ notes }}', 'ご不明な点がございましたらお気軽にお問い合わせください。')
-    
-    # Jinja2のfor文を削除して明細行を直接挿入
-    items_section_start = html_content.find('<!-- 明細行 -->')
-    items_section_end = html_content.find('<!-- 空白行（テーブルの高さを一定に保つため） -->')
-    
-    if items_section_start != -1 and items_section_end != -1:
-        before_items = html_content[:items_section_start]
-        after_items = html_content[items_section_end:]
-        
-        # 空白行セクションの終了位置を見つける
-        empty_rows_end = after_items.find('<!-- 合計欄 -->')
-        if empty_rows_end != -1:
-            after_items = after_items[empty_rows_end:]
-        
-        html_content = before_items + f"<!-- 明細行 -->\n{items_html}\n" + after_items
-    
-    return html_content
-
-def generate_parts_breakdown_html_with_gemini(parts_breakdown):
-    """
-    Gemini APIを使用して部品明細書のHTMLを動的生成する
+    Gemini APIを使用して部品明細書のHTMLを動的生成する (htmlEngine: gemini の場合のみ使用)
     """
     logger.info("Starting parts breakdown HTML generation with Gemini API")
+    issue_date = issue_date or get_today()
     
-    # template2.htmlを読み込み
-    template_path = os.path.join(os.path.dirname(__file__), 'template2.html')
-    with open(template_path, 'r', encoding='utf-8') as f:
-        template_content = f.read()
+    # 読み込み済みのtemplate2.htmlを使用
+    template_content = get_template_entry(PARTS_BREAKDOWN_TEMPLATE_NAME)["source"]
     
     # Gemini用のプロンプトを作成
     prompt = f"""
@@ -424,155 +1131,38 @@ def generate_parts_breakdown_html_with_gemini(parts_breakdown):
 {template_content}
 
 【部品明細データ】
-{json.dumps(parts_breakdown, ensure_ascii=False, indent=2)}
+{json.dumps(parts_breakdown, ensure_ascii=False, separators=(',', ':'))}
 
 【指示】
 1. テンプレートのJinja2変数を実際の値に置き換えてください
 2. parts_breakdown配列の各要素を製品セクションとして表示してください
-3. 各製品の部品配列を明細テーブルとして表示してください
-4. 発行日は今日の日付を使用してください
+3. 各製品の部品配列を明細テーブルとして表示してください。製品の最初の表は{PARTS_ROWS_FIRST_PAGE}行、以降は{PARTS_ROWS_PER_PAGE}行ごとに表を分割して改ページし、製品合計行は最後の表にのみ表示してください
+4. 発行日は {format_date(issue_date)} を使用してください
 5. 発行者情報は以下のデフォルト値を使用してください：
-   - 会社名: "株式会社サンプル"
-   - 住所: "〒100-0001 東京都千代田区千代田1-1-1"
-   - 電話: "03-1234-5678"
-   - メール: "info@sample.co.jp"
-6. 文書番号: "PARTS-001"
-7. 関連見積書: "EST-001"
-8. price_source: "AI推定価格"
+   - 会社名: "{DEFAULT_ISSUER['name']}"
+   - 住所: "{DEFAULT_ISSUER['zip_code']} {DEFAULT_ISSUER['address']}"
+   - 電話: "{DEFAULT_ISSUER['tel']}"
+   - メール: "{DEFAULT_ISSUER['email']}"
+6. 文書番号: "{DEFAULT_PARTS_DOCUMENT_NUMBER}"
+7. 関連見積書: "{DEFAULT_QUOTE_NUMBER}"
+8. price_source: "{DEFAULT_PRICE_SOURCE}"
 
 完全なHTMLドキュメントのみを返してください。説明や追加のテキストは不要です。
 """
 
     try:
-        response = model.generate_content(prompt)
-        html_content = response.text
-        
-        # HTMLタグで囲まれていない場合の処理
-        if not html_content.strip().startswith('<!DOCTYPE html>'):
-            # コードブロックから抽出
-            if '```html' in html_content:
-                html_content = html_content.split('```html')[1].split('```')[0].strip()
-            elif '```' in html_content:
-                html_content = html_content.split('```')[1].split('```')[0].strip()
+        cache_key = build_gemini_cache_key("parts_breakdown", PARTS_BREAKDOWN_TEMPLATE_NAME, parts_breakdown, issue_date)
+        html_content = request_html_from_gemini(prompt, cache_key)
         
         logger.info("Parts breakdown HTML generation completed successfully")
         return html_content
         
     except Exception as e:
         logger.error(f"Error generating parts breakdown HTML with Gemini: {e}")
-        # フォールバック: 簡単なテンプレート処理
-        return generate_parts_breakdown_html_fallback(parts_breakdown)
+        # フォールバック: テンプレートで描画
+        return render_parts_breakdown_html(parts_breakdown, issue_date)
 
 
-def generate_parts_breakdown_html_fallback(parts_breakdown):
-    """
-    Gemini APIが失敗した場合の部品明細書フォールバック処理
-    """
-    logger.info("Using fallback parts breakdown HTML generation")
-    
-    # 現在の日付
-    current_date = datetime.now().strftime('%Y年%m月%d日')
-    
-    # HTMLテンプレートの読み込み
-    template_path = os.path.join(os.path.dirname(__file__), 'template2.html')
-    with open(template_path, 'r', encoding='utf-8') as f:
-        template_content = f.read()
-    
-    # 製品セクションの生成
-    products_html = ""
-    for i, product in enumerate(parts_breakdown):
-        page_break_class = "page-break" if i > 0 else ""
-        
-        # 部品テーブルの生成
-        parts_rows = ""
-        total_price = 0
-        for part in product.get('parts', []):
-            category_class = ""
-            if part.get('category') == '金属部品':
-                category_class = "category-metal"
-            elif part.get('category') == '樹脂部品':
-                category_class = "category-resin"
-            elif part.get('category') == '電子部品':
-                category_class = "category-electronic"
-            else:
-                category_class = "category-other"
-            
-            parts_rows += f"""
-            <tr class="{category_class}">
-              <td class="col-category">{part.get('category', '')}</td>
-              <td class="col-name">{part.get('part_name', '')}</td>
-              <td class="col-description">{part.get('part_description', '')}</td>
-              <td class="col-material">{part.get('material', '')}</td>
-              <td class="col-quantity">{part.get('total_quantity', 0)}</td>
-              <td class="col-unit-price">¥{part.get('estimated_unit_price', 0):,}</td>
-              <td class="col-total-price">¥{part.get('total_price', 0):,}</td>
-            </tr>
-            """
-            total_price += part.get('total_price', 0)
-        
-        products_html += f"""
-        <div class="product-section {page_break_class}">
-          <div class="product-header">
-            {product.get('product_name', '')} - 部品構成明細
-          </div>
-
-          <div class="product-summary">
-            <div class="summary-item">
-              <div class="summary-label">製品数量</div>
-              <div class="summary-value">{product.get('product_quantity', 0)}個</div>
-            </div>
-            <div class="summary-item">
-              <div class="summary-label">部品総数</div>
-              <div class="summary-value">{len(product.get('parts', []))}種類</div>
-            </div>
-            <div class="summary-item">
-              <div class="summary-label">総部品数量</div>
-              <div class="summary-value">{sum(part.get('total_quantity', 0) for part in product.get('parts', []))}個</div>
-            </div>
-          </div>
-
-          <table class="parts-table">
-            <thead>
-              <tr>
-                <th class="col-category">カテゴリ</th>
-                <th class="col-name">部品名</th>
-                <th class="col-description">説明</th>
-                <th class="col-material">材質</th>
-                <th class="col-quantity">数量</th>
-                <th class="col-unit-price">単価(円)</th>
-                <th class="col-total-price">合計金額(円)</th>
-              </tr>
-            </thead>
-            <tbody>
-              {parts_rows}
-              
-              <!-- 製品合計行 -->
-              <tr class="total-row">
-                <td colspan="6" style="text-align: center;">{product.get('product_name', '')} 合計</td>
-                <td class="col-total-price">¥{total_price:,}</td>
-              </tr>
-            </tbody>
-          </table>
-        </div>
-        """
-    
-    # 変数の置換
-    html_content = template_content.replace('{{ issuer.name }}', '株式会社サンプル')
-    html_content = html_content.replace('{{ issuer.address }}', '〒100-0001 東京都千代田区千代田1-1-1')
-    html_content = html_content.replace('{{ issuer.tel }}', '03-1234-5678')
-    html_content = html_content.replace('{{ issuer.email }}', 'info@sample.co.jp')
-    html_content = html_content.replace('{{ issue_date }}', current_date)
-    html_content = html_content.replace('{{ document_number }}', 'PARTS-001')
-    html_content = html_content.replace('{{ quote_number }}', 'EST-001')
-    html_content = html_content.replace('{{ price_source }}', 'AI推定価格')
-    
-    # 製品セクションを挿入
-    products_section_start = html_content.find('<!-- 各製品の部品明細 -->')
-    products_section_end = html_content.find('<div class="footer-info">')
-    
-    if products_section_start != -1 and products_section_end != -1:
-        before_products = html_content[:products_section_start]
-        after_products = html_content[products_section_end:]
-        html_content = before_products + f"<!-- 各製品の部品明細 -->\n{products_html}\n\n" + after_products
-    
-    return html_content
\ No newline at end of file
+# PDF変換のワーカープロセスを起動時に立ち上げておき、最初のリクエストでプロセス起動・フォント読み込みのコストを払わないようにします
+if PDF_RENDERER == "weasyprint":
+    warm_up_pdf_render_pool()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+HTML→PDF変換の方式を比較するベンチマークスクリプト
+
+比較する方式:
+- fork:   帳票ごとにwkhtmltopdfを起動し、一時ファイル経由で変換 (従来の pdfkit.from_file)
+- pooled: 常駐ワーカープロセス内でWeasyPrintを使って変換 (app.py の PDF_RENDERER=weasyprint)
+
+どちらもHTMLを渡してPDFのバイト列を受け取るまでを1帳票のレイテンシとして計測し、
+p50 / p99 / 平均 と、変換プロセスのメモリ使用量(最大RSS)を出力します。
+
+使用方法:
+    python benchmark_pdf_renderer.py --iterations 10 --workers 4
+    python benchmark_pdf_renderer.py path/to/html_dir --iterations 10
+
+HTMLのディレクトリを省略した場合は、このディレクトリ直下の *.html (test_estimate_*.html など) を使用します。
+GCSやGemini APIには接続しません (wkhtmltopdf と weasyprint が必要です)。
+"""
+
+import os
+import sys
+import glob
+import math
+import time
+import argparse
+import resource
+import tempfile
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
+import pdfkit
+from weasyprint import HTML
+
+# app.py の PDF_OPTIONS と同じ変換オプション
+PDF_OPTIONS = {
+    'page-size': 'A4',
+    'margin-top': '0.75in',
+    'margin-right': '0.75in',
+    'margin-bottom': '0.75in',
+    'margin-left': '0.75in',
+    'encoding': "UTF-8",
+    'no-outline': None,
+    'enable-local-file-access': None,
+    'quiet': None
+}
+
+
+def percentile(values, ratio):
+    """最近傍順位法でパーセンタイル値を返します"""
+    ordered = sorted(values)
+    index = max(0, math.ceil(ratio * len(ordered)) - 1)
+    return ordered[index]
+
+
+def get_rss_mb(pid):
+    """/proc からプロセスの現在のRSS(MB)を取得します"""
+    with open(f"/proc/{pid}/status", 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def render_with_fork(html_content):
+    """wkhtmltopdfを起動し、一時ファイル経由でHTMLをPDFに変換します (従来方式)"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        html_path = os.path.join(tmp_dir, "document.html")
+        pdf_path = os.path.join(tmp_dir, "document.pdf")
+        with open(html_path, 'w', encoding='utf-8') as f:
+            f.write(html_content)
+        pdfkit.from_file(html_path, pdf_path, options=PDF_OPTIONS)
+        with open(pdf_path, 'rb') as f:
+            return f.read()
+
+
+def initialize_worker():
+    """ワーカープロセスで日本語を含むHTMLを1度変換し、フォントを読み込んでおきます"""
+    HTML(string='<p>見積書 部品明細書 ¥0</p>').write_pdf()
+
+
+def render_with_weasyprint(html_content):
+    """常駐ワーカー内でWeasyPrintを使ってHTMLをPDFに変換します"""
+    return HTML(string=html_content).write_pdf()
+
+
+def run_benchmark(name, render, corpus, iterations):
+    """全帳票をiterations回変換し、1帳票ごとのレイテンシ(ms)を返します"""
+    latencies = []
+    for iteration in range(iterations):
+        for html_name, html_content in corpus:
+            started_at = time.perf_counter()
+            pdf_bytes = render(html_content)
+            latencies.append((time.perf_counter() - started_at) * 1000)
+            if not pdf_bytes.startswith(b'%PDF'):
+                raise RuntimeError(f"{name}: invalid output for {html_name}")
+        print(f"   ⏱️ {name}: iteration {iteration + 1}/{iterations} completed")
+    return latencies
+
+
+def print_report(name, latencies, memory):
+    """レイテンシとメモリ使用量の統計を出力します"""
+    print(
+        f"{name:>8}: documents={len(latencies):5d}  "
+        f"p50={percentile(latencies, 0.50):8.1f}ms  "
+        f"p99={percentile(latencies, 0.99):8.1f}ms  "
+        f"mean={statistics.mean(latencies):8.1f}ms  "
+        f"memory={memory}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fork-per-call (wkhtmltopdf) と pooled (WeasyPrint) のHTML→PDF変換の比較")
+    parser.add_argument("html_dir", nargs="?", default=os.path.dirname(os.path.abspath(__file__)), help="ベンチマークに使うHTMLを置いたディレクトリ")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    html_paths = sorted(glob.glob(os.path.join(args.html_dir, "*.html")))
+    if not html_paths:
+        print(f"❌ HTMLが見つかりません: {args.html_dir}")
+        sys.exit(1)
+
+    corpus = []
+    for html_path in html_paths:
+        with open(html_path, 'r', encoding='utf-8') as f:
+            corpus.append((os.path.basename(html_path), f.read()))
+
+    print(f"🚀 Corpus: {len(corpus)} HTML documents, iterations={args.iterations}, workers={args.workers}")
+
+    fork_latencies = run_benchmark("fork", render_with_fork, corpus, args.iterations)
+    # 子プロセス(wkhtmltopdf)のうち最大のRSS (Linuxではru_maxrssの単位はKB)
+    fork_memory = f"max child RSS {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f}MB per call"
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=initialize_worker) as pool:
+        # 計測前に全ワーカーを起動しておきます
+        worker_pids = {future.result() for future in [pool.submit(os.getpid) for _ in range(args.workers)]}
+        startup_rss = sum(get_rss_mb(pid) for pid in worker_pids)
+
+        pooled_latencies = run_benchmark(
+            "pooled",
+            lambda html_content: pool.submit(render_with_weasyprint, html_content).result(),
+            corpus,
+            args.iterations
+        )
+        pooled_rss = sum(get_rss_mb(pid) for pid in worker_pids)
+        pooled_memory = f"{len(worker_pids)} resident workers {startup_rss:.1f}MB at startup / {pooled_rss:.1f}MB after run"
+
+    print()
+    print("📊 Results (per-document latency)")
+    print_report("fork", fork_latencies, fork_memory)
+    print_report("pooled", pooled_latencies, pooled_memory)
+
+
+if __name__ == "__main__":
+    main()
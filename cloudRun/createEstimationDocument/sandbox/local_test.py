@@ -78,8 +78,8 @@ def test_html_generation():
     
     try:
         # app.pyから関数をインポート
-        from app import generate_html_with_gemini, generate_html_fallback
-        from app import generate_parts_breakdown_html_with_gemini, generate_parts_breakdown_html_fallback
+        from app import generate_html_with_gemini, render_estimate_html
+        from app import generate_parts_breakdown_html_with_gemini, render_parts_breakdown_html
         
         success_count = 0
         total_tests = 2
@@ -92,10 +92,10 @@ def test_html_generation():
             generation_method = "Gemini API"
         except Exception as e:
             print(f"⚠️  Gemini APIでの生成に失敗: {e}")
-            print("🔄 フォールバック処理で見積書HTML生成を試行...")
-            estimate_html = generate_html_fallback(estimate_data)
-            print("✅ フォールバック処理での見積書HTML生成が成功しました！")
-            generation_method = "Fallback"
+            print("🔄 テンプレートで見積書HTML生成を試行...")
+            estimate_html = render_estimate_html(estimate_data)
+            print("✅ テンプレートでの見積書HTML生成が成功しました！")
+            generation_method = "Template"
         
         # 見積書HTMLをファイルに保存
         estimate_filename = f"test_estimate_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
@@ -120,10 +120,10 @@ def test_html_generation():
             parts_generation_method = "Gemini API"
         except Exception as e:
             print(f"⚠️  Gemini APIでの生成に失敗: {e}")
-            print("🔄 フォールバック処理で部品明細書HTML生成を試行...")
-            parts_html = generate_parts_breakdown_html_fallback(parts_breakdown)
-            print("✅ フォールバック処理での部品明細書HTML生成が成功しました！")
-            parts_generation_method = "Fallback"
+            print("🔄 テンプレートで部品明細書HTML生成を試行...")
+            parts_html = render_parts_breakdown_html(parts_breakdown)
+            print("✅ テンプレートでの部品明細書HTML生成が成功しました！")
+            parts_generation_method = "Template"
         
         # 部品明細書HTMLをファイルに保存
         parts_filename = f"test_parts_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
@@ -22,6 +22,8 @@ load_dotenv()
 # 通常の絶対インポート
 from firestore_helper import FirestoreHelper
 from gcs_helper import GCSHelper
+from id_token_helper import IdTokenProvider
+from http_session_helper import create_http_session
 from step1_pdf_download_test import execute_pdf_download_test
 from step2_download_target_pdf_assets import (
     get_analysis_json_from_step1_output,
@@ -75,6 +77,14 @@ def get_credentials_from_env():
 # Vertex AI/Google認証の初期化
 credentials, project = get_credentials_from_env()
 
+# Cloud Run呼び出し用のIDトークンのキャッシュ（有効期限の少し前まで使い回します）
+id_token_provider = IdTokenProvider()
+
+# Cloud Run呼び出し用のHTTPセッション（接続を使い回し、429/503はバックオフして再試行します）
+http_session = create_http_session()
+# 見積書生成APIのタイムアウト (接続, 読み取り) 秒
+ESTIMATE_GENERATION_API_TIMEOUT = (10, 300)
+
 def get_firestore_helper():
     """統一されたFirestoreHelperインスタンスを取得します（環境変数ベース）"""
     # FirestoreHelperにデフォルトパスを渡すが、実際は環境変数から認証情報を取得
@@ -823,19 +833,13 @@ def generate_api_request_body(parts_breakdown: list, document_id: str, user_inst
         }
 
 def get_cloud_run_auth_headers_for_agent(target_url: str) -> dict:
-    """Cloud Run認証用のヘッダーを取得（agent.py用）"""
+    """Cloud Run認証用のヘッダーを取得（agent.py用）
+
+    IDトークンはURLごとにキャッシュし、有効期限が近づいたものだけを取得し直します。
+    """
     try:
-        from google.oauth2 import id_token
-        from google.auth.transport.requests import Request
-        
-        print(f"🔐 IDトークン取得を試行中 for URL: {target_url}")
-        
-        # IDトークンを取得（Cloud Run認証用）
-        auth_req = Request()
-        id_token_value = id_token.fetch_id_token(auth_req, target_url)
-        
-        print(f"✅ IDトークンを正常に取得しました")
-        
+        id_token_value = id_token_provider.get_token(target_url)
+
         return {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {id_token_value}"
@@ -844,16 +848,15 @@ def get_cloud_run_auth_headers_for_agent(target_url: str) -> dict:
         print(f"❌ IDトークン取得エラー: {e}")
         print(f"   🔍 エラータイプ: {type(e)}")
         
-        # フォールバック: 既に取得済みのcredentialsを使用
+        # フォールバック: 既に取得済みのcredentialsを使用（期限切れの場合のみ更新）
         try:
             print("🔄 フォールバック: 既に取得済みのcredentialsを使用")
-            auth_req = Request()
-            credentials.refresh(auth_req)
+            access_token = id_token_provider.get_access_token(credentials)
             
             print(f"✅ 既存のcredentialsからアクセストークンを取得しました")
             return {
                 "Content-Type": "application/json",
-                "Authorization": f"Bearer {credentials.token}"
+                "Authorization": f"Bearer {access_token}"
             }
         except Exception as e2:
             print(f"❌ 認証取得エラー: {e2}")
@@ -890,11 +893,11 @@ def call_estimate_generation_api(request_body: dict) -> dict:
             print(f"   🔐 DEBUG: Token length: {len(auth_header.split(' ', 1)[1]) if ' ' in auth_header else 0} characters")
         
         # APIリクエスト送信
-        response = requests.post(
+        response = http_session.post(
             url=api_url,
             headers=headers,
             json=request_body,
-            timeout=300  # 5分のタイムアウト
+            timeout=ESTIMATE_GENERATION_API_TIMEOUT  # 接続10秒、応答5分のタイムアウト
         )
         
         print(f"   📊 Response status code: {response.status_code}")
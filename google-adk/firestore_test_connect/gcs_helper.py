@@ -91,4 +91,23 @@ class GCSHelper:
             
         except Exception as e:
             print(f"ダウンロードURLの生成に失敗しました: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    def download_json(self, gcs_file_path: str) -> dict:
+        """GCS上のJSONファイルをダウンロードして辞書として返します。
+
+        Args:
+            gcs_file_path (str): GCS上のファイルパス
+
+        Returns:
+            dict: JSONの内容（ファイルが存在しない場合はNone）
+        """
+        try:
+            blob = self.bucket.blob(gcs_file_path)
+            if not blob.exists():
+                return None
+            return json.loads(blob.download_as_bytes())
+            
+        except Exception as e:
+            print(f"JSONファイルのダウンロードに失敗しました: {e}")
+            return None
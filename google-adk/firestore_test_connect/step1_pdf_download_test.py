@@ -93,6 +93,45 @@ def get_pdf_file_path_from_firestore(document_id: str = "adk",collection_name: s
             "error_message": f"PDFファイルパス取得中にエラーが発生しました: {str(e)}"
         }
 
+def get_text_sidecar_path(pdf_file_path: str) -> str:
+    """PDF変換サービスが保存するテキスト抽出結果（JSONサイドカー）のGCSパスを返します。
+
+    backend の変換ジョブは .../pdf/blueprint.pdf を .../png/blueprint.png に変換し、
+    その隣に .../png/blueprint_text.json を保存します。
+
+    Args:
+        pdf_file_path (str): GCS上のPDFファイルパス
+
+    Returns:
+        str: テキスト抽出結果のGCSパス
+    """
+    pdf_dir, pdf_name = os.path.split(pdf_file_path)
+    stem = os.path.splitext(pdf_name)[0]
+    return f"{os.path.dirname(pdf_dir)}/png/{stem}_text.json"
+
+def summarize_text_sidecar(text_sidecar: dict) -> dict:
+    """テキスト抽出結果から、後続のLLMステップに渡すページごとのテキストと寸法注記だけを抜き出します。
+
+    Args:
+        text_sidecar (dict): 変換サービスが保存したテキスト抽出結果
+
+    Returns:
+        dict: ページ数とページごとのテキスト・寸法注記
+    """
+    return {
+        "page_count": text_sidecar["page_count"],
+        "pages": [
+            {
+                "page": page["page"],
+                "width_pt": page["width"],
+                "height_pt": page["height"],
+                "text": page["text"],
+                "dimensions": [dimension["text"] for dimension in page["dimensions"]]
+            }
+            for page in text_sidecar["pages"]
+        ]
+    }
+
 def generate_download_url_and_analyze(pdf_file_path: str) -> dict:
     """GCSファイルパスからダウンロード可能なURLを生成し、ファイル内容を解析してコメントします。
 
@@ -134,8 +173,15 @@ def generate_download_url_and_analyze(pdf_file_path: str) -> dict:
             "access_method": "direct_url"
         }
         
+        # 変換サービスがテキスト抽出結果を保存済みであれば、バイナリの走査ではなくそちらを使用
+        text_sidecar = gcs_helper.download_json(get_text_sidecar_path(pdf_file_path))
+        text_summary = summarize_text_sidecar(text_sidecar) if text_sidecar else None
+        if text_summary:
+            pdf_info["page_count"] = text_summary["page_count"]
+            print(f"DEBUG: Loaded text sidecar: {text_summary['page_count']} pages")
+        
         # ファイル内容の解析とコメント生成
-        analysis_comment = analyze_and_comment_on_file(pdf_blob, pdf_file_path)
+        analysis_comment = analyze_and_comment_on_file(pdf_blob, pdf_file_path, text_summary)
         
         print(f"DEBUG: File analysis completed. Size: {pdf_info['file_size_mb']}MB")
         
@@ -144,6 +190,7 @@ def generate_download_url_and_analyze(pdf_file_path: str) -> dict:
             "download_url": download_url,
             "pdf_info": pdf_info,
             "analysis_comment": analysis_comment,
+            "text_summary": text_summary,
             "message": f"ファイルURL生成と解析が完了しました（{pdf_info['file_size_mb']}MB）"
         }
         
@@ -153,12 +200,13 @@ def generate_download_url_and_analyze(pdf_file_path: str) -> dict:
             "error_message": f"URL生成・ファイル解析中にエラーが発生しました: {str(e)}"
         }
 
-def analyze_and_comment_on_file(file_blob: bytes, file_path: str) -> str:
+def analyze_and_comment_on_file(file_blob: bytes, file_path: str, text_summary: dict = None) -> str:
     """ファイル内容を解析してコメントを生成します。
 
     Args:
         file_blob (bytes): ファイルのバイナリデータ
         file_path (str): ファイルパス
+        text_summary (dict): 変換サービスのテキスト抽出結果（あればページ数とキーワードの判定に使用）
 
     Returns:
         str: ファイル内容に関するコメント
@@ -175,13 +223,22 @@ def analyze_and_comment_on_file(file_blob: bytes, file_path: str) -> str:
         if file_blob.startswith(b'%PDF'):
             analysis_parts.append("📄 **PDFファイル**として認識されました")
             
-            # PDFの簡易解析
-            content_str = str(file_blob)
-            page_count = content_str.count('/Type /Page')
-            if page_count == 0:
-                page_count = content_str.count('endobj') // 10  # 大まかな推定
-            
-            analysis_parts.append(f"📊 推定ページ数: {max(1, page_count)}ページ")
+            if text_summary:
+                # テキスト抽出結果があれば実際のページ数とテキストを使用
+                content_str = '\n'.join(page["text"] for page in text_summary["pages"])
+                page_count = text_summary["page_count"]
+                analysis_parts.append(f"📊 ページ数: {page_count}ページ")
+                dimension_count = sum(len(page["dimensions"]) for page in text_summary["pages"])
+                if dimension_count:
+                    analysis_parts.append(f"📐 検出された寸法注記: {dimension_count}件")
+            else:
+                # PDFの簡易解析
+                content_str = str(file_blob)
+                page_count = content_str.count('/Type /Page')
+                if page_count == 0:
+                    page_count = content_str.count('endobj') // 10  # 大まかな推定
+                
+                analysis_parts.append(f"📊 推定ページ数: {max(1, page_count)}ページ")
             
             # PDFの内容キーワード検索
             keywords_found = []
@@ -418,7 +475,7 @@ def execute_pdf_download_test(document_id: str = "adk",collection_name: str = "a
         validation_results = {
             "is_pdf_format": pdf_info["is_valid_pdf"],
             "has_content": pdf_info["file_size_mb"] > 0.01,  # 10KB以上
-            "estimated_pages": 1,  # 簡易推定
+            "estimated_pages": pdf_info.get("page_count", 1),  # テキスト抽出結果が無い場合は簡易推定
             "file_size_mb": pdf_info["file_size_mb"],
             "validation_status": "valid" if pdf_info["is_valid_pdf"] else "unknown",
             "access_method": "direct_url"
@@ -484,6 +541,7 @@ def execute_pdf_download_test(document_id: str = "adk",collection_name: str = "a
             "pdf_info": pdf_info,
             "validation_results": validation_results,
             "analysis_comment": analysis_comment,
+            "text_summary": analysis_result.get("text_summary"),
             "analysis_data": analysis_data,
             "next_step": "Step2: analysisJSONの内容出力に進む準備が整いました"
         }
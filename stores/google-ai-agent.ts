@@ -62,6 +62,8 @@ export const useGoogleAiAgentStore = defineStore("googleAiAgent", {
     currentAppName: "",
     // リアルタイム監視のunsubscribe関数
     currentUnsubscribe: null as Unsubscribe | null,
+    // 受信中のAgentメッセージのID
+    streamingMessageId: null as string | null,
   }),
 
   getters: {
@@ -97,6 +99,20 @@ export const useGoogleAiAgentStore = defineStore("googleAiAgent", {
       this.updateConversationHistoryForView();
     },
 
+    // 受信中のAgentメッセージを追加、または途中経過で更新する
+    upsertStreamingMessage(content: Part[]) {
+      const message = this.conversationHistory.find(
+        (msg) => msg.id === this.streamingMessageId
+      );
+      if (message) {
+        message.content = content;
+        this.updateConversationHistoryForView();
+        return;
+      }
+      this.addMessage("model", content);
+      this.streamingMessageId = this.latestMessage.id;
+    },
+
     // 表示用の会話履歴を更新する
     updateConversationHistoryForView() {
       this.conversationHistoryForView = this.conversationHistory
@@ -187,6 +203,7 @@ export const useGoogleAiAgentStore = defineStore("googleAiAgent", {
     clearConversation() {
       this.conversationHistory = [];
       this.conversationHistoryForView = [];
+      this.streamingMessageId = null;
       log("INFO", "会話履歴をクリアしました");
     },
 
@@ -332,11 +349,23 @@ export const useGoogleAiAgentStore = defineStore("googleAiAgent", {
               const data =
                 docSnapshot.data() as decodedSendQueryToGoogleAgentRequest;
 
-              if (data && data.status === "completed" && data.output?.parts) {
-                // Agentのレスポンスを会話履歴に追加
+              if (data && data.status === "streaming" && data.output?.parts) {
+                // 受信中のAgentのレスポンスを途中経過として表示
+                this.upsertStreamingMessage(data.output.parts);
+              } else if (
+                data &&
+                data.status === "completed" &&
+                data.output?.parts
+              ) {
+                // Agentのレスポンスを会話履歴に追加（途中経過を表示済みの場合は置き換え）
                 const agentResponse = data.output.parts;
 
-                this.addMessage("model", agentResponse);
+                if (this.streamingMessageId) {
+                  this.upsertStreamingMessage(agentResponse);
+                  this.streamingMessageId = null;
+                } else {
+                  this.addMessage("model", agentResponse);
+                }
 
                 toast.add({
                   title: "AI Agentからレスポンスを受信しました",
@@ -354,6 +383,7 @@ export const useGoogleAiAgentStore = defineStore("googleAiAgent", {
                 }
               } else if (data && data.status === "failed") {
                 this.isProcessing = false;
+                this.streamingMessageId = null;
                 globalError.createNewGlobalError({
                   selectedErrorMessage:
                     globalError.errorCodeList.googleAiAgent.E4205,
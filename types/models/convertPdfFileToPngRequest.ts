@@ -12,12 +12,32 @@ export const convertPdfFileToPngRequestZodObject = z.object({
     blueprintId: z.string().nullable(),
     inputPdfGcsFilePath: z.string(),
     outputPngGcsFilePath: z.string(),
+    // trueの場合、変換サービスが非同期ジョブとして処理し、進捗をこのドキュメントに書き込みます
+    async: z.boolean().optional(),
+    // trueの場合、版の比較用にページハッシュ(png/blueprint_phash.json)も保存します (全ページを追加でレンダリングします)
+    perceptualHash: z.boolean().optional(),
   }),
   status: z.union([
     z.literal("start"),
+    z.literal("processing"),
     z.literal("completed"),
     z.literal("failed"),
   ]),
+  // 変換サービスが非同期ジョブとして書き込む進捗
+  progress: z
+    .object({
+      pagesDone: z.number().optional(),
+      pagesTotal: z.number().optional(),
+      tilesDone: z.number().optional(),
+      tilesTotal: z.number().optional(),
+      bytes: z.number().optional(),
+      elapsedMs: z.number(),
+    })
+    .optional(),
+  // 非同期ジョブの最終更新時刻 (更新が途絶えたジョブはbackendの定期実行関数がfailedにします)
+  heartbeatAt: z.instanceof(Timestamp).optional(),
+  // 変換サービスのレスポンス (完了・失敗時に書き込まれます)
+  output: z.record(z.unknown()).optional(),
   logs: z.array(requestJobLogZodObject),
 });
 
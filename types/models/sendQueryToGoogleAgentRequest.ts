@@ -37,6 +37,8 @@ export const sendQueryToGoogleAgentRequestZodObject = z.object({
     .optional(),
   status: z.union([
     z.literal("pending"),
+    // Agentの応答を受信中（output.partsに途中経過が入ります）
+    z.literal("streaming"),
     z.literal("completed"),
     z.literal("failed"),
   ]),